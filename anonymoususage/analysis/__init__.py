@@ -0,0 +1,8 @@
+__author__ = 'calvin'
+
+from arrays import *
+from consolidate import *
+from executor import *
+from database import DataBase
+from manager import DataManager
+from plot import plot_statistic, plot_total_statistics, plot_state, plot_timer
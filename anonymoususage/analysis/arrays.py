@@ -0,0 +1,254 @@
+__author__ = 'calvin'
+
+import logging
+
+import numpy as np
+
+from anonymoususage.tools import *
+from anonymoususage.tools import TEXT_TIME_TO_EPOCH
+
+logger = logging.getLogger('AnonymousUsage')
+
+__all__ = ['TableData', 'load_table', 'concatenate', 'group_starts', 'group_ends', 'diffs', 'rates', 'totals',
+           'resample', 'state_dwell_times']
+
+RESAMPLE_METHODS = ('sum', 'count', 'mean', 'last')
+
+
+class TableData(object):
+    """
+    Rows of a table as NumPy arrays, sorted by UUID and then by time.
+
+    :ivar name: table name
+    :ivar uuids: array of the distinct UUIDs
+    :ivar uuid_codes: int array of the index in `uuids` of each row's UUID
+    :ivar times: float64 array of unix timestamps
+    :ivar counts: float64 array of the Count column
+    :ivar states: array of the distinct State values, or None if the table is not a State
+    :ivar state_codes: int array of the index in `states` of each row's State, or None
+    """
+
+    def __init__(self, name, uuids, uuid_codes, times, counts, states=None, state_codes=None):
+        self.name = name
+        self.uuids = uuids
+        self.uuid_codes = uuid_codes
+        self.times = times
+        self.counts = counts
+        self.states = states
+        self.state_codes = state_codes
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return 'TableData ({s.name}): {n} rows, {u} UUIDs'.format(s=self, n=len(self), u=len(self.uuids))
+
+    def select(self, mask):
+        """
+        Return the rows selected by a boolean mask or index array.
+        """
+        states = self.state_codes[mask] if self.state_codes is not None else None
+        return TableData(self.name, self.uuids, self.uuid_codes[mask], self.times[mask], self.counts[mask],
+                         self.states, states)
+
+    def for_uuid(self, uuid):
+        """
+        Return the rows of one UUID.
+        """
+        code = np.searchsorted(self.uuids, uuid)
+        if code == len(self.uuids) or self.uuids[code] != uuid:
+            return self.select(np.zeros(len(self), dtype=bool))
+        return self.select(self.uuid_codes == code)
+
+
+def _sorted(data):
+    # Rows are kept grouped by UUID and in time order within each UUID, which all per-UUID operations rely on
+    order = np.lexsort((data.times, data.uuid_codes))
+    return data.select(order)
+
+
+def load_table(dbconn, tablename, uuid=None, since=None, until=None):
+    """
+    Load the rows of a table into NumPy arrays. Times stored as text by older versions are converted by SQLite.
+    :param dbconn: database connection
+    :param tablename: name of the table
+    :param uuid: optional UUID to load the rows of
+    :param since: optional datetime or unix timestamp of the earliest row
+    :param until: optional datetime or unix timestamp after the latest row
+    :return: TableData
+    """
+    columns = get_table_columns(dbconn, tablename)
+    is_state = 'State' in [c[0] for c in columns]
+    select = 'UUID, Count, {time}{state}'.format(time=TEXT_TIME_TO_EPOCH, state=', State' if is_state else '')
+    # Tables written by older versions have a text Time column, which is compared as a string unless it is converted.
+    # Tables with a numeric Time column are filtered on the column itself, so the Time index is used.
+    time_column = TEXT_TIME_TO_EPOCH if ('Time', 'TEXT') in columns else '"Time"'
+    conditions, args = [], []
+    if uuid is not None:
+        conditions.append('UUID = ?')
+        args.append(uuid)
+    if since is not None:
+        conditions.append('{} >= ?'.format(time_column))
+        args.append(to_epoch(since))
+    if until is not None:
+        conditions.append('{} < ?'.format(time_column))
+        args.append(to_epoch(until))
+    query = "SELECT {select} FROM {name}".format(select=select, name=quote_identifier(tablename))
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    cursor = dbconn.cursor()
+    cursor.row_factory = None
+    rows = cursor.execute(query, args).fetchall()
+    if rows:
+        columns = zip(*rows)
+    else:
+        columns = [()] * (4 if is_state else 3)
+    uuids, uuid_codes = np.unique(np.array(columns[0], dtype=object).astype(unicode), return_inverse=True)
+    times = np.array(columns[2], dtype=np.float64)
+    counts = np.array(columns[1], dtype=np.float64)
+    states = state_codes = None
+    if is_state:
+        states, state_codes = np.unique(np.array(columns[3], dtype=object).astype(unicode), return_inverse=True)
+    logger.debug("Loaded {n} rows of table '{name}'".format(n=len(rows), name=tablename))
+    return _sorted(TableData(tablename, uuids, uuid_codes, times, counts, states, state_codes))
+
+
+def _recode(values, codes, categories):
+    # Map the codes of each part to codes in the combined categories
+    return np.concatenate([np.searchsorted(categories, v)[c] for v, c in zip(values, codes)])
+
+
+def concatenate(datas):
+    """
+    Combine the rows of the same table loaded from several databases.
+    :param datas: list of TableData
+    :return: TableData
+    """
+    datas = list(datas)
+    uuids = np.unique(np.concatenate([d.uuids for d in datas]))
+    uuid_codes = _recode([d.uuids for d in datas], [d.uuid_codes for d in datas], uuids)
+    states = state_codes = None
+    if datas[0].states is not None:
+        states = np.unique(np.concatenate([d.states for d in datas]))
+        state_codes = _recode([d.states for d in datas], [d.state_codes for d in datas], states)
+    data = TableData(datas[0].name, uuids, uuid_codes, np.concatenate([d.times for d in datas]),
+                     np.concatenate([d.counts for d in datas]), states, state_codes)
+    return _sorted(data)
+
+
+def group_starts(data):
+    """
+    Return a boolean array that is True for the first row of each UUID.
+    """
+    starts = np.ones(len(data), dtype=bool)
+    starts[1:] = data.uuid_codes[1:] != data.uuid_codes[:-1]
+    return starts
+
+
+def group_ends(data):
+    """
+    Return a boolean array that is True for the last row of each UUID.
+    """
+    ends = np.ones(len(data), dtype=bool)
+    ends[:-1] = data.uuid_codes[1:] != data.uuid_codes[:-1]
+    return ends
+
+
+def diffs(data, initial=0.):
+    """
+    Return the change of the Count of each row from the previous row of the same UUID. The first row of each UUID is
+    compared to `initial`, so the diffs of a Statistic sum up to its count.
+    """
+    result = np.empty(len(data))
+    result[1:] = np.diff(data.counts)
+    starts = group_starts(data)
+    result[starts] = data.counts[starts] - initial
+    return result
+
+
+def rates(data):
+    """
+    Return the change of the Count per second between each row and the previous row of the same UUID. The first row of
+    each UUID, and rows at the same time as the previous row, have a rate of NaN.
+    """
+    result = np.full(len(data), np.nan)
+    if len(data) < 2:
+        return result
+    dt = np.diff(data.times)
+    dc = np.diff(data.counts)
+    valid = ~group_starts(data)[1:] & (dt > 0)
+    result[1:][valid] = dc[valid] / dt[valid]
+    return result
+
+
+def totals(data):
+    """
+    Return the last Count of each UUID.
+    :return: tuple of (array of UUIDs, array of counts)
+    """
+    ends = group_ends(data)
+    return data.uuids[data.uuid_codes[ends]], data.counts[ends]
+
+
+def resample(times, values, interval, start=None, end=None, how='sum'):
+    """
+    Aggregate values into fixed time intervals.
+    :param times: array of unix timestamps
+    :param values: array of values, ie. the diffs of a Statistic
+    :param interval: length of each interval in seconds
+    :param start: start of the first interval, the earliest time if None
+    :param end: end of the last interval (exclusive), after the latest time if None
+    :param how: 'sum', 'count', 'mean' or 'last' (the value of the latest row in each interval, NaN if there is none)
+    :return: tuple of (array of interval start times, array of aggregated values)
+    """
+    if how not in RESAMPLE_METHODS:
+        raise ValueError('Unknown resample method: %s' % how)
+    times = np.asarray(times, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if start is None:
+        start = times.min() if len(times) else 0.
+    if end is None:
+        end = times.max() + interval if len(times) else start
+    n_bins = max(int(np.ceil((end - start) / float(interval))), 0)
+    bins = np.floor((times - start) / interval).astype(np.int64)
+    inside = (bins >= 0) & (bins < n_bins)
+    bins, times, values = bins[inside], times[inside], values[inside]
+    starts = start + interval * np.arange(n_bins)
+
+    if how == 'last':
+        result = np.full(n_bins, np.nan)
+        order = np.lexsort((times, bins))
+        bins, values = bins[order], values[order]
+        # Rows are sorted by interval and time, take the last row of each interval
+        last = np.ones(len(bins), dtype=bool)
+        last[:-1] = bins[1:] != bins[:-1]
+        result[bins[last]] = values[last]
+        return starts, result
+    sums = np.bincount(bins, weights=values, minlength=n_bins)
+    if how == 'sum':
+        return starts, sums
+    counts = np.bincount(bins, minlength=n_bins).astype(np.float64)
+    if how == 'count':
+        return starts, counts
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return starts, sums / counts
+
+
+def state_dwell_times(data, end=None):
+    """
+    Return the total time spent in each state. Each row of a UUID lasts until the next row of that UUID; the last row
+    of each UUID lasts until `end`, or is not counted if `end` is None.
+    :param data: TableData of a State table
+    :param end: optional datetime or unix timestamp at which the last state of each UUID ended
+    :return: dictionary of state values to seconds
+    """
+    if data.state_codes is None:
+        raise ValueError("Table '{}' is not a State".format(data.name))
+    dwell = np.zeros(len(data))
+    if len(data):
+        dwell[:-1] = np.diff(data.times)
+        ends = group_ends(data)
+        dwell[ends] = to_epoch(end) - data.times[ends] if end is not None else 0.
+    seconds = np.bincount(data.state_codes, weights=dwell, minlength=len(data.states))
+    return dict(zip(data.states.tolist(), seconds.tolist()))
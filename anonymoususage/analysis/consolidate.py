@@ -0,0 +1,155 @@
+__author__ = 'calvin'
+
+import logging
+import multiprocessing
+import os
+import re
+import sqlite3
+from collections import defaultdict
+
+from anonymoususage.rollup import ROLLUP_TABLE
+from anonymoususage.sketch import SKETCH_TABLE
+from anonymoususage.submission import WATERMARK_TABLE
+from anonymoususage.tools import *
+from anonymoususage.tools import TEXT_TIME_TO_EPOCH
+
+logger = logging.getLogger('AnonymousUsage')
+
+__all__ = ['consolidate', 'consolidate_parallel', 'group_parts', 'DEDUP_COLUMNS']
+
+# A tracker names the databases of a user <uuid>_<n>.db (see AnonymousUsageTracker.regex_db)
+REGEX_PART = re.compile(r'^(?P<uuid>.+)_\d+\.db$')
+# Rows with the same values in these columns are the same event. Tables without them are compared on every column.
+DEDUP_COLUMNS = ('UUID', 'Count', 'Time')
+# Bookkeeping of a single tracker, which does not carry over into a consolidated database
+SKIPPED_TABLES = (WATERMARK_TABLE, ROLLUP_TABLE, SKETCH_TABLE)
+
+
+def group_parts(paths):
+    """
+    Group the databases named <uuid>_<n>.db by UUID.
+    :param paths: paths of database files
+    :return: dictionary of UUIDs to lists of paths
+    """
+    groups = defaultdict(list)
+    for path in paths:
+        match = REGEX_PART.match(os.path.basename(path))
+        if match:
+            groups[match.group('uuid')].append(path)
+    return dict(groups)
+
+
+def _source_tables(dbconn):
+    # Read the schema of the attached database, the file itself is never written to
+    tables = []
+    for (table,) in dbconn.execute("SELECT name FROM source.sqlite_master WHERE type='table'").fetchall():
+        if table in SKIPPED_TABLES or table.startswith('sqlite_'):
+            continue
+        info = dbconn.execute("PRAGMA source.table_info({})".format(quote_identifier(table))).fetchall()
+        tables.append((table, [(row[1], row[2]) for row in info]))
+    return tables
+
+
+def _merge_table(dbconn, table, columns):
+    # Copy the rows of the attached table that are not already in the main database. DISTINCT removes the duplicates
+    # within the source, NOT EXISTS the rows merged before, looked up in the UUID index. Databases written by older
+    # versions store the times as text, which are converted to unix timestamps as they are copied.
+    names = [c for c, _ in columns]
+    main_names = [c for c, _ in get_table_columns(dbconn, table)]
+    for column, type in columns:
+        if column not in main_names:
+            dbconn.execute("ALTER TABLE main.{name} ADD COLUMN {column} {type}".format(
+                name=quote_identifier(table), column=quote_identifier(column),
+                type='REAL' if column == 'Time' else type))
+    keys = DEDUP_COLUMNS if set(DEDUP_COLUMNS).issubset(names) else names
+    values = ', '.join('{} AS "Time"'.format(TEXT_TIME_TO_EPOCH) if c == 'Time' else quote_identifier(c) for c in names)
+    cur = dbconn.execute(
+        "INSERT INTO main.{name} ({columns}) SELECT DISTINCT * FROM (SELECT {values} FROM source.{name}) AS s "
+        "WHERE NOT EXISTS (SELECT 1 FROM main.{name} AS m WHERE {match})".format(
+            name=quote_identifier(table),
+            columns=', '.join(quote_identifier(c) for c in names),
+            values=values,
+            match=' AND '.join('m.{c} IS s.{c}'.format(c=quote_identifier(c)) for c in keys)))
+    return cur.rowcount
+
+
+def _merge_file(dbconn, path):
+    total = 0
+    with attach_database(dbconn, path, 'source'):
+        dbconn.execute("BEGIN IMMEDIATE")
+        try:
+            for table, columns in _source_tables(dbconn):
+                names = [c for c, _ in columns]
+                if create_table(dbconn, table, [(c, 'REAL' if c == 'Time' else t) for c, t in columns]):
+                    if 'Time' in names:
+                        create_time_index(dbconn, table)
+                # Tables created by an earlier consolidation may not be indexed yet
+                if set(DEDUP_COLUMNS).issubset(names):
+                    create_uuid_index(dbconn, table)
+                total += _merge_table(dbconn, table, columns)
+            dbconn.execute("COMMIT")
+        except sqlite3.Error:
+            dbconn.execute("ROLLBACK")
+            raise
+    return total
+
+
+def consolidate(target, paths, delete=False):
+    """
+    Merge databases into one database. Each database is attached to the target and its rows are copied by SQLite in
+    one transaction, skipping the rows the target already has, so a database can be consolidated more than once. The
+    databases are only read; text times written by older versions are converted to unix timestamps as they are copied.
+    Tables are created in the target as they are found, with an index on their UUID, Time and Count columns.
+    :param target: path of the database to merge into, which is created if it does not exist
+    :param paths: paths of the databases to merge
+    :param delete: delete each database once it is merged
+    :return: number of rows added to the target
+    """
+    # The transactions are managed explicitly, a database can not be attached within one
+    dbconn = sqlite3.connect(target, isolation_level=None)
+    total = 0
+    try:
+        # Only the target is migrated, the databases merged into it are read without being modified
+        migrate_schema(dbconn)
+        for path in paths:
+            if os.path.abspath(path) == os.path.abspath(target):
+                continue
+            n = _merge_file(dbconn, path)
+            logger.debug('Consolidated {n} rows of {path} into {target}'.format(n=n, path=path, target=target))
+            total += n
+            if delete:
+                os.remove(path)
+    finally:
+        dbconn.close()
+    return total
+
+
+def _consolidate_job(args):
+    # Entry point of the worker processes
+    return consolidate(*args)
+
+
+def consolidate_parallel(target, paths, processes=None, delete=False):
+    """
+    Merge databases into one database with a pool of processes. The databases are split into one shard per process,
+    each process consolidates its shard into a temporary database next to the target and the shards are then merged
+    into the target.
+    :param target: path of the database to merge into
+    :param paths: paths of the databases to merge
+    :param processes: number of processes, the number of CPUs by default
+    :param delete: delete each database once it is merged
+    :return: number of rows added to the target
+    """
+    processes = processes or multiprocessing.cpu_count()
+    shards = [paths[i::processes] for i in xrange(processes) if paths[i::processes]]
+    if len(shards) < 2:
+        return consolidate(target, paths, delete)
+
+    jobs = [('{target}.shard{i}'.format(target=target, i=i), shard, delete) for i, shard in enumerate(shards)]
+    pool = multiprocessing.Pool(len(jobs))
+    try:
+        pool.map(_consolidate_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return consolidate(target, [job[0] for job in jobs], delete=True)
@@ -0,0 +1,46 @@
+__author__ = 'calvin'
+
+import sqlite3
+
+from anonymoususage.tools import *
+from .arrays import load_table
+
+
+class DataBase(sqlite3.Connection):
+    """
+    Connection to a usage database for analysis. Open it with sqlite3.connect(path, factory=DataBase).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(DataBase, self).__init__(*args, **kwargs)
+        self.row_factory = sqlite3.Row
+
+    def get_table_list(self):
+        """
+        Return the names of the tables that hold usage statistics.
+        """
+        return [t for t in get_table_list(self) if not t.startswith('__') or t == '__submissions__']
+
+    def get_uuid_list(self):
+        """
+        Return the UUIDs that have rows in any of the tables.
+        """
+        return get_uuid_list(self, self.get_table_list())
+
+    def rename_table(self, original, new):
+        """
+        Rename a table, if it exists.
+        :return: True if the table was renamed
+        """
+        if not check_table_exists(self, original) or check_table_exists(self, new):
+            return False
+        rename_table(self, original, new)
+        self.commit()
+        return True
+
+    def load(self, tablename, uuid=None, since=None, until=None):
+        """
+        Load the rows of a table into NumPy arrays. See `arrays.load_table`.
+        :return: TableData
+        """
+        return load_table(self, tablename, uuid, since, until)
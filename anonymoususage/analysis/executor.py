@@ -0,0 +1,192 @@
+__author__ = 'calvin'
+
+import itertools
+import logging
+import multiprocessing
+import sqlite3
+import time
+
+import numpy as np
+
+from anonymoususage.tools import *
+from anonymoususage.tools import TEXT_TIME_TO_EPOCH
+
+logger = logging.getLogger('AnonymousUsage')
+
+__all__ = ['Query', 'LastCount', 'RowCount', 'QueryResult', 'QueryExecutor', 'REDUCERS']
+
+REDUCERS = {'sum': np.sum, 'mean': np.mean, 'histogram': np.histogram}
+
+
+class Query(object):
+    """
+    Query run on each database by a QueryExecutor. A query returns a dictionary of UUIDs to values, and values of the
+    same UUID from different databases (ie. the <uuid>_<n>.db databases of one user) are merged with `combine`.
+    Queries are sent to the worker processes, so subclasses must be defined at module level.
+    """
+
+    def __init__(self, tablename):
+        """
+        :param tablename: name of the table to query
+        """
+        self.tablename = tablename
+
+    def __call__(self, dbconn):
+        if not check_table_exists(dbconn, self.tablename):
+            return {}
+        return self.execute(dbconn)
+
+    def execute(self, dbconn):
+        """
+        Run the query on a database that has the table.
+        :return: dictionary of UUIDs to values
+        """
+        raise NotImplementedError
+
+    def combine(self, a, b):
+        """
+        Merge two values of the same UUID.
+        """
+        return a + b
+
+    def value(self, v):
+        """
+        Return the value passed to the reducer for a merged value.
+        """
+        return v
+
+
+class LastCount(Query):
+    """
+    The Count of the last row (highest ROWID, as returned by tools.get_last_row) of each UUID. Across databases the
+    latest row by time is kept.
+    """
+
+    def execute(self, dbconn):
+        name = quote_identifier(self.tablename)
+        rows = dbconn.execute("SELECT UUID, {time}, Count FROM {name} WHERE ROWID IN "
+                              "(SELECT MAX(ROWID) FROM {name} GROUP BY UUID)".format(time=TEXT_TIME_TO_EPOCH,
+                                                                                       name=name))
+        return {uuid: (t, count) for uuid, t, count in rows}
+
+    def combine(self, a, b):
+        return max(a, b)
+
+    def value(self, v):
+        return v[1]
+
+
+class RowCount(Query):
+    """
+    The number of rows of each UUID, ie. the number of times a statistic was changed.
+    """
+
+    def execute(self, dbconn):
+        rows = dbconn.execute("SELECT UUID, COUNT(*) FROM {name} GROUP BY UUID".format(
+            name=quote_identifier(self.tablename)))
+        return dict(rows.fetchall())
+
+
+class QueryResult(object):
+    """
+    Result of a query run over many databases.
+
+    :ivar value: the reduced value, or None if no database had rows for the query
+    :ivar values: dictionary of UUIDs to their merged values
+    :ivar timings: dictionary of database paths to the seconds taken to query them
+    :ivar errors: dictionary of database paths to the errors raised by them
+    """
+
+    def __init__(self, value, values, timings, errors):
+        self.value = value
+        self.values = values
+        self.timings = timings
+        self.errors = errors
+
+    def __repr__(self):
+        return 'QueryResult: {v} ({n} UUIDs, {f} databases, {e} errors)'.format(v=self.value, n=len(self.values),
+                                                                               f=len(self.timings),
+                                                                               e=len(self.errors))
+
+    def slowest(self, n=10):
+        """
+        Return the `n` databases that took the longest to query.
+        :return: list of (path, seconds) tuples
+        """
+        return sorted(self.timings.iteritems(), key=lambda item: item[1], reverse=True)[:n]
+
+
+def _run_query(args):
+    # Entry point of the worker processes
+    query, path = args
+    start = time.time()
+    try:
+        dbconn = sqlite3.connect(path)
+        try:
+            partial, error = query(dbconn), None
+        finally:
+            dbconn.close()
+    except sqlite3.Error as e:
+        partial, error = {}, str(e)
+    return path, partial, time.time() - start, error
+
+
+class QueryExecutor(object):
+    """
+    Runs a query on each database of a list in a pool of processes and merges the results, without consolidating the
+    databases first.
+    """
+    # Number of databases sent to a worker process at a time
+    CHUNKSIZE = 16
+
+    def __init__(self, paths, processes=None):
+        """
+        :param paths: paths of the databases to query
+        :param processes: number of processes, the number of CPUs by default. With 1 the databases are queried in this
+                          process.
+        """
+        self.paths = list(paths)
+        self.processes = processes or multiprocessing.cpu_count()
+
+    def iter_partials(self, query):
+        """
+        Run a query on every database, yielding the results as they arrive, in no particular order.
+        :param query: Query instance
+        :return: generator of (path, dictionary of UUIDs to values, seconds, error message or None) tuples
+        """
+        jobs = [(query, path) for path in self.paths]
+        if self.processes == 1 or len(jobs) < 2:
+            for result in itertools.imap(_run_query, jobs):
+                yield result
+            return
+        pool = multiprocessing.Pool(min(self.processes, len(jobs)))
+        try:
+            for result in pool.imap_unordered(_run_query, jobs, chunksize=self.CHUNKSIZE):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def run(self, query, reducer='sum', **reducer_kw):
+        """
+        Run a query on every database, merge the values of each UUID and reduce them into one value.
+        :param query: Query instance
+        :param reducer: 'sum', 'mean', 'histogram' (numpy.histogram, returning the counts and bin edges) or a function
+                        that takes an array of the values of every UUID
+        :param reducer_kw: keyword arguments of the reducer, ie. bins=20 for a histogram
+        :return: QueryResult
+        """
+        reduce_values = REDUCERS[reducer] if reducer in REDUCERS else reducer
+        merged, timings, errors = {}, {}, {}
+        for path, partial, seconds, error in self.iter_partials(query):
+            timings[path] = seconds
+            if error is not None:
+                logger.error('Query of {path} failed: {error}'.format(path=path, error=error))
+                errors[path] = error
+            for uuid, v in partial.iteritems():
+                merged[uuid] = query.combine(merged[uuid], v) if uuid in merged else v
+
+        values = {uuid: query.value(v) for uuid, v in merged.iteritems()}
+        value = reduce_values(np.array(values.values()), **reducer_kw) if values else None
+        logger.debug('Queried {n} databases in {s:.2f}s'.format(n=len(timings), s=sum(timings.itervalues())))
+        return QueryResult(value, values, timings, errors)
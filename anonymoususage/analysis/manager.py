@@ -0,0 +1,136 @@
+__author__ = 'calvin'
+
+import ConfigParser
+import glob
+import logging
+import multiprocessing
+import os
+import sqlite3
+
+from anonymoususage.tools import *
+from .arrays import concatenate
+from .consolidate import consolidate, consolidate_parallel, group_parts, _consolidate_job
+from .database import DataBase
+from .executor import QueryExecutor
+
+logger = logging.getLogger('AnonymousUsage')
+
+
+class DataManager(object):
+    """
+    Analyses the usage databases collected in a directory, ie. the databases submitted by the users of an application.
+    The databases can be consolidated into a master database in the same directory.
+    """
+    MASTER = 'master.db'
+
+    def __init__(self, path=None, config=None, master=None):
+        """
+        :param path: directory of the usage databases
+        :param config: optional configuration file. The directory is read from `path` in the [Analysis] section, or
+                       is the directory of `filepath` in the [General] section.
+        :param master: path of the master database, master.db in the directory by default. It can also be set with
+                       `master` in the [Analysis] section of the configuration file.
+        """
+        if config is not None:
+            cfg = ConfigParser.ConfigParser()
+            with open(config, 'r') as _f:
+                cfg.readfp(_f)
+            if path is None and cfg.has_option('Analysis', 'path'):
+                path = cfg.get('Analysis', 'path')
+            elif path is None and cfg.has_option('General', 'filepath'):
+                path = os.path.dirname(cfg.get('General', 'filepath'))
+            if master is None and cfg.has_option('Analysis', 'master'):
+                master = cfg.get('Analysis', 'master')
+        if path is None:
+            raise ValueError('No directory of usage databases was given')
+        self.path = path
+        self.master_path = master or os.path.join(path, self.MASTER)
+
+    def databases(self):
+        """
+        Return the paths of the usage databases in the directory, excluding the master database.
+        """
+        master = os.path.abspath(self.master_path)
+        return sorted(p for p in glob.glob(os.path.join(self.path, '*.db')) if os.path.abspath(p) != master)
+
+    @staticmethod
+    def open(path):
+        """
+        Open a usage database for analysis.
+        :return: DataBase connection
+        """
+        return sqlite3.connect(path, factory=DataBase)
+
+    def load(self, tablename, since=None, until=None):
+        """
+        Load the rows of a table from every database in the directory into NumPy arrays.
+        :param tablename: name of the table
+        :param since: optional datetime or unix timestamp of the earliest row
+        :param until: optional datetime or unix timestamp after the latest row
+        :return: TableData, or None if no database has the table
+        """
+        datas = []
+        for path in self.databases():
+            db = self.open(path)
+            try:
+                if check_table_exists(db, tablename):
+                    datas.append(db.load(tablename, since=since, until=until))
+            finally:
+                db.close()
+        if not datas:
+            return None
+        logger.debug("Loaded table '{}' from {} databases".format(tablename, len(datas)))
+        return concatenate(datas)
+
+    def query(self, query, reducer='sum', processes=None, **reducer_kw):
+        """
+        Run a query on every database in the directory, without consolidating them, and reduce the values of all
+        UUIDs into one value. See `QueryExecutor.run`.
+        :param query: Query instance, ie. LastCount('monsters_killed')
+        :param reducer: 'sum', 'mean', 'histogram' or a function of an array of values
+        :param processes: number of processes, the number of CPUs by default
+        :return: QueryResult
+        """
+        return QueryExecutor(self.databases(), processes).run(query, reducer, **reducer_kw)
+
+    def consolidate_individuals(self, delete_parts=False, processes=None):
+        """
+        Merge the databases of each user, named <uuid>_<n>.db, into one database named <uuid>.db.
+        :param delete_parts: delete the <uuid>_<n>.db databases once they are merged
+        :param processes: number of processes to merge the users' databases in, 1 to merge them in this process
+        :return: number of rows merged
+        """
+        jobs = [(os.path.join(self.path, uuid + '.db'), sorted(paths), delete_parts)
+                for uuid, paths in sorted(group_parts(self.databases()).iteritems())]
+        processes = processes or multiprocessing.cpu_count()
+        if processes > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(processes, len(jobs)))
+            try:
+                counts = pool.map(_consolidate_job, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            counts = map(_consolidate_job, jobs)
+        logger.debug('Consolidated the databases of {} users'.format(len(jobs)))
+        return sum(counts)
+
+    def consolidate_into_master(self, delete=False, processes=None):
+        """
+        Merge every database in the directory into the master database. Rows already in the master database are
+        skipped, so the directory can be consolidated again as new databases arrive.
+        :param delete: delete the databases once they are merged
+        :param processes: number of processes to merge the databases in, 1 to merge them in this process
+        :return: number of rows added to the master database
+        """
+        paths = self.databases()
+        if processes == 1:
+            return consolidate(self.master_path, paths, delete)
+        return consolidate_parallel(self.master_path, paths, processes, delete)
+
+    def open_master(self):
+        """
+        Open the master database for analysis.
+        :return: DataBase connection
+        """
+        return self.open(self.master_path)
@@ -0,0 +1,100 @@
+__author__ = 'calvin'
+
+import numpy as np
+
+from .arrays import diffs, totals, state_dwell_times
+
+__all__ = ['plot_statistic', 'plot_total_statistics', 'plot_state', 'plot_timer']
+
+
+def _pyplot():
+    # matplotlib is only needed for plotting, the rest of the analysis package works without it
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        raise ImportError('Plotting requires matplotlib: pip install anonymoususage[plot]')
+    return plt
+
+
+def _datetimes(times):
+    return (np.asarray(times) * 1e6).astype('datetime64[us]')
+
+
+def _load(db, tablenames):
+    return [db.load(name) for name in tablenames if name in db.get_table_list()]
+
+
+def plot_statistic(db, tablenames, show=True):
+    """
+    Plot the count of each statistic over time, one line per UUID.
+    :param db: DataBase connection
+    :param tablenames: names of the Statistic tables
+    :param show: show the figure
+    :return: matplotlib figure
+    """
+    plt = _pyplot()
+    datas = _load(db, tablenames)
+    fig, axes = plt.subplots(len(datas), 1, squeeze=False, sharex=True)
+    for ax, data in zip(axes[:, 0], datas):
+        for code, uuid in enumerate(data.uuids):
+            mask = data.uuid_codes == code
+            ax.step(_datetimes(data.times[mask]), data.counts[mask], where='post', label=uuid)
+        ax.set_title(data.name)
+        ax.set_ylabel('Count')
+    fig.autofmt_xdate()
+    if show:
+        plt.show()
+    return fig
+
+
+def plot_total_statistics(db, tablenames, show=True):
+    """
+    Plot the total count of each statistic summed over all UUIDs.
+    """
+    plt = _pyplot()
+    datas = _load(db, tablenames)
+    fig, ax = plt.subplots()
+    positions = np.arange(len(datas))
+    ax.bar(positions, [totals(data)[1].sum() for data in datas])
+    ax.set_xticks(positions)
+    ax.set_xticklabels([data.name for data in datas], rotation=45, ha='right')
+    ax.set_ylabel('Total count')
+    if show:
+        plt.show()
+    return fig
+
+
+def plot_state(db, tablenames, show=True):
+    """
+    Plot the total time spent in each state, summed over all UUIDs.
+    """
+    plt = _pyplot()
+    datas = _load(db, tablenames)
+    fig, axes = plt.subplots(len(datas), 1, squeeze=False)
+    for ax, data in zip(axes[:, 0], datas):
+        dwell = state_dwell_times(data)
+        states = sorted(dwell)
+        ax.barh(np.arange(len(states)), [dwell[s] / 3600. for s in states])
+        ax.set_yticks(np.arange(len(states)))
+        ax.set_yticklabels(states)
+        ax.set_title(data.name)
+        ax.set_xlabel('Hours')
+    if show:
+        plt.show()
+    return fig
+
+
+def plot_timer(db, tablenames, bins=50, show=True):
+    """
+    Plot a histogram of the durations recorded by each timer.
+    """
+    plt = _pyplot()
+    datas = _load(db, tablenames)
+    fig, axes = plt.subplots(len(datas), 1, squeeze=False)
+    for ax, data in zip(axes[:, 0], datas):
+        ax.hist(diffs(data), bins=bins)
+        ax.set_title(data.name)
+        ax.set_xlabel('Seconds')
+    if show:
+        plt.show()
+    return fig
@@ -1,6 +1,7 @@
 __author__ = 'calvin'
 
 import ConfigParser
+import atexit
 import datetime
 import logging
 import os
@@ -11,9 +12,16 @@ import sqlite3
 import threading
 import time
 import socket
-import requests
 
-from tables import Table, Statistic, State, Timer, Sequence, NO_STATE
+from tables import Table, Statistic, State, Timer, Sequence, NO_STATE, Storage, SQLiteStorage, MemoryStorage, \
+    LogStorage
+from .buffer import EventBuffer
+from .pool import ConnectionPool, PooledConnection
+from .rollup import Rollups
+from .sketch import *
+from .submission import *
+from .uploader import Uploader
+from .worker import Waiter, Worker
 from .exceptions import TableConflictError
 from .tools import *
 
@@ -23,18 +31,59 @@ logger = logging.getLogger('AnonymousUsage')
 
 class AnonymousUsageTracker(object):
     HQ_DEFAULT_TIMEOUT = 10
+    HQ_CONTENT_ENCODING = 'gzip'
+    HQ_BATCH_ROWS = 1000
+    # Failed uploads are retried with backoff. After HQ_FAILURE_THRESHOLD failed submissions in a row, uploads are
+    # paused for HQ_COOLDOWN_S seconds.
+    HQ_RETRIES = 2
+    HQ_BACKOFF_S = 1
+    HQ_FAILURE_THRESHOLD = 3
+    HQ_COOLDOWN_S = 600
+    # Maximum relative error of the duration percentiles of Timers
+    SKETCH_RELATIVE_ACCURACY = 0.01
     MAX_ROWS_PER_TABLE = 1000
+    # Fraction of max_rows a table may grow past its limit before the oldest rows are deleted, if eviction_slack is None
+    EVICTION_SLACK_FRACTION = 0.1
+    # Write-ahead logging lets readers run alongside the writer and only syncs the log at checkpoints
+    SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}
+    STORAGE_MODES = ('split', 'single')
 
     def __init__(self, uuid, filepath, submit_interval_s=0, check_interval_s=0, enabled=True,
-                 application_name='', application_version='', debug=False):
+                 application_name='', application_version='', debug=False, buffer_size=0, flush_interval_s=0,
+                 eviction_slack=None, sqlite_pragmas=None, defer_submission=False, submit_threshold=0,
+                 storage_mode='split', storage=None, rollups=False):
         """
         Create a usage tracker database with statistics from a unique user defined by the uuid.
         :param uuid: unique identifier
         :param filepath: path to store the database
         :param application_name: Name of the application as a string
         :param application_version: Application version as a string
-        :param check_interval_s: How often the tracker should check to see if an upload is required (seconds)
+        :param check_interval_s: How long the watcher waits before retrying a failed upload (seconds)
         :param submit_interval_s: How often the usage statistics should be uploaded (seconds)
+        :param buffer_size: Number of rows to hold in memory before writing them to the database in one transaction.
+                            If 0, every row is written and committed immediately.
+        :param flush_interval_s: Maximum number of seconds a buffered row is held in memory before being written
+        :param eviction_slack: Number of rows a table may grow past its max_rows before the oldest rows are deleted.
+                               Rows over max_rows are also deleted before every watcher submission and on close.
+                               If None, a table may grow by EVICTION_SLACK_FRACTION of its max_rows.
+        :param sqlite_pragmas: Dictionary of PRAGMA settings applied to every database connection, ie.
+                               {'cache_size': -8000, 'mmap_size': 67108864}. These are applied on top of
+                               SQLITE_PRAGMAS, set a pragma to None to leave it at the SQLite default.
+        :param defer_submission: Check whether a submission is due, and submit, on a background thread rather than
+                                 during construction. The check is also made when the HQ is set up.
+        :param submit_threshold: Number of new rows that triggers a submission by the watcher before the submit
+                                 interval has passed. If 0, the watcher only submits once the interval has passed.
+        :param storage_mode: 'split' keeps rows that have not been submitted in a separate partial database, which
+                             is merged into the master database after each submission. 'single' keeps every row in
+                             the master database and records which rows were submitted. An existing partial
+                             database is merged into the master database when a tracker is opened in 'single' mode,
+                             and left untouched by a tracker in 'split' mode without a submit interval.
+        :param storage: Where the rows of the tracked tables are kept: 'sqlite' (the default) for the tracker's
+                        database files, 'log' to append Statistic and Timer rows to a memory-mapped segment file
+                        that is compacted into the database, 'memory' to keep them in memory only, or a Storage
+                        instance.
+        :param rollups: Keep per-minute, per-hour and per-day aggregates of every Statistic and Timer in the master
+                        database. These outlive the rows removed by max_rows.
         """
 
         if debug:
@@ -47,36 +96,87 @@ class AnonymousUsageTracker(object):
         self.check_interval_s = check_interval_s
         self.application_name = application_name
         self.application_version = application_version
+        self.eviction_slack = eviction_slack
+        self.sqlite_pragmas = dict(self.SQLITE_PRAGMAS, **(sqlite_pragmas or {}))
+        self.defer_submission = defer_submission
+        self.submit_threshold = submit_threshold
+        if storage_mode not in self.STORAGE_MODES:
+            raise ValueError('Unknown storage mode: %s' % storage_mode)
+        self.storage_mode = storage_mode
+        if isinstance(storage, Storage):
+            self.storage = storage
+        elif storage in (None, 'sqlite'):
+            self.storage = SQLiteStorage(self)
+        elif storage == 'memory':
+            self.storage = MemoryStorage()
+        elif storage == 'log':
+            self.storage = LogStorage(self)
+        else:
+            raise ValueError('Unknown storage: %s' % storage)
 
         self.regex_db = re.compile(r'%s_\d+.db' % self.uuid)
         self._tables = {}
+        self._schema = {}
+        self._watermarks = None
+        self._db_locks = {}
+        # Serializes submissions and the merging of the partial database into the master
+        self._submit_lock = threading.RLock()
         self._hq = {}
+        self._uploader = None
+        self._submit_worker = Worker('usage_tracker_submit')
+        self._pending_submission = None
+        self._pending_lock = threading.Lock()
         self._enabled = enabled
         self._watcher = None
         self._watcher_enabled = False
+        self._watcher_waiter = Waiter()
+        # Set while the watcher sleeps until the next row is added
+        self._watcher_idle = False
+        # Number of rows written since the last submission and the time of the last submission, so that checking
+        # whether a submission is due does not have to query the databases
+        self._rows_since_submission = 0
+        self._rows_lock = threading.Lock()
+        self._last_submission = None
         self._open_sockets = {}
         self._discovery_socket_port = None
 
-        # Create the data base connections to the master database and partial database (if submit_interval)
-        self.dbcon_master = sqlite3.connect(self.filepath, check_same_thread=False)
-        self.dbcon_master.row_factory = sqlite3.Row
+        # Create the data base connection pools to the master database and partial database (if submit_interval).
+        # Each thread gets its own connection to each database.
+        self._master_pool = ConnectionPool(self.filepath, self.open_connection)
+        self.migrate_schema(self.dbcon_master)
 
         # If a submit interval is given, create a partial database that contains only the table entries since
         # the last submission. Merge this partial database into the master after a submission.
-        # If no submit interval is given, just use a single (master) database.
-        if submit_interval_s:
+        # If no submit interval is given, the storage mode is 'single' or the rows are not kept in the tracker's
+        # databases, just use a single (master) database.
+        if submit_interval_s and storage_mode == 'split' and isinstance(self.storage, SQLiteStorage):
             self.filepath_part = self.filename + '.part.db'
-            self.dbcon_part = sqlite3.connect(self.filepath_part, check_same_thread=False)
-            self.dbcon_part.row_factory = sqlite3.Row
-            self.dbcon = self.dbcon_part
+            self._part_pool = ConnectionPool(self.filepath_part, self.open_connection)
+            self.migrate_schema(self.dbcon_part)
         else:
-            self.dbcon_part = None
+            self._part_pool = None
             self.filepath_part = None
-            self.dbcon = self.dbcon_master
+            # A partial database is only merged on a deliberate switch to 'single' mode. In 'split' mode without a
+            # submit interval it is left in place, to be used again once the tracker is opened with an interval.
+            if storage_mode == 'single' and os.path.exists(self.filename + '.part.db'):
+                self._migrate_part_database(self.filename + '.part.db')
+
+        # Optionally hold new rows in memory and write them out in batches rather than committing every row
+        if buffer_size:
+            self.buffer = EventBuffer(lambda: self.dbcon, buffer_size, flush_interval_s, lock=self.db_lock(self.dbcon))
+            atexit.register(self.flush)
+        else:
+            self.buffer = None
 
+        self.rollups = Rollups(self) if rollups else None
+
+        self._rows_since_submission = self._count_unsubmitted_rows()
         self.track_statistic('__submissions__', description='The number of statistic submissions to the server.')
-        if self._hq and self._requires_submission():
-            self.submit_statistics()
+        if self._hq:
+            if defer_submission:
+                self.submit_statistics_async(only_if_required=True)
+            elif self._requires_submission():
+                self._submit_locked()
 
         if check_interval_s and submit_interval_s:
             self.start_watcher()
@@ -101,6 +201,31 @@ class AnonymousUsageTracker(object):
             elif isinstance(table, (State, Sequence)):
                 table.insert(value)
 
+    @property
+    def dbcon_master(self):
+        """
+        The calling thread's connection to the master database
+        """
+        return self._master_pool.get()
+
+    @property
+    def dbcon_part(self):
+        """
+        The calling thread's connection to the partial database, or None if there is no partial database
+        """
+        if self._part_pool is None:
+            return None
+        return self._part_pool.get()
+
+    @property
+    def dbcon(self):
+        """
+        The calling thread's connection to the database new rows are written to
+        """
+        if self._part_pool is None:
+            return self._master_pool.get()
+        return self._part_pool.get()
+
     @property
     def states(self):
         return [t for t in self._tables.itervalues() if type(t) is State]
@@ -117,18 +242,186 @@ class AnonymousUsageTracker(object):
     def sequences(self):
         return [t for t in self._tables.itervalues() if type(t) is Sequence]
 
-    def close(self):
-        self.dbcon_part.commit()
-        self.dbcon_part.close()
-        self.dbcon_master.commit()
-        self.dbcon_master.close()
+    def open_connection(self, path):
+        """
+        Open a connection to the database at `path`. Subclasses can override this to customize connection setup.
+        :param path: path to the database file
+        :return: database connection
+        """
+        # Connections are created by the pool for the calling thread, but may be closed from another thread
+        dbconn = sqlite3.connect(path, check_same_thread=False, factory=PooledConnection)
+        dbconn.row_factory = sqlite3.Row
+        set_pragmas(dbconn, self.sqlite_pragmas)
+        return dbconn
+
+    def db_lock(self, dbconn):
+        """
+        Return the lock that serializes writes to a database. All connections to the same database share a lock.
+        :param dbconn: database connection
+        """
+        key = self._database_key(dbconn)
+        lock = self._db_locks.get(key)
+        if lock is None:
+            lock = self._db_locks.setdefault(key, threading.RLock())
+        return lock
+
+    @staticmethod
+    def _database_key(dbconn):
+        """
+        Return a key identifying the database a connection is opened to
+        """
+        return getattr(dbconn, 'path', dbconn)
+
+    def flush(self):
+        """
+        Write any buffered rows to the database.
+        :return: number of rows written
+        """
+        if self.buffer is not None:
+            return self.buffer.flush()
+        return 0
+
+    def table_exists(self, dbconn, tablename):
+        """
+        Return True if the table exists in the database. The table list of each database is cached until
+        `invalidate_schema` is called.
+        :param dbconn: database connection
+        :param tablename: table name
+        """
+        return tablename in self._get_schema(dbconn)
+
+    def table_columns(self, dbconn, tablename):
+        """
+        Return a list of (name, type) tuples of the table's columns, or an empty list if the table does not exist.
+        :param dbconn: database connection
+        :param tablename: table name
+        """
+        schema = self._get_schema(dbconn)
+        if tablename not in schema:
+            return []
+        if schema[tablename] is None:
+            schema[tablename] = get_table_columns(dbconn, tablename)
+        return schema[tablename]
+
+    def create_table(self, dbconn, tablename, columns):
+        """
+        Create a table in the database and invalidate the cached schema.
+        :return: True if a new table was created
+        """
+        with self.db_lock(dbconn):
+            created = create_table(dbconn, tablename, columns)
+            if created and 'Time' in [c[0] for c in columns]:
+                create_time_index(dbconn, tablename)
+        self.invalidate_schema(dbconn)
+        return created
+
+    def migrate_schema(self, dbconn):
+        """
+        Upgrade the tables of a database written by an older version to SCHEMA_VERSION.
+        :return: True if the database was migrated
+        """
+        with self.db_lock(dbconn):
+            migrated = migrate_schema(dbconn)
+        if migrated:
+            self.invalidate_schema(dbconn)
+        return migrated
+
+    def load_sketch(self, tablename):
+        """
+        Load the duration sketch of a Timer, or create an empty one if it has none.
+        :param tablename: name of the Timer
+        :return: QuantileSketch
+        """
+        dbconn = self.dbcon_master
+        sketch = None
+        if self.table_exists(dbconn, SKETCH_TABLE):
+            sketch = load_sketch(dbconn, tablename)
+        return sketch if sketch is not None else QuantileSketch(self.SKETCH_RELATIVE_ACCURACY)
+
+    def save_sketches(self, sketches):
+        """
+        Store the duration sketches of Timers in the master database.
+        :param sketches: dictionary of Timer names to QuantileSketch
+        """
+        dbconn = self.dbcon_master
+        if not self.table_exists(dbconn, SKETCH_TABLE):
+            self.create_table(dbconn, SKETCH_TABLE, SKETCH_COLUMNS)
+        with self.db_lock(dbconn):
+            save_sketches(dbconn, sketches)
+
+    def invalidate_schema(self, dbconn=None):
+        """
+        Clear the cached schema of a database (or all databases if `dbconn` is None). This must be called whenever
+        tables are created, renamed or merged into a database outside of the tracker.
+        """
+        if dbconn is None:
+            self._schema.clear()
+        else:
+            self._schema.pop(self._database_key(dbconn), None)
+
+    def _get_schema(self, dbconn):
+        key = self._database_key(dbconn)
+        schema = self._schema.get(key)
+        if schema is None:
+            # Map each table name to its columns, which are looked up the first time they are requested
+            schema = self._schema[key] = dict.fromkeys(get_table_list(dbconn))
+        return schema
+
+    def evict(self):
+        """
+        Delete the oldest rows of every table that holds more than its max_rows.
+        :return: number of rows deleted
+        """
+        return sum(table.evict() for table in self._tables.itervalues())
 
-    def setup_hq(self, host, api_key):
-        self._hq = dict(host=host, api_key=api_key)
+    def close(self):
+        watcher = self._watcher
+        self.stop_watcher()
+        if watcher is not None:
+            watcher.join(self.HQ_DEFAULT_TIMEOUT)
+        if watcher is None or not watcher.is_alive():
+            self._watcher_waiter.close()
+        self._submit_worker.stop(self.HQ_DEFAULT_TIMEOUT)
+        self.evict()
+        self.flush()
+        self.storage.close()
+        if self.rollups is not None:
+            self.rollups.flush()
+        for timer in self.timers:
+            timer.save_sketch()
+        if self._part_pool is not None:
+            self._part_pool.close()
+        self._master_pool.close()
+        if self._uploader is not None:
+            self._uploader.close()
+
+    def setup_hq(self, host, api_key, content_encoding=None, batch_rows=None):
+        """
+        Set the server that statistics are submitted to.
+        :param host: address of the HQ
+        :param api_key: API key of the application
+        :param content_encoding: compression of the uploads, 'gzip', 'deflate' or 'none' (default HQ_CONTENT_ENCODING)
+        :param batch_rows: maximum number of rows sent in one upload, 0 for no limit (default HQ_BATCH_ROWS)
+        """
+        if content_encoding is None:
+            content_encoding = self.HQ_CONTENT_ENCODING
+        if batch_rows is None:
+            batch_rows = self.HQ_BATCH_ROWS
+        self._hq = dict(host=host, api_key=api_key, batch_rows=int(batch_rows),
+                        content_encoding=None if content_encoding == 'none' else content_encoding)
+        if self._uploader is not None:
+            self._uploader.close()
+        self._uploader = Uploader(host, timeout=self.HQ_DEFAULT_TIMEOUT, retries=self.HQ_RETRIES,
+                                  backoff_s=self.HQ_BACKOFF_S, failure_threshold=self.HQ_FAILURE_THRESHOLD,
+                                  cooldown_s=self.HQ_COOLDOWN_S)
+        if self.defer_submission:
+            # Catch up on a submission that came due while the application was not running
+            self.submit_statistics_async(only_if_required=True)
+        self._wake_watcher()
 
     def register_table(self, tablename, uuid, type, description):
-        exists_in_master = check_table_exists(self.dbcon_master, '__tableinfo__')
-        exists_in_partial = self.dbcon_part and check_table_exists(self.dbcon_part, '__tableinfo__')
+        exists_in_master = self.table_exists(self.dbcon_master, '__tableinfo__')
+        exists_in_partial = self.dbcon_part and self.table_exists(self.dbcon_part, '__tableinfo__')
         if not exists_in_master and not exists_in_partial:
             # The table doesn't exist in master, create it in partial so it can be merged in on submit
             # (if partial exists) otherwise, create it in the master
@@ -137,25 +430,29 @@ class AnonymousUsageTracker(object):
             else:
                 db = self.dbcon_master
                 exists_in_master = True
-            create_table(db, '__tableinfo__', [("TableName", "TEXT"), ("Type", "TEXT"), ("Description", "TEXT")])
+            self.create_table(db, '__tableinfo__', [("TableName", "TEXT"), ("Type", "TEXT"), ("Description", "TEXT")])
 
         # Check if info is already in the table
         dbconn = self.dbcon_master if exists_in_master else self.dbcon_part
-        tableinfo = dbconn.execute("SELECT * FROM __tableinfo__ WHERE TableName='{}'".format(tablename)).fetchall()
+        tableinfo = dbconn.execute("SELECT * FROM __tableinfo__ WHERE TableName=?", (tablename,)).fetchall()
         # If the info for this table is not in the database, add it
         if len(tableinfo) == 0:
-            dbconn.execute("INSERT INTO {name} VALUES{args}".format(name='__tableinfo__',
-                                                                    args=(str(tablename), type, description)))
+            with self.db_lock(dbconn):
+                insert_row(dbconn, '__tableinfo__', str(tablename), type, description)
+            if dbconn is self.dbcon_part:
+                # New tables are reported in the next submission
+                self._row_added('__tableinfo__')
         elif len(tableinfo) == 1 and tableinfo[0][2] != unicode(description):
             # Update the description if it has changed
-            dbconn.execute("UPDATE {name} SET Description ='{description}' WHERE TableName = '{tablename}'" \
-                           .format(name='__tableinfo__', tablename=tablename, description=description))
+            with self.db_lock(dbconn):
+                dbconn.execute("UPDATE __tableinfo__ SET Description=? WHERE TableName=?", (description, tablename))
+                dbconn.commit()
 
     def get_table_info(self, field=None):
         rows = []
-        if check_table_exists(self.dbcon_master, '__tableinfo__'):
+        if self.table_exists(self.dbcon_master, '__tableinfo__'):
             rows = get_rows(self.dbcon_master, '__tableinfo__')
-        elif check_table_exists(self.dbcon_part, '__tableinfo__'):
+        elif self.dbcon_part and self.table_exists(self.dbcon_part, '__tableinfo__'):
             rows = get_rows(self.dbcon_part, '__tableinfo__')
 
         if field:
@@ -210,91 +507,158 @@ class AnonymousUsageTracker(object):
         self._tables[name] = Sequence(name, self, checkpoints, max_rows=max_rows)
 
     def get_row_count(self):
-        info = {}
-        for db in (self.dbcon_master, self.dbcon_part):
-            cursor = db.cursor()
-            for table, stat in self._tables.items():
-                row_count_query = "SELECT Count() FROM %s" % table
-                try:
-                    cursor.execute(row_count_query)
-                except sqlite3.OperationalError:
-                    continue
-                nrows = cursor.fetchone()[0]
-                if table in info:
-                    info[table]['nrows'] += nrows
-                else:
-                    info[table] = {'nrows': nrows}
-        return info
+        return {name: {'nrows': table.number_of_rows} for name, table in self._tables.iteritems()}
 
     def submit_statistics(self):
         """
         Upload the database to the FTP server. Only submit new information contained in the partial database.
         Merge the partial database back into master after a successful upload.
         """
+        return self._submit_locked()
+
+    def _submit_locked(self):
+        # Internal submissions call this rather than submit_statistics, which subclasses (ie. the UsageTrackerServer
+        # endpoint) may override
+        with self._submit_lock:
+            return self._submit_statistics()
+
+    def submit_statistics_async(self, only_if_required=False):
+        """
+        Submit the statistics on a background thread. If a submission is already waiting to start, its future is
+        returned instead of queueing another one.
+        :param only_if_required: only submit if the submit interval has passed since the last submission
+        :return: Future whose result is the return value of the submission
+        """
+        with self._pending_lock:
+            pending = self._pending_submission
+            if pending is not None and not pending.running() and not pending.done():
+                return pending
+            func = self._submit_if_required if only_if_required else self._submit_locked
+            self._pending_submission = self._submit_worker.submit(func)
+            return self._pending_submission
+
+    def _submit_if_required(self):
+        if self._requires_submission():
+            return self._submit_locked()
+        return False
+
+    def _submit_statistics(self):
         if not self._hq.get('api_key', False) or not self._enabled:
             return
         for r in ('uuid', 'application_name', 'application_version'):
             if not getattr(self, r, False):
                 return False
+        if self._uploader.is_open:
+            # The HQ has been failing, wait for the uploader to allow uploads again
+            return False
         self['__submissions__'] += 1
+        self._last_submission = time.time()
+        self.flush()
+        pending_rows = self._rows_since_submission
 
+        success = False
         try:
             # To ensure the usage tracker does not interfere with script functionality, catch all exceptions so any
             # errors always exit nicely.
             tableinfo = self.get_table_info()
-            # Get the last row from each table
-            json_data = database_to_json(self.dbcon_master, tableinfo)
-            json_data.update(database_to_json(self.dbcon_part, tableinfo))
-
-            payload = {'API Key': self._hq['api_key'],
-                       'User Identifier': self.uuid,
-                       'Application Name': self.application_name,
-                       'Application Version': self.application_version,
-                       'Data': json_data
-                       }
-
-            # For tables with data that has not yet been writen to the database (ie inital values),
-            # add them manually to the payload
-            for name, info in tableinfo.iteritems():
-                if name not in payload['Data']:
-                    table = self[name]
-                    if table is None:
-                        continue
-                    if isinstance(table, State):
-                        data = 'No State' if table._state == NO_STATE else table._state
-                    else:
-                        data = table.count
-                    tableinfo[name]['data'] = data
-                    payload['Data'][name] = tableinfo[name]
-
-            try:
-                response = requests.post(self._hq['host'] + '/usagestats/upload',
-                                         data=json.dumps(payload),
-                                         timeout=self.HQ_DEFAULT_TIMEOUT)
-            except Exception as e:
-                logging.error(e)
-                response = False
-
-            if response and response.status_code == 200:
-                success = True
+            # Only the rows added since the last successful submission are uploaded
+            delta, rowids = self._collect_delta()
+            data = self._payload_data(tableinfo)
+
+            # Large deltas are sent in several batches. Each acknowledged batch is marked as submitted right away so
+            # that a failed upload only has to resend the batches that were not acknowledged.
+            batches = split_batches(delta, rowids, self._hq['batch_rows'])
+            for n, (batch, collected) in enumerate(batches):
+                # The first batch reports the value of every table, the others only the tables they have rows for
+                batch_data = {}
+                for name, info in data.iteritems():
+                    if n == 0 or name in batch:
+                        batch_data[name] = dict(info, **batch.get(name, {}))
+
+                payload = {'API Key': self._hq['api_key'],
+                           'User Identifier': self.uuid,
+                           'Application Name': self.application_name,
+                           'Application Version': self.application_version,
+                           'Batch': n + 1,
+                           'Batches': len(batches),
+                           'Data': batch_data
+                           }
+                success = self._upload(payload)
+                if not success:
+                    break
+                self._advance_watermarks(collected)
+
+            if success:
                 logger.debug('Submission to %s successful.' % self._hq['host'])
-            else:
-                success = False
-
-            # If we have a partial database, merge it into the local master and create a new partial
-            if self.dbcon_part and success:
-                merge_databases(self.dbcon_master, self.dbcon_part)
-
-                # Clear the partial database now that the stats have been uploaded
-                for table in get_table_list(self.dbcon_part):
-                    clear_table(self.dbcon_part, table)
-
-            return success
+                # Rows written while the submission was in progress are left for the next one
+                with self._rows_lock:
+                    self._rows_since_submission = max(0, self._rows_since_submission - pending_rows)
         except Exception as e:
             logger.error(e)
+        if not success:
+            # Only successful submissions are recorded, so that a retry is scheduled from the last successful one
             self['__submissions__'].delete_last()
-            self.stop_watcher()
-            return False
+            self._last_submission = None
+        return success
+
+    def _get_watermarks(self):
+        """
+        Return the highest submitted ROWID of each table in the database new rows are written to
+        """
+        if self._watermarks is None:
+            self._watermarks = self.storage.load_watermarks()
+        return self._watermarks
+
+    def _collect_delta(self):
+        """
+        Gather the rows written to each table since the last successful submission.
+        :return: tuple of (dictionary of table names to their new columns and rows,
+                           dictionary of table names to the highest ROWID collected)
+        """
+        return self.storage.collect_delta(self._get_watermarks())
+
+    def _payload_data(self, tableinfo):
+        """
+        Build the 'Data' section of a submission with the current value of each table.
+        """
+        # Trackables report their current value from memory. Tables that are registered but not tracked by this
+        # session report the value of their last row.
+        untracked = {name: info for name, info in tableinfo.iteritems() if self[name] is None}
+        data = database_to_json(self.dbcon_master, untracked)
+        if self.dbcon_part:
+            data.update(database_to_json(self.dbcon_part, untracked))
+
+        for name, info in tableinfo.iteritems():
+            table = self[name]
+            if table is not None:
+                value = table.current_value
+                info['data'] = 'No State' if value is NO_STATE else value
+                if isinstance(table, Timer):
+                    # The HQ merges the duration sketches of all users
+                    info['sketch'] = table.get_sketch_state()
+                data[name] = info
+        return data
+
+    def _upload(self, payload):
+        """
+        Send a payload to the HQ.
+        :return: True if the HQ acknowledged the upload
+        """
+        body, headers = encode_payload(payload, self._hq['content_encoding'])
+        return self._uploader.post('/usagestats/upload', body, headers)
+
+    def _advance_watermarks(self, collected):
+        """
+        Mark the collected rows as submitted. If there is a partial database, the submitted rows are moved into
+        the master database.
+        :param collected: dictionary of table names to the highest ROWID that was submitted
+        """
+        try:
+            self.storage.merge(collected, self._get_watermarks())
+        except Exception:
+            # The watermarks may have been advanced in memory only
+            self._watermarks = None
+            raise
 
     def database_to_csv(self, path, orderby='type'):
         """
@@ -304,6 +668,7 @@ class AnonymousUsageTracker(object):
         :param dbconn_part: partial database connection
         :param tableinfo: table header information
         """
+        self.flush()
         tableinfo = self.get_table_info()
         stats_master = database_to_json(self.dbcon_master, tableinfo)
         stats_partial = database_to_json(self.dbcon_part, tableinfo)
@@ -391,6 +756,20 @@ class AnonymousUsageTracker(object):
                 kw['submit_interval_s'] = int(general.get('submit_interval_s', 0))
                 kw['check_interval_s'] = int(general.get('check_interval_s', 0))
                 kw['debug'] = bool(general.get('debug', False))
+                kw['buffer_size'] = int(general.get('buffer_size', 0))
+                kw['flush_interval_s'] = float(general.get('flush_interval_s', 0))
+                if 'eviction_slack' in general:
+                    kw['eviction_slack'] = int(general['eviction_slack'])
+                kw['defer_submission'] = general.get('defer_submission', 'false').lower() in ('1', 'true', 'yes')
+                kw['submit_threshold'] = int(general.get('submit_threshold', 0))
+                kw['storage_mode'] = general.get('storage_mode', 'split')
+                kw['storage'] = general.get('storage', 'sqlite')
+                kw['rollups'] = general.get('rollups', 'false').lower() in ('1', 'true', 'yes')
+                pragmas = {}
+                for pragma in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size'):
+                    if pragma in general:
+                        pragmas[pragma] = general[pragma]
+                kw['sqlite_pragmas'] = pragmas
 
             if cfg.has_section('HQ'):
                 hq_params = dict(cfg.items('HQ'))
@@ -426,7 +805,7 @@ class AnonymousUsageTracker(object):
         """
         Start the watcher thread that tries to upload usage statistics.
         """
-        if self._watcher and self._watcher.is_alive:
+        if self._watcher and self._watcher.is_alive():
             self._watcher_enabled = True
         else:
             logger.debug('Starting watcher.')
@@ -442,37 +821,103 @@ class AnonymousUsageTracker(object):
         if self._watcher:
             self._watcher_enabled = False
             logger.debug('Stopping watcher.')
+            self._wake_watcher()
+
+    def _wake_watcher(self):
+        """
+        Have the watcher re-evaluate when it should next check for a submission.
+        """
+        self._watcher_waiter.notify()
+
+    def _row_added(self, tablename):
+        """
+        Called by the tables for every row written. Wakes the watcher if it is waiting for new rows or if
+        `submit_threshold` rows were added since it last checked.
+        """
+        if tablename == '__submissions__':
+            return
+        with self._rows_lock:
+            self._rows_since_submission += 1
+        if self._watcher_idle or self._threshold_reached():
+            self._wake_watcher()
+
+    def _threshold_reached(self):
+        return 0 < self.submit_threshold <= self._rows_since_submission
+
+    def _count_unsubmitted_rows(self):
+        """
+        Count the rows that have not been submitted yet. This includes new tables registered in the partial database.
+        """
+        if not self.submit_interval_s:
+            return 0
+        watermarks = self._get_watermarks()
+        tables = [t for t in self.storage.table_names() if t != '__submissions__']
+        nrows = sum(self.storage.count_since(t, watermarks.get(t, 0)) for t in tables)
+        if self.dbcon_part is not None and self.table_exists(self.dbcon_part, '__tableinfo__'):
+            nrows += get_number_of_rows(self.dbcon_part, '__tableinfo__')
+        return nrows
+
+    def _migrate_part_database(self, path):
+        """
+        Merge a partial database left by a tracker in 'split' mode into the master database and delete it. Rows in the
+        master database were submitted before, while the rows of the partial database were not.
+        :param path: path to the partial database
+        """
+        logger.debug('Merging the partial database {} into the master database.'.format(path))
+        master = self.dbcon_master
+        part = self.open_connection(path)
+        migrate_schema(part)
+        with self.db_lock(master):
+            tables = [t for t in get_table_list(part) if t != WATERMARK_TABLE]
+            for table in tables:
+                if not self.table_exists(master, table):
+                    self.create_table(master, table, get_table_columns(part, table))
+            if not self.table_exists(master, WATERMARK_TABLE):
+                self.create_table(master, WATERMARK_TABLE, WATERMARK_COLUMNS)
+
+            submitted = [t for t in self._get_schema(master) if t not in INTERNAL_TABLES]
+            watermarks = {t: rowid or 0 for t, rowid in get_max_rowids(master, submitted).iteritems()}
+            with attach_database(master, path, 'part'):
+                try:
+                    merge_attached_tables(master, 'part', dict.fromkeys(tables))
+                    save_watermarks(master, watermarks, commit=False)
+                    master.commit()
+                except sqlite3.Error:
+                    master.rollback()
+                    raise
+        part.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    def _last_submission_time(self):
+        """
+        Returns the time of the last submission as a unix timestamp. If no submissions have ever been made, the last
+        modified time of the database is returned instead.
+        """
+        if self._last_submission is None:
+            last_submission = self['__submissions__'].get_last(1)
+            if last_submission:
+                self._last_submission = last_submission[0]['Time']
+            else:
+                self._last_submission = os.path.getmtime(self.filepath)
+        return self._last_submission
 
     def _requires_submission(self):
         """
-        Returns True if the time since the last submission is greater than the submission interval.
-        If no submissions have ever been made, check if the database last modified time is greater than the
-        submission interval.
+        Returns True if there are new rows and the time since the last submission is greater than the submission
+        interval. If no submissions have ever been made, the database last modified time is used instead.
         """
-        if self.dbcon_part is None:
+        if not self.submit_interval_s:
             return False
 
-        tables = get_table_list(self.dbcon_part)
-        nrows = 0
-        for table in tables:
-            if table == '__submissions__':
-                continue
-            nrows += get_number_of_rows(self.dbcon_part, table)
+        nrows = self._rows_since_submission
         if nrows:
             logger.debug('%d new statistics were added since the last submission.' % nrows)
         else:
             logger.debug('No new statistics were added since the last submission.')
 
-        t0 = datetime.datetime.now()
-        s = self['__submissions__']
-        last_submission = s.get_last(1)
-        if last_submission:
-            logger.debug('Last submission was %s' % last_submission[0]['Time'])
-            t_ref = datetime.datetime.strptime(last_submission[0]['Time'], Table.time_fmt)
-        else:
-            t_ref = datetime.datetime.fromtimestamp(os.path.getmtime(self.filepath))
-
-        submission_interval_passed = (t0 - t_ref).total_seconds() > self.submit_interval_s
+        submission_interval_passed = time.time() - self._last_submission_time() > self.submit_interval_s
         submission_required = bool(submission_interval_passed and nrows)
         if submission_required:
             logger.debug('A submission is overdue.')
@@ -481,12 +926,37 @@ class AnonymousUsageTracker(object):
         return submission_required
 
     def _watcher_thread(self):
-        while 1:
-            time.sleep(self.check_interval_s or 300)
-            if not self._watcher_enabled:
-                break
-            if self._hq and self._requires_submission():
-                logger.debug('Attempting to upload usage statistics.')
-                self.submit_statistics()
+        """
+        Sleeps until the next submission is due, then submits. Rather than polling, the watcher blocks until it is
+        stopped, the HQ is set up, `submit_threshold` rows have been added, the next submission is due or, if there is
+        nothing to submit, the next row is added.
+        """
+        retry_at = 0
+        while self._watcher_enabled:
+            if not self._hq:
+                # Nothing can be submitted until setup_hq() wakes the watcher
+                self._watcher_waiter.wait()
+                continue
+            if not self._rows_since_submission:
+                # Sleep until there is something to submit
+                self._watcher_idle = True
+                if not self._rows_since_submission:
+                    self._watcher_waiter.wait()
+                self._watcher_idle = False
+                continue
+
+            if self._threshold_reached():
+                due = retry_at
+            else:
+                due = max(self._last_submission_time() + self.submit_interval_s, retry_at)
+            timeout = due - time.time()
+            if timeout > 0:
+                self._watcher_waiter.wait(timeout)
+                continue
+
+            self.evict()
+            logger.debug('Attempting to upload usage statistics.')
+            if not self._submit_locked():
+                retry_at = time.time() + (self.check_interval_s or 300)
         logger.debug('Watcher stopped.')
         self._watcher = None
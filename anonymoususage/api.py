@@ -203,8 +203,9 @@ class UsageTrackerServer(AnonymousUsageTracker):
         return 'Nothing to see here'
 
     @cherrypy.expose
-    def setup_hq(self, host, api_key):
-        super(UsageTrackerServer, self).setup_hq(host, api_key)
+    def setup_hq(self, host, api_key, content_encoding=None, batch_rows=None):
+        super(UsageTrackerServer, self).setup_hq(host, api_key, content_encoding=content_encoding,
+                                                 batch_rows=batch_rows)
         return 'HQ API key received.'
 
     @cherrypy.expose
@@ -218,7 +219,12 @@ class UsageTrackerServer(AnonymousUsageTracker):
         return 'Usage tracker has been disabled'
 
     @cherrypy.expose
-    def submit_statistics(self):
+    def submit_statistics(self, wait=False):
+        # The value arrives as a string from the query string, ie. ?wait=0
+        if str(wait).lower() not in ('1', 'true', 'yes'):
+            # Respond right away rather than holding the request open for the upload
+            self.submit_statistics_async()
+            return 'Submitting usage statistics: Queued'
         status = super(UsageTrackerServer, self).submit_statistics()
         return 'Submitting usage statistics: %s' % ('Success' if status else 'Failed')
 
@@ -0,0 +1,77 @@
+__author__ = 'calvin'
+
+import logging
+import sqlite3
+import threading
+
+from itertools import groupby
+from operator import itemgetter
+
+from .tools import insert_rows
+
+logger = logging.getLogger('AnonymousUsage')
+
+
+class EventBuffer(object):
+    """
+    Write-behind queue of table rows. Rows are held in memory and written to the database in a single transaction
+    once `size` rows are pending or the oldest pending row is `max_age_s` seconds old.
+    """
+
+    def __init__(self, get_dbconn, size, max_age_s=0, lock=None):
+        """
+        :param get_dbconn: function returning the connection to write the rows with. It is called on the thread
+                           doing the flush.
+        :param size: number of pending rows that triggers a flush
+        :param max_age_s: maximum number of seconds a row can stay in the buffer (0 to only flush on size)
+        :param lock: lock held while writing to the database connection
+        """
+        self.get_dbconn = get_dbconn
+        self.size = size
+        self.max_age_s = max_age_s
+        self._lock = lock or threading.RLock()
+        self._rows = []
+        self._timer = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def append(self, tablename, row):
+        """
+        Queue a row for insertion into table `tablename`
+        :param tablename: name of the table
+        :param row: tuple of column values
+        """
+        with self._lock:
+            self._rows.append((tablename, row))
+            if len(self._rows) >= self.size:
+                self.flush()
+            elif self.max_age_s and self._timer is None:
+                self._timer = threading.Timer(self.max_age_s, self.flush)
+                self._timer.setDaemon(True)
+                self._timer.start()
+
+    def flush(self):
+        """
+        Write all pending rows to the database in one transaction.
+        :return: number of rows written
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._rows:
+                return 0
+            rows, self._rows = self._rows, []
+            dbconn = self.get_dbconn()
+            try:
+                # Consecutive rows for the same table are inserted with a single executemany
+                for tablename, group in groupby(rows, key=itemgetter(0)):
+                    insert_rows(dbconn, tablename, [r for _, r in group], commit=False)
+                dbconn.commit()
+            except sqlite3.Error as e:
+                dbconn.rollback()
+                logger.error('Failed to write {n} buffered rows: {e}'.format(n=len(rows), e=e))
+                return 0
+            logger.debug('Flushed {n} buffered rows.'.format(n=len(rows)))
+            return len(rows)
@@ -46,4 +46,12 @@ class InvalidCheckpointError(AnonymousUsageError):
         self.checkpoint = checkpoint
 
     def __str__(self):
-        return 'Checkpoint "{}" assignment is not in the valid list of checkpoints'.format(self.checkpoint)
\ No newline at end of file
+        return 'Checkpoint "{}" assignment is not in the valid list of checkpoints'.format(self.checkpoint)
+
+class FutureTimeoutError(AnonymousUsageError):
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def __str__(self):
+        return 'The result was not available within {} seconds.'.format(self.timeout)
@@ -0,0 +1,71 @@
+__author__ = 'calvin'
+
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger('AnonymousUsage')
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    sqlite3 connection that remembers the path of its database file, so that connections opened by different threads
+    to the same database can share locks and cached schema information.
+    """
+
+    def __init__(self, path, *args, **kwargs):
+        super(PooledConnection, self).__init__(path, *args, **kwargs)
+        self.path = path
+
+
+class ConnectionPool(object):
+    """
+    Hands out one connection per thread to a database file. Connections owned by threads that have exited are
+    handed to the next thread that asks for one, rather than opening a new connection.
+    """
+
+    def __init__(self, path, connect):
+        """
+        :param path: path to the database file
+        :param connect: function that opens a connection to a database path
+        """
+        self.path = path
+        self._connect = connect
+        self._connections = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return the calling thread's connection to the database.
+        """
+        try:
+            return self._local.dbconn
+        except AttributeError:
+            pass
+
+        with self._lock:
+            for owner, dbconn in self._connections.items():
+                if not owner.is_alive():
+                    del self._connections[owner]
+                    break
+            else:
+                dbconn = self._connect(self.path)
+                logger.debug('Opened connection {n} to {path}'.format(n=len(self._connections) + 1, path=self.path))
+            self._connections[threading.current_thread()] = dbconn
+            self._local.dbconn = dbconn
+            return dbconn
+
+    def close(self):
+        """
+        Commit and close every connection in the pool.
+        """
+        with self._lock:
+            for dbconn in self._connections.itervalues():
+                try:
+                    dbconn.commit()
+                    dbconn.close()
+                except sqlite3.Error as e:
+                    logger.error(e)
+            self._connections.clear()
+            self._local = threading.local()
@@ -0,0 +1,159 @@
+__author__ = 'calvin'
+
+import logging
+import sqlite3
+import threading
+import time
+
+from .tools import *
+
+logger = logging.getLogger('AnonymousUsage')
+
+ROLLUP_TABLE = '__rollups__'
+ROLLUP_COLUMNS = (("TableName", "TEXT"), ("Resolution", "INTEGER"), ("Start", "REAL"), ("Sum", "REAL"),
+                  ("Count", "INTEGER"), ("Min", "REAL"), ("Max", "REAL"))
+RESOLUTIONS = {'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+class Rollups(object):
+    """
+    Keeps per-minute, per-hour and per-day aggregates (sum, count, min and max) of the values added to Statistic and
+    Timer tables, so that long-range trends can be read without the raw rows. Buckets start on multiples of their
+    resolution in UTC.
+
+    Aggregates are accumulated in memory and added to the __rollups__ table of the master database when a minute ends,
+    before they are queried and when the tracker is closed. A timer writes them out at the end of the minute even if
+    no further values are added. Aggregates older than their retention are deleted.
+    """
+    # Number of seconds the aggregates of each resolution are kept, None to keep them forever
+    RETENTION_S = {60: 2 * 86400, 3600: 120 * 86400, 86400: None}
+
+    def __init__(self, tracker, retention_s=None):
+        """
+        :param tracker: usage tracker whose master database holds the aggregates
+        :param retention_s: optional dictionary of resolutions (seconds) to retention (seconds) that overrides
+                            RETENTION_S
+        """
+        self.tracker = tracker
+        self.retention_s = dict(self.RETENTION_S)
+        self.retention_s.update(retention_s or {})
+        # Maps (table name, resolution, bucket start) to [sum, count, min, max]
+        self._pending = {}
+        self._minute = None
+        self._lock = threading.Lock()
+        self._timer = None
+
+    @staticmethod
+    def resolution(resolution):
+        """
+        Return the number of seconds of a resolution given by name ('minute', 'hour', 'day') or in seconds.
+        """
+        if resolution in RESOLUTIONS:
+            return RESOLUTIONS[resolution]
+        if resolution in RESOLUTIONS.values():
+            return resolution
+        raise ValueError('Unknown rollup resolution: %s' % resolution)
+
+    def _merge(self, key, total, count, minimum, maximum):
+        aggregate = self._pending.get(key)
+        if aggregate is None:
+            self._pending[key] = [total, count, minimum, maximum]
+        else:
+            aggregate[0] += total
+            aggregate[1] += count
+            aggregate[2] = min(aggregate[2], minimum)
+            aggregate[3] = max(aggregate[3], maximum)
+
+    def add(self, tablename, value, t=None):
+        """
+        Add a value to the aggregates of a table.
+        :param tablename: table name
+        :param value: value of the event, ie. the increment of a Statistic or the seconds recorded by a Timer
+        :param t: unix timestamp of the event, the current time if None
+        """
+        t = time.time() if t is None else t
+        minute = t // 60 * 60
+        if self._pending and self._minute is not None and minute > self._minute:
+            # Write out the aggregates of the previous minute once it has ended
+            self.flush()
+        with self._lock:
+            self._minute = max(minute, self._minute)
+            for resolution in self.retention_s:
+                self._merge((tablename, resolution, t // resolution * resolution), value, 1, value, value)
+            if self._timer is None:
+                # Write out the aggregates shortly after the current minute ends, in case the tracker goes idle
+                self._timer = threading.Timer(61 - time.time() % 60, self._flush_due)
+                self._timer.setDaemon(True)
+                self._timer.start()
+
+    def _flush_due(self):
+        try:
+            self.flush()
+        except sqlite3.Error as e:
+            logger.error('Failed to write the rollups: {}'.format(e))
+
+    def flush(self):
+        """
+        Add the aggregates accumulated in memory to the database and delete expired aggregates.
+        :return: number of aggregates written
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        tracker = self.tracker
+        dbconn = tracker.dbcon_master
+        if not tracker.table_exists(dbconn, ROLLUP_TABLE):
+            tracker.create_table(dbconn, ROLLUP_TABLE, ROLLUP_COLUMNS)
+            dbconn.execute("CREATE UNIQUE INDEX IF NOT EXISTS __rollups___key ON __rollups__(TableName, Resolution, "
+                           "Start)")
+        keys = [(name, resolution, start) for name, resolution, start in pending]
+        now = time.time()
+        with tracker.db_lock(dbconn):
+            try:
+                dbconn.executemany("INSERT OR IGNORE INTO __rollups__ VALUES (?, ?, ?, 0, 0, ?, ?)",
+                                   [key + (pending[key][2], pending[key][3]) for key in keys])
+                dbconn.executemany("UPDATE __rollups__ SET Sum = Sum + ?, Count = Count + ?, Min = min(Min, ?), "
+                                   "Max = max(Max, ?) WHERE TableName = ? AND Resolution = ? AND Start = ?",
+                                   [tuple(pending[key]) + key for key in keys])
+                for resolution, retention in self.retention_s.iteritems():
+                    if retention:
+                        dbconn.execute("DELETE FROM __rollups__ WHERE Resolution = ? AND Start < ?",
+                                       (resolution, now - retention))
+                dbconn.commit()
+            except sqlite3.Error:
+                dbconn.rollback()
+                # Keep the aggregates for the next flush
+                with self._lock:
+                    for key, aggregate in pending.iteritems():
+                        self._merge(key, *aggregate)
+                raise
+        return len(keys)
+
+    def query(self, tablename, resolution, since=None, until=None):
+        """
+        Return the aggregates of a table, oldest first.
+        :param tablename: table name
+        :param resolution: 'minute', 'hour', 'day' or the resolution in seconds
+        :param since: datetime or unix timestamp of the earliest bucket, or None for no limit
+        :param until: datetime or unix timestamp after the latest bucket (exclusive), or None for no limit
+        :return: list of rows with the columns Start, Sum, Count, Min and Max
+        """
+        resolution = self.resolution(resolution)
+        self.flush()
+        dbconn = self.tracker.dbcon_master
+        if not self.tracker.table_exists(dbconn, ROLLUP_TABLE):
+            return []
+        query = "SELECT Start, Sum, Count, Min, Max FROM __rollups__ WHERE TableName = ? AND Resolution = ?"
+        args = [tablename, resolution]
+        if since is not None:
+            query += " AND Start >= ?"
+            args.append(to_epoch(since))
+        if until is not None:
+            query += " AND Start < ?"
+            args.append(to_epoch(until))
+        return dbconn.execute(query + " ORDER BY Start", args).fetchall()
@@ -0,0 +1,150 @@
+__author__ = 'calvin'
+
+import json
+import logging
+import math
+
+from .tools import *
+
+logger = logging.getLogger('AnonymousUsage')
+
+__all__ = ['QuantileSketch', 'SKETCH_TABLE', 'SKETCH_COLUMNS', 'load_sketch', 'save_sketches']
+
+SKETCH_TABLE = '__sketches__'
+SKETCH_COLUMNS = ("TableName", "TEXT PRIMARY KEY"), ("Sketch", "TEXT")
+
+
+class QuantileSketch(object):
+    """
+    Fixed-memory sketch of a distribution of non-negative values that answers quantile queries within a relative
+    error. Values are counted in logarithmic buckets, bucket i holding the values in (gamma^(i-1), gamma^i] where
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy). Sketches with the same relative accuracy are merged by
+    adding their bucket counts, so sketches from many users can be combined into one.
+
+    If more than `max_buckets` buckets are used, the lowest buckets are collapsed into one, which only reduces the
+    accuracy of the lowest quantiles.
+    """
+    # Values at or below this are counted as zero
+    MIN_VALUE = 1e-9
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        """
+        :param relative_accuracy: maximum relative error of the quantiles
+        :param max_buckets: maximum number of buckets kept
+        """
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('relative_accuracy must be between 0 and 1')
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.
+        self.min = None
+        self.max = None
+
+    def add(self, value, count=1):
+        """
+        Add a value to the sketch.
+        :param value: value, negative values are counted as zero
+        :param count: number of times the value was seen
+        """
+        if value <= self.MIN_VALUE:
+            self.zero_count += count
+        else:
+            index = int(math.ceil(math.log(value) / self._log_gamma))
+            self.buckets[index] = self.buckets.get(index, 0) + count
+            if len(self.buckets) > self.max_buckets:
+                self._collapse()
+        self.count += count
+        self.sum += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def _collapse(self):
+        indices = sorted(self.buckets)
+        excess = indices[:len(indices) - self.max_buckets + 1]
+        lowest = indices[len(excess)]
+        self.buckets[lowest] += sum(self.buckets.pop(i) for i in excess)
+
+    def merge(self, other):
+        """
+        Add the values of another sketch with the same relative accuracy to this sketch.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge sketches with different relative accuracies')
+        for index, count in other.buckets.iteritems():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        while len(self.buckets) > self.max_buckets:
+            self._collapse()
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def quantile(self, q):
+        """
+        Return the value at quantile q (0 <= q <= 1), or None if the sketch is empty.
+        """
+        if not 0 <= q <= 1:
+            raise ValueError('Quantile must be between 0 and 1')
+        if not self.count:
+            return None
+        if q == 0:
+            return self.min
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # The middle of the bucket is within relative_accuracy of every value in it
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        """
+        Return the state of the sketch as a JSON serializable dictionary.
+        """
+        return {'relative_accuracy': self.relative_accuracy, 'zero_count': self.zero_count, 'count': self.count,
+                'sum': self.sum, 'min': self.min, 'max': self.max, 'buckets': sorted(self.buckets.iteritems())}
+
+    @classmethod
+    def from_dict(cls, state, max_buckets=2048):
+        """
+        Create a sketch from the state returned by `to_dict`.
+        """
+        sketch = cls(state['relative_accuracy'], max_buckets)
+        sketch.buckets = {index: count for index, count in state['buckets']}
+        sketch.zero_count = state['zero_count']
+        sketch.count = state['count']
+        sketch.sum = state['sum']
+        sketch.min = state['min']
+        sketch.max = state['max']
+        return sketch
+
+
+def load_sketch(dbconn, tablename):
+    """
+    Load the sketch of a table from the database. The sketch table must exist.
+    :return: QuantileSketch or None if the table has no sketch
+    """
+    row = dbconn.execute("SELECT Sketch FROM __sketches__ WHERE TableName = ?", (tablename,)).fetchone()
+    return QuantileSketch.from_dict(json.loads(row[0])) if row else None
+
+
+def save_sketches(dbconn, sketches):
+    """
+    Store sketches in the database. The sketch table must exist.
+    :param dbconn: database connection
+    :param sketches: dictionary of table names to QuantileSketch
+    """
+    dbconn.executemany("INSERT OR REPLACE INTO __sketches__ VALUES (?, ?)",
+                       [(name, json.dumps(sketch.to_dict())) for name, sketch in sketches.iteritems()])
+    dbconn.commit()
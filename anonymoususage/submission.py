@@ -0,0 +1,116 @@
+__author__ = 'calvin'
+
+import json
+import logging
+import zlib
+
+from .rollup import ROLLUP_TABLE
+from .sketch import SKETCH_TABLE
+from .tools import *
+
+logger = logging.getLogger('AnonymousUsage')
+
+WATERMARK_TABLE = '__watermarks__'
+WATERMARK_COLUMNS = ("TableName", "TEXT PRIMARY KEY"), ("RowID", "INTEGER")
+# Tables that hold the tracker's bookkeeping rather than usage statistics
+INTERNAL_TABLES = ('__tableinfo__', WATERMARK_TABLE, ROLLUP_TABLE, SKETCH_TABLE)
+
+
+def load_watermarks(dbconn):
+    """
+    Load the highest ROWID of each table that has been submitted.
+    :param dbconn: connection to the database the rows are submitted from
+    :return: dictionary of table names to ROWIDs
+    """
+    if not check_table_exists(dbconn, WATERMARK_TABLE):
+        return {}
+    return {name: rowid for name, rowid in dbconn.execute("SELECT TableName, RowID FROM __watermarks__")}
+
+
+def save_watermarks(dbconn, watermarks, commit=True, database='main'):
+    """
+    Store the highest submitted ROWID of each table. The watermark table must exist.
+    :param dbconn: connection to the database the rows are submitted from
+    :param watermarks: dictionary of table names to ROWIDs
+    :param commit: commit the transaction after saving
+    :param database: schema name of the database, if it is attached to `dbconn`
+    """
+    dbconn.executemany("INSERT OR REPLACE INTO {db}.__watermarks__ VALUES (?, ?)".format(db=quote_identifier(database)),
+                       watermarks.iteritems())
+    if commit:
+        dbconn.commit()
+
+
+def collect_delta(dbconn, tablenames, watermarks):
+    """
+    Gather the rows of each table that were added after its watermark.
+    :param dbconn: connection to the database the rows are submitted from
+    :param tablenames: tables to collect rows from
+    :param watermarks: dictionary of table names to the highest ROWID already submitted
+    :return: tuple of (dictionary of table names to {'columns': [...], 'rows': [...]},
+                       dictionary of table names to the ROWIDs of the collected rows)
+    """
+    delta = {}
+    rowids = {}
+    for table, max_rowid in get_max_rowids(dbconn, tablenames).iteritems():
+        if max_rowid is None:
+            continue
+        since = watermarks.get(table, 0)
+        if max_rowid < since:
+            # Every row of the table was deleted since the last submission, so its ROWIDs started over
+            since = 0
+        if max_rowid > since:
+            rows = list(iter_rows_since(dbconn, table, since, max_rowid, with_rowid=True))
+            columns = [c[0] for c in get_table_columns(dbconn, table)]
+            delta[table] = {'columns': columns, 'rows': [tuple(row)[1:] for row in rows]}
+            rowids[table] = [row[0] for row in rows]
+            logger.debug("Collected {n} new rows of table '{name}'".format(n=len(rows), name=table))
+    return delta, rowids
+
+
+def split_batches(delta, rowids, max_rows=None):
+    """
+    Split the rows collected by `collect_delta` into batches of at most `max_rows` rows. A table's rows may be spread
+    over several consecutive batches. At least one (possibly empty) batch is always returned.
+    :param delta: dictionary of table names to {'columns': [...], 'rows': [...]}
+    :param rowids: dictionary of table names to the ROWIDs of their rows
+    :param max_rows: maximum number of rows in a batch, or None for no limit
+    :return: list of tuples of (delta of the batch, dictionary of table names to the highest ROWID in the batch)
+    """
+    batches = []
+    batch, collected, size = {}, {}, 0
+    for table in sorted(delta):
+        columns, rows = delta[table]['columns'], delta[table]['rows']
+        start = 0
+        while start < len(rows):
+            if max_rows and size >= max_rows:
+                batches.append((batch, collected))
+                batch, collected, size = {}, {}, 0
+            end = min(len(rows), start + max_rows - size) if max_rows else len(rows)
+            batch[table] = {'columns': columns, 'rows': rows[start:end]}
+            collected[table] = rowids[table][end - 1]
+            size += end - start
+            start = end
+    batches.append((batch, collected))
+    return batches
+
+
+def encode_payload(payload, encoding=None):
+    """
+    Serialize a payload to JSON and compress it.
+    :param payload: JSON serializable payload
+    :param encoding: 'gzip', 'deflate' or None for no compression
+    :return: tuple of (request body, dictionary of request headers)
+    """
+    body = json.dumps(payload)
+    headers = {'Content-Type': 'application/json'}
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(body) + compressor.flush()
+    elif encoding == 'deflate':
+        body = zlib.compress(body)
+    elif encoding:
+        raise ValueError('Unsupported content encoding: %s' % encoding)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return body, headers
@@ -3,6 +3,8 @@ __author__ = 'Calvin'
 from sequence import Sequence
 from state import State, NO_STATE
 from statistic import Statistic
+from storage import Storage, SQLiteStorage, MemoryStorage
+from logstorage import LogStorage
 from table import Table
 from timer import Timer
 
@@ -0,0 +1,182 @@
+__author__ = 'calvin'
+
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+from collections import defaultdict
+from threading import RLock
+
+from anonymoususage.tools import *
+from .storage import SQLiteStorage
+from .table import Table
+
+logger = logging.getLogger('AnonymousUsage')
+
+__all__ = ['LogStorage']
+
+
+class LogStorage(SQLiteStorage):
+    """
+    Appends the rows of Statistic and Timer tables as fixed-width binary records (table id, count, epoch, uuid) to a
+    memory-mapped segment file rather than inserting them into SQLite. The segment is compacted into the tracker's
+    database when it fills up, before rows are read or submitted and when the tracker is closed. Rows of other tables
+    are written to SQLite directly.
+
+    Rows deleted to enforce a table's max_rows are only deleted at compaction time. A segment left behind by a process
+    that did not close its tracker is compacted the next time the tracker is opened.
+    """
+    MAGIC = 'AULG'
+    HEADER = struct.Struct('<4sII')
+    HEADER_SIZE = 4096
+    RECORD = struct.Struct('<Hdd64s')
+    # Tables whose rows can be written to the segment
+    COLUMNS = [c[0] for c in Table.table_args]
+
+    def __init__(self, tracker, path=None, capacity=4096):
+        """
+        :param tracker: usage tracker whose database the segment is compacted into
+        :param path: path of the segment file, <tracker filename>.log by default
+        :param capacity: number of records the segment holds before it is compacted. An existing segment keeps its
+                         size.
+        """
+        super(LogStorage, self).__init__(tracker)
+        self.path = path or tracker.filename + '.log'
+        self._lock = RLock()
+        self._evictions = defaultdict(int)
+
+        size = self.HEADER_SIZE + capacity * self.RECORD.size
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) > self.HEADER_SIZE
+        self._file = open(self.path, 'r+b' if exists else 'w+b')
+        if exists:
+            size = os.path.getsize(self.path)
+        else:
+            self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self.capacity = (size - self.HEADER_SIZE) // self.RECORD.size
+
+        magic, self._n_records, length = self.HEADER.unpack_from(self._mmap, 0)
+        if magic == self.MAGIC:
+            start = self.HEADER.size
+            self._tables = json.loads(self._mmap[start:start + length])
+        else:
+            self._n_records = 0
+            self._tables = []
+            self._write_header()
+        self._table_ids = {name: i for i, name in enumerate(self._tables)}
+
+    def _write_header(self):
+        names = json.dumps(self._tables)
+        self.HEADER.pack_into(self._mmap, 0, self.MAGIC, self._n_records, len(names))
+        self._mmap[self.HEADER.size:self.HEADER.size + len(names)] = names
+
+    def _is_logged(self, name):
+        return name in self._table_ids
+
+    def create(self, name, columns):
+        super(LogStorage, self).create(name, columns)
+        with self._lock:
+            if name in self._table_ids or [c[0] for c in columns] != self.COLUMNS:
+                return
+            names = json.dumps(self._tables + [name])
+            if self.HEADER.size + len(names) > self.HEADER_SIZE or len(self.tracker.uuid) > 64:
+                logger.debug("Rows of table '{}' are written to the database directly.".format(name))
+                return
+            self._table_ids[name] = len(self._tables)
+            self._tables.append(name)
+            self._write_header()
+
+    def append(self, name, row):
+        table_id = self._table_ids.get(name)
+        if table_id is None:
+            return super(LogStorage, self).append(name, row)
+        with self._lock:
+            if self._n_records == self.capacity:
+                self.compact()
+            offset = self.HEADER_SIZE + self._n_records * self.RECORD.size
+            self.RECORD.pack_into(self._mmap, offset, table_id, row[1], row[2], row[0])
+            self._n_records += 1
+            struct.pack_into('<I', self._mmap, 4, self._n_records)
+
+    def delete_first(self, name, n=1):
+        if not self._is_logged(name):
+            return super(LogStorage, self).delete_first(name, n)
+        # The oldest rows are deleted when the segment is next compacted
+        with self._lock:
+            self._evictions[name] += n
+        return n
+
+    def delete_last(self, name):
+        self.compact()
+        return super(LogStorage, self).delete_last(name)
+
+    def max_rowid(self, name):
+        self.compact()
+        return super(LogStorage, self).max_rowid(name)
+
+    def iter_since(self, name, rowid, until=None):
+        self.compact()
+        return super(LogStorage, self).iter_since(name, rowid, until)
+
+    def collect_delta(self, watermarks):
+        self.compact()
+        return super(LogStorage, self).collect_delta(watermarks)
+
+    def flush(self):
+        return self.compact() + super(LogStorage, self).flush()
+
+    def compact(self):
+        """
+        Insert the records of the segment into the database, delete the rows evicted since the last compaction and
+        empty the segment.
+        :return: number of records compacted
+        """
+        with self._lock:
+            n_records = self._n_records
+            if not n_records and not self._evictions:
+                return 0
+            rows = defaultdict(list)
+            for i in xrange(n_records):
+                offset = self.HEADER_SIZE + i * self.RECORD.size
+                table_id, count, epoch, uuid = self.RECORD.unpack_from(self._mmap, offset)
+                rows[self._tables[table_id]].append((uuid.rstrip('\0'), count, epoch))
+
+            tracker = self.tracker
+            dbconn = tracker.dbcon
+            master, part = tracker.dbcon_master, tracker.dbcon_part
+            # The evictions may delete from both databases. Lock the master database before the partial database, in
+            # the same order as SQLiteStorage.merge, so that a compaction and a submission can not deadlock.
+            with tracker.db_lock(master), tracker.db_lock(part if part is not None else master):
+                try:
+                    for name, table_rows in rows.iteritems():
+                        if not tracker.table_exists(dbconn, name):
+                            tracker.create_table(dbconn, name, Table.table_args)
+                        insert_rows(dbconn, name, table_rows, commit=False)
+                    for name, n in self._evictions.iteritems():
+                        # The oldest rows are in the master database, if the tracker has a partial database
+                        for db in self._databases(name):
+                            if n > 0:
+                                n -= delete_first_rows(db, name, n, commit=db is not dbconn)
+                    dbconn.commit()
+                except sqlite3.Error:
+                    dbconn.rollback()
+                    raise
+
+            self._evictions.clear()
+            self._n_records = 0
+            struct.pack_into('<I', self._mmap, 4, 0)
+            if n_records:
+                logger.debug('Compacted {n} records of {path}'.format(n=n_records, path=self.path))
+            return n_records
+
+    def close(self):
+        with self._lock:
+            if self._mmap is None:
+                return
+            self.compact()
+            self._mmap.flush()
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
@@ -1,6 +1,6 @@
 __author__ = 'calvin'
 
-import datetime
+import time
 import sqlite3
 import logging
 
@@ -8,7 +8,6 @@ from itertools import imap
 from operator import eq
 from collections import deque
 from .table import Table
-from ..tools import insert_row
 from anonymoususage.exceptions import InvalidCheckpointError
 
 logger = logging.getLogger('AnonymousUsage')
@@ -41,13 +40,9 @@ class Sequence(Table):
             logging.debug('{cp} added to sequence "{s.name}"'.format(cp=checkpoint, s=self))
             if len(self._sequence) == len(self._checkpoints) and all(imap(eq, self._sequence, self._checkpoints)):
                 # Sequence is complete. Increment the database
-                dt = datetime.datetime.now().strftime(self.time_fmt)
                 count = self.count + 1
                 try:
-                    with Table.lock:
-                        if self.get_number_of_rows() >= self.max_rows:
-                            self.delete_first()
-                        insert_row(self.tracker.dbcon, self.name, self.tracker.uuid, count, dt)
+                    self._insert_row(self.tracker.uuid, count, time.time())
                 except sqlite3.Error as e:
                     logger.error(e)
                 else:
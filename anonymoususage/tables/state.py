@@ -1,11 +1,10 @@
 __author__ = 'calvin'
 
-import datetime
+import time
 import sqlite3
 import logging
 
 from .table import Table
-from ..tools import insert_row
 
 
 logger = logging.getLogger('AnonymousUsage')
@@ -22,7 +21,7 @@ class State(Table):
         tracker[state_name] = 'ON'
         tracker[state_name] = 'OFF'
     """
-    table_args = ("UUID", "INTEGER"), ("Count", "REAL"), ("State", "TEXT"), ("Time", "TEXT")
+    table_args = ("UUID", "INTEGER"), ("Count", "REAL"), ("State", "TEXT"), ("Time", "REAL")
 
     def __init__(self, name, tracker, initial_state=NO_STATE, keep_redundant=False, *args, **kwargs):
         super(State, self).__init__(name, tracker, *args, **kwargs)
@@ -58,14 +57,8 @@ class State(Table):
             # Don't add redundant information, ie if the state value is the same as the previous do not insert a new row
             return
 
-        dt = datetime.datetime.now().strftime(self.time_fmt)
-
         try:
-            with Table.lock:
-                if self.get_number_of_rows() >= self.max_rows:
-                    self.delete_first()
-                insert_row(self.tracker.dbcon, self.name, self.tracker.uuid, self.count + 1, str(value), dt)
-
+            self._insert_row(self.tracker.uuid, self.count + 1, str(value), time.time())
         except sqlite3.Error as e:
             logger.error(e)
         else:
@@ -1,11 +1,10 @@
 __author__ = 'calvin'
 
-import datetime
 import logging
 import sqlite3
+import time
 
 from .table import Table
-from ..tools import insert_row
 
 logger = logging.getLogger('AnonymousUsage')
 
@@ -32,17 +31,16 @@ class Statistic(Table):
         return self.count - self.startup_value
 
     def __add__(self, i):
-        dt = datetime.datetime.now().strftime(self.time_fmt)
+        t = time.time()
         count = self.count + i
         try:
-            with Table.lock:
-                if self.get_number_of_rows() >= self.max_rows:
-                    self.delete_first()
-                insert_row(self.tracker.dbcon, self.name, self.tracker.uuid, count, dt)
+            self._insert_row(self.tracker.uuid, count, t)
         except sqlite3.Error as e:
             logger.error(e)
         else:
             self.count = count
+            if self.tracker.rollups is not None:
+                self.tracker.rollups.add(self.name, i, t)
             logging.debug('{s.name} count set to {s.count}'.format(s=self))
 
         return self
@@ -67,6 +65,19 @@ class Statistic(Table):
     def __repr__(self):
         return "Statistic ({s.name}): {s.count}".format(s=self)
 
+    def get_rollups(self, resolution='hour', since=None, until=None):
+        """
+        Return the per-minute, per-hour or per-day aggregates of the values added to the statistic. The tracker must
+        have been created with rollups=True.
+        :param resolution: 'minute', 'hour' or 'day'
+        :param since: datetime or unix timestamp of the earliest bucket, or None for no limit
+        :param until: datetime or unix timestamp after the latest bucket (exclusive), or None for no limit
+        :return: list of rows with the columns Start, Sum, Count, Min and Max
+        """
+        if self.tracker.rollups is None:
+            raise ValueError('Rollups are not enabled on the tracker')
+        return self.tracker.rollups.query(self.name, resolution, since, until)
+
     def get_average(self, default=None):
         """
         Return the statistic's count divided by the number of rows in the table. If it cannot be calculated return
@@ -0,0 +1,466 @@
+__author__ = 'calvin'
+
+import bisect
+import heapq
+import logging
+import sqlite3
+from itertools import islice
+from threading import RLock
+
+from anonymoususage.tools import *
+from anonymoususage.submission import *
+
+logger = logging.getLogger('AnonymousUsage')
+
+__all__ = ['Storage', 'SQLiteStorage', 'MemoryStorage', 'MemoryRow']
+
+
+class Storage(object):
+    """
+    Keeps the rows of the tracker's tables. Every row is identified by a ROWID that increases with each row appended
+    to a table, which is what submissions use to tell which rows have already been sent.
+
+    Rows are returned as sequences that can also be indexed by column name, ie. row['Count'].
+    """
+
+    def create(self, name, columns):
+        """
+        Create a table if it does not exist yet.
+        :param name: table name
+        :param columns: list of (name, type) tuples
+        """
+        raise NotImplementedError
+
+    def columns(self, name):
+        """
+        Return the names of the table's columns.
+        """
+        raise NotImplementedError
+
+    def table_names(self):
+        """
+        Return the names of the tables that hold usage statistics.
+        """
+        raise NotImplementedError
+
+    def append(self, name, row):
+        """
+        Append a row to a table.
+        :param name: table name
+        :param row: tuple of column values
+        """
+        raise NotImplementedError
+
+    def first(self, name, n=1):
+        """
+        Return the oldest n rows of a table, oldest first.
+        """
+        raise NotImplementedError
+
+    def last(self, name, n=1):
+        """
+        Return the newest n rows of a table, newest first.
+        """
+        raise NotImplementedError
+
+    def rows(self, name):
+        """
+        Return every row of a table, oldest first.
+        """
+        raise NotImplementedError
+
+    def iter_rows(self, name, since=None, until=None, limit=None, order='asc'):
+        """
+        Iterate over the rows of a table with a Time in [since, until), sorted by time.
+        :param name: table name
+        :param since: unix timestamp of the earliest row, or None for no limit
+        :param until: unix timestamp after the latest row, or None for no limit
+        :param limit: maximum number of rows, or None for no limit
+        :param order: 'asc' for the oldest rows first, 'desc' for the newest rows first
+        :return: generator of rows
+        """
+        rows = [row for row in self.rows(name) if (since is None or row['Time'] >= since) and
+                (until is None or row['Time'] < until)]
+        rows.sort(key=lambda row: row['Time'], reverse=order == 'desc')
+        return iter(rows[:limit])
+
+    def count(self, name):
+        """
+        Return the number of rows in a table.
+        """
+        raise NotImplementedError
+
+    def count_since(self, name, rowid):
+        """
+        Return the number of rows of a table that have not been submitted and come after ROWID `rowid`.
+        """
+        return sum(1 for _ in self.iter_since(name, rowid))
+
+    def delete_first(self, name, n=1):
+        """
+        Delete the oldest n rows of a table.
+        :return: number of rows deleted
+        """
+        raise NotImplementedError
+
+    def delete_last(self, name):
+        """
+        Delete the newest row of a table.
+        :return: True if a row was deleted
+        """
+        raise NotImplementedError
+
+    def max_rowid(self, name):
+        """
+        Return the highest ROWID of the rows that have not been submitted, or None if there are none.
+        """
+        raise NotImplementedError
+
+    def iter_since(self, name, rowid, until=None):
+        """
+        Iterate over the rows that have not been submitted and come after ROWID `rowid`, oldest first.
+        :param name: table name
+        :param rowid: ROWID after which to start
+        :param until: optional highest ROWID to return
+        :return: generator of (ROWID, row) tuples
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Write out any rows held back by the storage.
+        :return: number of rows written
+        """
+        return 0
+
+    def load_watermarks(self):
+        """
+        Return a dictionary of table names to the highest submitted ROWID.
+        """
+        return {}
+
+    def close(self):
+        """
+        Write out any rows held back by the storage and release its resources.
+        """
+        self.flush()
+
+    def collect_delta(self, watermarks):
+        """
+        Gather the rows of each table that were added after its watermark.
+        :param watermarks: dictionary of table names to the highest ROWID already submitted
+        :return: tuple of (dictionary of table names to {'columns': [...], 'rows': [...]},
+                           dictionary of table names to the ROWIDs of the collected rows)
+        """
+        delta = {}
+        rowids = {}
+        for table in self.table_names():
+            max_rowid = self.max_rowid(table)
+            if max_rowid is None:
+                continue
+            since = watermarks.get(table, 0)
+            if max_rowid < since:
+                since = 0
+            rows = list(self.iter_since(table, since, max_rowid))
+            if rows:
+                delta[table] = {'columns': self.columns(table), 'rows': [tuple(row) for _, row in rows]}
+                rowids[table] = [rowid for rowid, _ in rows]
+        return delta, rowids
+
+    def merge(self, collected, watermarks):
+        """
+        Mark rows as submitted.
+        :param collected: dictionary of table names to the highest ROWID that was submitted
+        :param watermarks: dictionary of table names to the highest submitted ROWID, updated in place
+        """
+        watermarks.update(collected)
+
+
+class SQLiteStorage(Storage):
+    """
+    Keeps the rows in the tracker's SQLite databases. Rows that have not been submitted are written to the partial
+    database if the tracker has one, and moved into the master database once they are submitted.
+    """
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def _databases(self, name, newest_first=False):
+        tracker = self.tracker
+        dbs = (tracker.dbcon_part, tracker.dbcon_master) if newest_first else (tracker.dbcon_master, tracker.dbcon_part)
+        return [db for db in dbs if db is not None and tracker.table_exists(db, name)]
+
+    def create(self, name, columns):
+        if not self.tracker.table_exists(self.tracker.dbcon, name):
+            self.tracker.create_table(self.tracker.dbcon, name, columns)
+
+    def columns(self, name):
+        return [c[0] for c in self.tracker.table_columns(self.tracker.dbcon, name)]
+
+    def table_names(self):
+        return [t for t in self.tracker._get_schema(self.tracker.dbcon) if t not in INTERNAL_TABLES]
+
+    def append(self, name, row):
+        tracker = self.tracker
+        if tracker.buffer is not None:
+            tracker.buffer.append(name, row)
+        else:
+            with tracker.db_lock(tracker.dbcon):
+                insert_row(tracker.dbcon, name, *row)
+
+    def first(self, name, n=1):
+        self.flush()
+        rows = []
+        # The master database holds the oldest rows
+        for db in self._databases(name):
+            if len(rows) < n:
+                rows.extend(get_first_row(db, name, n))
+        return rows[:n]
+
+    def last(self, name, n=1):
+        self.flush()
+        rows = []
+        # The partial database holds the newest rows
+        for db in self._databases(name, newest_first=True):
+            if len(rows) < n:
+                rows.extend(get_last_row(db, name, n))
+        return rows[:n]
+
+    def rows(self, name):
+        self.flush()
+        rows = []
+        for db in self._databases(name):
+            rows.extend(get_rows(db, name))
+        return rows
+
+    def iter_rows(self, name, since=None, until=None, limit=None, order='asc'):
+        self.flush()
+        conditions, args = [], []
+        if since is not None:
+            conditions.append('"Time" >= ?')
+            args.append(since)
+        if until is not None:
+            conditions.append('"Time" < ?')
+            args.append(until)
+        query = "SELECT * FROM {name}{where} ORDER BY \"Time\" {order}".format(
+            name=quote_identifier(name), where=' WHERE ' + ' AND '.join(conditions) if conditions else '',
+            order='DESC' if order == 'desc' else 'ASC')
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+
+        # Each database returns its rows in time order from the index, merge the streams as they are read
+        sign = -1 if order == 'desc' else 1
+
+        def stream(i, cursor):
+            for row in cursor:
+                yield sign * row['Time'], i, row
+
+        streams = [stream(i, db.execute(query, args)) for i, db in enumerate(self._databases(name))]
+        rows = (row for _, _, row in heapq.merge(*streams))
+        return islice(rows, limit)
+
+    def count(self, name):
+        self.flush()
+        return sum(get_number_of_rows(db, name) for db in self._databases(name))
+
+    def count_since(self, name, rowid):
+        self.flush()
+        query = "SELECT COUNT(*) FROM {name} WHERE ROWID > ?".format(name=quote_identifier(name))
+        return self.tracker.dbcon.execute(query, (rowid,)).fetchone()[0]
+
+    def delete_first(self, name, n=1):
+        deleted = 0
+        # Rows are removed from the master database (which holds the oldest rows) before the partial database
+        for db in self._databases(name):
+            if deleted < n:
+                with self.tracker.db_lock(db):
+                    deleted += delete_first_rows(db, name, n - deleted)
+        # Some of the rows may still be buffered, write them out so they can be removed
+        if deleted < n and self.flush():
+            deleted += self.delete_first(name, n - deleted)
+        return deleted
+
+    def delete_last(self, name):
+        self.flush()
+        tracker = self.tracker
+        # Submissions advance the watermarks, hold them off until the watermark is corrected
+        with tracker._submit_lock:
+            for db in self._databases(name, newest_first=True):
+                with tracker.db_lock(db):
+                    rowid = get_max_rowids(db, [name])[name]
+                    if delete_last_row(db, name):
+                        if db is tracker.dbcon:
+                            self._lower_watermark(name, rowid)
+                        return True
+        return False
+
+    def _lower_watermark(self, name, rowid):
+        # The tables have no AUTOINCREMENT, so SQLite reuses the ROWID of a deleted last row. If that row was submitted,
+        # the watermark is moved below it, or the next row would be taken as submitted.
+        tracker = self.tracker
+        watermarks = tracker._get_watermarks()
+        if watermarks.get(name, 0) < rowid:
+            return
+        watermarks[name] = rowid - 1
+        if tracker.table_exists(tracker.dbcon, WATERMARK_TABLE):
+            save_watermarks(tracker.dbcon, {name: rowid - 1})
+
+    def max_rowid(self, name):
+        return get_max_rowids(self.tracker.dbcon, [name])[name]
+
+    def iter_since(self, name, rowid, until=None):
+        for row in iter_rows_since(self.tracker.dbcon, name, rowid, until, with_rowid=True):
+            yield row[0], tuple(row)[1:]
+
+    def flush(self):
+        return self.tracker.flush()
+
+    def load_watermarks(self):
+        return load_watermarks(self.tracker.dbcon)
+
+    def collect_delta(self, watermarks):
+        # One query finds the new rows of every table
+        return collect_delta(self.tracker.dbcon, self.table_names(), watermarks)
+
+    def merge(self, collected, watermarks):
+        tracker = self.tracker
+        dbconn = tracker.dbcon
+        if not tracker.table_exists(dbconn, WATERMARK_TABLE):
+            tracker.create_table(dbconn, WATERMARK_TABLE, WATERMARK_COLUMNS)
+
+        if tracker.dbcon_part is None:
+            watermarks.update(collected)
+            with tracker.db_lock(dbconn):
+                save_watermarks(dbconn, watermarks)
+            return
+
+        # Hold both connections so that no rows are written to the partial database during the merge. Rows written
+        # after the delta was collected have a higher ROWID and stay in the partial database.
+        master, part = tracker.dbcon_master, tracker.dbcon_part
+        with tracker.db_lock(master), tracker.db_lock(part):
+            rowids = dict(collected)
+            if tracker.table_exists(part, '__tableinfo__'):
+                rowids['__tableinfo__'] = None
+            for table in rowids:
+                if not tracker.table_exists(master, table):
+                    tracker.create_table(master, table, tracker.table_columns(part, table))
+
+            # Tables that will be empty after the merge number their rows from 1 again
+            max_rowids = get_max_rowids(part, collected.keys())
+            for table, rowid in collected.iteritems():
+                watermarks[table] = rowid if max_rowids.get(table) > rowid else 0
+
+            # Copy the rows into master, delete them from the partial database and advance the watermarks in
+            # one transaction
+            with attach_database(master, tracker.filepath_part, 'part'):
+                try:
+                    merge_attached_tables(master, 'part', rowids, delete=True)
+                    save_watermarks(master, watermarks, commit=False, database='part')
+                    master.commit()
+                except sqlite3.Error:
+                    master.rollback()
+                    raise
+
+
+class MemoryRow(tuple):
+    """
+    Row of a MemoryStorage table that can be indexed by position or column name, like sqlite3.Row.
+    """
+
+    def __new__(cls, values, index):
+        row = tuple.__new__(cls, values)
+        row._index = index
+        return row
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            key = self._index[key]
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return sorted(self._index, key=self._index.get)
+
+
+class _MemoryTable(object):
+
+    def __init__(self, columns):
+        self.columns = [c[0] for c in columns]
+        self.index = {c: i for i, c in enumerate(self.columns)}
+        self.rowids = []
+        self.rows = []
+        self.next_rowid = 1
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps the rows in memory. Nothing is written to disk, so the rows are lost when the process exits. Useful for
+    tests and short lived processes.
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = RLock()
+
+    def create(self, name, columns):
+        with self._lock:
+            if name not in self._tables:
+                self._tables[name] = _MemoryTable(columns)
+
+    def columns(self, name):
+        return list(self._tables[name].columns)
+
+    def table_names(self):
+        return self._tables.keys()
+
+    def append(self, name, row):
+        with self._lock:
+            table = self._tables[name]
+            table.rowids.append(table.next_rowid)
+            table.rows.append(MemoryRow(row, table.index))
+            table.next_rowid += 1
+
+    def first(self, name, n=1):
+        return self._tables[name].rows[:n]
+
+    def last(self, name, n=1):
+        return self._tables[name].rows[-n:][::-1] if n else []
+
+    def rows(self, name):
+        return list(self._tables[name].rows)
+
+    def count(self, name):
+        return len(self._tables[name].rows)
+
+    def count_since(self, name, rowid):
+        table = self._tables[name]
+        return len(table.rowids) - bisect.bisect_right(table.rowids, rowid)
+
+    def delete_first(self, name, n=1):
+        with self._lock:
+            table = self._tables[name]
+            deleted = min(n, len(table.rows))
+            del table.rows[:deleted]
+            del table.rowids[:deleted]
+            return deleted
+
+    def delete_last(self, name):
+        with self._lock:
+            table = self._tables[name]
+            if table.rows:
+                table.rows.pop()
+                table.rowids.pop()
+                return True
+            return False
+
+    def max_rowid(self, name):
+        table = self._tables[name]
+        return table.rowids[-1] if table.rowids else None
+
+    def iter_since(self, name, rowid, until=None):
+        with self._lock:
+            table = self._tables[name]
+            start = bisect.bisect_right(table.rowids, rowid)
+            end = len(table.rowids) if until is None else bisect.bisect_right(table.rowids, until)
+            rows = zip(table.rowids[start:end], table.rows[start:end])
+        return iter(rows)
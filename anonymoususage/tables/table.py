@@ -10,18 +10,25 @@ logger = logging.getLogger('AnonymousUsage')
 
 
 class Table(object):
+    # Format of the Time column before schema version 1, which stores unix timestamps
     time_fmt = "%d/%m/%Y %H:%M:%S"
-    table_args = ("UUID", "INTEGER"), ("Count", "REAL"), ("Time", "TEXT")
-    lock = RLock()
+    table_args = ("UUID", "INTEGER"), ("Count", "REAL"), ("Time", "REAL")
 
-    def __init__(self, name, tracker, max_rows):
+    def __init__(self, name, tracker, max_rows, storage=None):
         if ' ' in name:
             raise TableNameError(name)
         self.max_rows = max_rows
         self.tracker = tracker
         self.name = name
-
-        self.number_of_rows = self.get_number_of_rows()
+        # Where the rows are kept, the tracker's storage unless the table is given its own
+        self.storage = storage if storage is not None else tracker.storage
+        # Guards the table's in-memory state. Writes to a database connection are additionally serialized by the
+        # tracker's lock for that connection, so unrelated tables only contend while actually writing.
+        self.lock = RLock()
+
+        # Row count is kept in memory so that max_rows can be enforced without querying the database on every insert
+        self.storage.create(name, self.table_args)
+        self.number_of_rows = self.count_rows()
         last = self.get_last()
         if last:
             self.count = last[0]['Count']
@@ -30,26 +37,54 @@ class Table(object):
 
         logger.debug("{s.name}: {s.number_of_rows} table entries found".format(s=self))
 
-        if not check_table_exists(self.tracker.dbcon, name):
-            create_table(self.tracker.dbcon, name, self.table_args)
-
     def get_rows(self):
         """
         Attempt to load the statistic from the database.
         :return: Number of entries for the statistic
         """
-        rows = []
-        if check_table_exists(self.tracker.dbcon_master, self.name):
-            rows.extend(get_rows(self.tracker.dbcon_master, self.name))
-        if self.tracker.dbcon_part and check_table_exists(self.tracker.dbcon_part, self.name):
-            rows.extend(get_rows(self.tracker.dbcon_part, self.name))
-        return rows
+        return self.storage.rows(self.name)
+
+    def iter_rows(self, since=None, until=None, limit=None, order='asc'):
+        """
+        Iterate over the rows of the table in time order. Rows are read from the database as the generator is consumed,
+        so only the rows that are used are loaded.
+        :param since: datetime or unix timestamp of the earliest row, or None for no limit
+        :param until: datetime or unix timestamp after the latest row (exclusive), or None for no limit
+        :param limit: maximum number of rows, or None for no limit
+        :param order: 'asc' for the oldest rows first, 'desc' for the newest rows first
+        :return: generator of rows
+        """
+        if order not in ('asc', 'desc'):
+            raise ValueError('Unknown order: %s' % order)
+        since = None if since is None else to_epoch(since)
+        until = None if until is None else to_epoch(until)
+        return self.storage.iter_rows(self.name, since, until, limit, order)
+
+    def query(self, since=None, until=None, limit=None, order='asc'):
+        """
+        Retrieve the rows of the table in a time range. See `iter_rows`.
+        :return: list of rows
+        """
+        return list(self.iter_rows(since, until, limit, order))
+
+    def get_rows_between(self, since=None, until=None):
+        """
+        Retrieve the rows of the table that were added in a time range, sorted by time.
+        :return: list of rows
+        """
+        return self.query(since, until)
 
     def get_number_of_rows(self):
-        n_rows = get_number_of_rows(self.tracker.dbcon_master, self.name)
-        if self.tracker.dbcon_part:
-            n_rows += get_number_of_rows(self.tracker.dbcon_part, self.name)
-        return n_rows
+        """
+        Return the number of rows in the table, including rows that are waiting in the tracker's buffer.
+        """
+        return self.number_of_rows
+
+    def count_rows(self):
+        """
+        Count the rows of the table in its storage.
+        """
+        return self.storage.count(self.name)
 
     def insert(self, value):
         """
@@ -59,51 +94,76 @@ class Table(object):
         """
         pass
 
+    def _insert_row(self, *args):
+        """
+        Write a row to the table. If the tracker buffers its writes, the row is queued and written to the database on
+        the next flush. Once the table grows more than `eviction_slack()` rows over `max_rows`, the oldest
+        rows are deleted in bulk.
+        :param args: table columns
+        """
+        with self.lock:
+            self.storage.append(self.name, args)
+            self.number_of_rows += 1
+            if self.number_of_rows > self.max_rows + self.eviction_slack():
+                self.evict()
+        self.tracker._row_added(self.name)
+
+    def eviction_slack(self):
+        """
+        Return the number of rows the table may grow past max_rows before the oldest rows are deleted. Evicting in
+        bulk saves a DELETE and a commit on every insert once the table is full.
+        """
+        slack = self.tracker.eviction_slack
+        if slack is None:
+            slack = int(self.max_rows * self.tracker.EVICTION_SLACK_FRACTION)
+        return slack
+
     def get_first(self, n=1):
         """
         Retrieve the first n rows from the table
         :param n: number of rows to return
-        :return: list of rows
+        :return: list of rows, oldest first
         """
-        rows = []
-        # Get values from the partial db first
-        if self.tracker.dbcon_master and check_table_exists(self.tracker.dbcon_master, self.name):
-            rows.extend(get_first_row(self.tracker.dbcon_master, self.name, n))
-        # Then add rows from the master if required
-        if len(rows) < n and self.tracker.dbcon_part and check_table_exists(self.tracker.dbcon_part, self.name):
-            rows.extend(get_first_row(self.tracker.dbcon_part, self.name, n))
-        return rows[:n]
+        return self.storage.first(self.name, n)
 
     def get_last(self, n=1):
         """
         Retrieve the last n rows from the table
         :param n: number of rows to return
-        :return: list of rows
+        :return: list of rows, newest first
         """
-        rows = []
-        # Get values from the partial db first
-        if self.tracker.dbcon_part and check_table_exists(self.tracker.dbcon_part, self.name):
-            rows.extend(get_last_row(self.tracker.dbcon_part, self.name, n))
-        # Then add rows from the master if required
-        if len(rows) < n and check_table_exists(self.tracker.dbcon_master, self.name):
-            rows.extend(get_last_row(self.tracker.dbcon_master, self.name, n))
-        return rows[-n:]
+        return self.storage.last(self.name, n)
 
     def delete_last(self):
-        last = self.get_last()
-        if last:
-            last = last[0]
-            db = self.tracker.dbcon_part if self.tracker.dbcon_part else self.tracker.dbcon_master
-            delete_row(db, self.name, "Time", last['Time'])
-            self.count -= 1
-
-    def delete_first(self):
-        for db in (self.tracker.dbcon_master, self.tracker.dbcon_part):
-            if db:
-                rowid = get_first_row(db, self.name)
-                if rowid:
-                    delete_row(db, self.name, "Time", rowid[0]['Time'])
-                    break
+        # The storage corrects the submission watermark under the submit lock, which a submission holds while it
+        # takes the lock of the table. Take the locks in the same order.
+        with self.tracker._submit_lock, self.lock:
+            if self.storage.delete_last(self.name):
+                self.number_of_rows -= 1
+                self.count -= 1
+
+    def delete_first(self, n=1):
+        """
+        Delete the oldest `n` rows from the table.
+        :param n: number of rows to delete
+        :return: number of rows deleted
+        """
+        with self.lock:
+            deleted = self.storage.delete_first(self.name, n)
+            self.number_of_rows -= deleted
+            return deleted
+
+    def evict(self):
+        """
+        Delete the oldest rows from the table so that no more than `max_rows` rows remain.
+        :return: number of rows deleted
+        """
+        with self.lock:
+            excess = self.number_of_rows - self.max_rows
+            if excess > 0:
+                logger.debug("{s.name}: evicting {n} rows".format(s=self, n=excess))
+                return self.delete_first(excess)
+            return 0
 
     def get_count(self):
         row = self.get_last()
@@ -15,13 +15,19 @@ class Timer(Statistic):
     A timer is a special case of a Statistic where the count is the number of elapsed seconds. A Timer object can be
     started and stopped in order to record the time it takes for certain tasks to be completed.
 
+    The distribution of the recorded durations is kept in a fixed-size sketch, from which percentiles can be read.
     """
+    # The sketch is written to the database at most this often, and when the tracker is closed
+    SKETCH_SAVE_INTERVAL_S = 60
 
     def __init__(self, name, tracker, *args, **kwargs):
         super(Timer, self).__init__(name, tracker, *args, **kwargs)
         self._start_time = None
         self.paused = False
         self._delta_seconds = 0
+        self.sketch = tracker.load_sketch(name)
+        self._sketch_saved = time.time()
+        self._sketch_changed = False
 
     def start_timer(self):
         self._start_time = datetime.datetime.now()
@@ -48,12 +54,42 @@ class Timer(Statistic):
             self._delta_seconds += timedelta.total_seconds()
         self += self._delta_seconds
         delta_seconds = self._delta_seconds
+        with self.lock:
+            self.sketch.add(delta_seconds)
+            self._sketch_changed = True
+        if time.time() - self._sketch_saved >= self.SKETCH_SAVE_INTERVAL_S:
+            self.save_sketch()
         self._delta_seconds = 0
         self._start_time = None
         self.paused = False
         logger.debug('AnonymousUsage: Stopping %s timer' % self.name)
         return delta_seconds
 
+    def percentile(self, p):
+        """
+        Return the p-th percentile (0 <= p <= 100) of the recorded durations in seconds, within the sketch's relative
+        accuracy, or None if no durations were recorded.
+        """
+        with self.lock:
+            return self.sketch.quantile(p / 100.)
+
+    def get_sketch_state(self):
+        """
+        Return the state of the duration sketch as a JSON serializable dictionary.
+        """
+        with self.lock:
+            return self.sketch.to_dict()
+
+    def save_sketch(self):
+        """
+        Write the duration sketch to the database if durations were recorded since it was last written.
+        """
+        with self.lock:
+            if self._sketch_changed:
+                self.tracker.save_sketches({self.name: self.sketch})
+                self._sketch_changed = False
+            self._sketch_saved = time.time()
+
     @property
     def elapsed_time_s(self):
         """
@@ -4,13 +4,52 @@ import datetime
 import ftplib
 import logging
 import sqlite3
+import time
+from contextlib import contextmanager
 
 logger = logging.getLogger('AnonymousUsage')
 
-__all__ = ['create_table', 'get_table_list', 'get_table_columns', 'check_table_exists', 'get_rows',
-           'merge_databases', 'ftp_download', 'get_datetime_sorted_rows', 'delete_row', 'get_uuid_list',
-           'get_number_of_rows', 'get_last_row', 'get_first_row', 'fetch', 'rename_table', 'database_to_json',
-           'clear_table']
+__all__ = ['create_table', 'insert_row', 'insert_rows', 'get_table_list', 'get_table_columns', 'check_table_exists',
+           'get_rows', 'merge_databases', 'ftp_download', 'get_datetime_sorted_rows', 'delete_row', 'delete_first_rows',
+           'delete_last_row', 'get_uuid_list', 'get_number_of_rows', 'get_last_row', 'get_first_row', 'fetch',
+           'rename_table', 'database_to_json', 'clear_table', 'quote_identifier', 'set_pragmas', 'delete_rows_until',
+           'get_max_rowids', 'iter_rows_since', 'get_database_path', 'attach_database', 'merge_attached_tables',
+           'SCHEMA_VERSION', 'get_schema_version', 'migrate_schema', 'create_time_index', 'create_uuid_index',
+           'to_epoch']
+
+# Version 1 stores the Time column as a unix timestamp (REAL) and indexes it. Version 0 stored day-first text.
+SCHEMA_VERSION = 1
+# Converts a version 0 'dd/mm/YYYY HH:MM:SS' local time to a unix timestamp
+TEXT_TIME_TO_EPOCH = ("CASE WHEN typeof(\"Time\") = 'text' THEN "
+                      "round((julianday(substr(\"Time\", 7, 4) || '-' || substr(\"Time\", 4, 2) || '-' || "
+                      "substr(\"Time\", 1, 2) || ' ' || substr(\"Time\", 12), 'utc') - 2440587.5) * 86400.0, 3) "
+                      "ELSE \"Time\" END")
+
+
+def quote_identifier(name):
+    """
+    Quote a table or column name for use in an SQL statement. Identifiers cannot be bound as parameters, so every
+    statement for a given table is built from the same quoted name and can be reused from the statement cache.
+    :param name: table or column name
+    :return: quoted identifier
+    """
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def set_pragmas(dbconn, pragmas):
+    """
+    Apply PRAGMA settings to a database connection.
+    :param dbconn: database connection
+    :param pragmas: dictionary of pragma names and values, ie. {'journal_mode': 'WAL', 'cache_size': -8000}
+    """
+    for name, value in pragmas.iteritems():
+        if value is None:
+            continue
+        if not name.replace('_', '').isalnum():
+            raise ValueError('Invalid pragma name "{}"'.format(name))
+        result = dbconn.execute("PRAGMA {name}={value}".format(name=name, value=value)).fetchone()
+        logger.debug('PRAGMA {name}={value}: {result}'.format(name=name, value=value,
+                                                              result=result[0] if result else value))
 
 
 def create_table(dbcon, name, columns):
@@ -20,13 +59,89 @@ def create_table(dbcon, name, columns):
     :return: True if a new table was created
     """
     try:
-        colString = ", ".join(["{} {}".format(colName, colType) for colName, colType in columns])
-        dbcon.execute("CREATE TABLE '{name}'({args})".format(name=name, args=colString))
+        colString = ", ".join(["{} {}".format(quote_identifier(colName), colType) for colName, colType in columns])
+        dbcon.execute("CREATE TABLE {name}({args})".format(name=quote_identifier(name), args=colString))
         return True
     except sqlite3.OperationalError as e:
         return False
 
 
+def create_uuid_index(dbconn, tablename):
+    """
+    Index the UUID, Time and Count columns of a table, to select the rows of a user and find duplicate rows when
+    databases are consolidated.
+    :param dbconn: database connection
+    :param tablename: name of the table
+    """
+    dbconn.execute("CREATE INDEX IF NOT EXISTS {index} ON {name}(UUID, \"Time\", Count)".format(
+        index=quote_identifier(tablename + '_UUID'), name=quote_identifier(tablename)))
+
+
+def create_time_index(dbconn, tablename):
+    """
+    Index the Time column of a table so that rows can be selected and sorted by time in SQL.
+    :param dbconn: database connection
+    :param tablename: name of the table
+    """
+    dbconn.execute("CREATE INDEX IF NOT EXISTS {index} ON {name}(\"Time\")".format(
+        index=quote_identifier(tablename + '_Time'), name=quote_identifier(tablename)))
+
+
+def get_schema_version(dbconn):
+    """
+    Return the schema version of a database (PRAGMA user_version)
+    """
+    return dbconn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate_schema(dbconn):
+    """
+    Upgrade the tables of a database to SCHEMA_VERSION in one transaction. Tables with a text Time column are rebuilt
+    with the times converted to unix timestamps, keeping their ROWIDs, and the Time column is indexed.
+    :param dbconn: database connection
+    :return: True if the database was migrated
+    """
+    if get_schema_version(dbconn) >= SCHEMA_VERSION:
+        return False
+    # Manage the transaction explicitly, the sqlite3 module commits before every CREATE, DROP and ALTER statement
+    isolation_level = dbconn.isolation_level
+    dbconn.commit()
+    dbconn.isolation_level = None
+    try:
+        dbconn.execute("BEGIN IMMEDIATE")
+        for table in get_table_list(dbconn):
+            columns = get_table_columns(dbconn, table)
+            if ('Time', 'TEXT') not in columns:
+                continue
+            logger.debug("Migrating table '{}' to schema version {}".format(table, SCHEMA_VERSION))
+            name, tmp = quote_identifier(table), quote_identifier(table + '__migration')
+            create_table(dbconn, table + '__migration', [(c, 'REAL' if c == 'Time' else t) for c, t in columns])
+            names = ', '.join(quote_identifier(c) for c, _ in columns)
+            values = ', '.join(TEXT_TIME_TO_EPOCH if c == 'Time' else quote_identifier(c) for c, _ in columns)
+            dbconn.execute("INSERT INTO {tmp} (ROWID, {names}) SELECT ROWID, {values} FROM {name}".format(
+                tmp=tmp, names=names, values=values, name=name))
+            dbconn.execute("DROP TABLE {name}".format(name=name))
+            dbconn.execute("ALTER TABLE {tmp} RENAME TO {name}".format(tmp=tmp, name=name))
+            create_time_index(dbconn, table)
+        dbconn.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        dbconn.execute("COMMIT")
+    except sqlite3.Error:
+        dbconn.execute("ROLLBACK")
+        raise
+    finally:
+        dbconn.isolation_level = isolation_level
+    return True
+
+
+def to_epoch(value):
+    """
+    Convert a datetime (in local time) or unix timestamp to a unix timestamp.
+    """
+    if isinstance(value, datetime.datetime):
+        return time.mktime(value.timetuple()) + value.microsecond / 1e6
+    return float(value)
+
+
 def insert_row(dbconn, tablename, *args):
     """
     Insert a row into a table
@@ -34,11 +149,29 @@ def insert_row(dbconn, tablename, *args):
     :param table_name: name of the table
     :param args: table columns
     """
+    placeholders = ("?," * len(args))[:-1]
     cur = dbconn.cursor()
-    cur.execute("INSERT INTO '{name}' VALUES{args}".format(name=tablename, args=args))
+    cur.execute("INSERT INTO {name} VALUES ({args})".format(name=quote_identifier(tablename), args=placeholders), args)
     dbconn.commit()
 
 
+def insert_rows(dbconn, tablename, rows, commit=True):
+    """
+    Insert several rows into a table with a single statement
+    :param dbconn: data base connection
+    :param tablename: name of the table
+    :param rows: list of row tuples
+    :param commit: commit the transaction after inserting
+    """
+    if not rows:
+        return
+    placeholders = ("?," * len(rows[0]))[:-1]
+    dbconn.executemany("INSERT INTO {name} VALUES ({args})".format(name=quote_identifier(tablename), args=placeholders),
+                       rows)
+    if commit:
+        dbconn.commit()
+
+
 def delete_row(dbconn, table_name, field, value):
     """
     Delete a row from a table in a database.
@@ -46,10 +179,69 @@ def delete_row(dbconn, table_name, field, value):
     :param table_name: name of the table
     :param field: field of the table to target
     :param value: value of the field in the table to delete
+    :return: number of rows deleted
     """
     cur = dbconn.cursor()
-    cur.execute("DELETE FROM '{name}' WHERE {field}='{value}'".format(name=table_name, field=field, value=value))
+    cur.execute("DELETE FROM {name} WHERE {field}=?".format(name=quote_identifier(table_name),
+                                                            field=quote_identifier(field)), (value,))
     dbconn.commit()
+    return cur.rowcount
+
+
+def delete_first_rows(dbconn, table_name, n, commit=True):
+    """
+    Delete the first `n` rows (by ROWID) from a table in a database.
+    :param dbconn: data base connection
+    :param table_name: name of the table
+    :param n: number of rows to delete
+    :param commit: commit the transaction after deleting
+    :return: number of rows deleted
+    """
+    name = quote_identifier(table_name)
+    cur = dbconn.cursor()
+    cur.execute("SELECT ROWID FROM {name} ORDER BY ROWID LIMIT 1 OFFSET ?".format(name=name), (n,))
+    cutoff = cur.fetchone()
+    if cutoff is None:
+        # The table has no more than n rows
+        cur.execute("DELETE FROM {name}".format(name=name))
+    else:
+        cur.execute("DELETE FROM {name} WHERE ROWID < ?".format(name=name), (cutoff[0],))
+    if commit:
+        dbconn.commit()
+    return cur.rowcount
+
+
+def delete_rows_until(dbconn, table_name, rowid=None, commit=True):
+    """
+    Delete every row up to and including ROWID `rowid` from a table in a database.
+    :param dbconn: data base connection
+    :param table_name: name of the table
+    :param rowid: highest ROWID to delete, or None to delete every row
+    :param commit: commit the transaction after deleting
+    :return: number of rows deleted
+    """
+    cur = dbconn.cursor()
+    if rowid is None:
+        cur.execute("DELETE FROM {name}".format(name=quote_identifier(table_name)))
+    else:
+        cur.execute("DELETE FROM {name} WHERE ROWID <= ?".format(name=quote_identifier(table_name)), (rowid,))
+    if commit:
+        dbconn.commit()
+    return cur.rowcount
+
+
+def delete_last_row(dbconn, table_name):
+    """
+    Delete the last row (by ROWID) from a table in a database.
+    :param dbconn: data base connection
+    :param table_name: name of the table
+    :return: number of rows deleted
+    """
+    name = quote_identifier(table_name)
+    cur = dbconn.cursor()
+    cur.execute("DELETE FROM {name} WHERE ROWID=(SELECT MAX(ROWID) FROM {name})".format(name=name))
+    dbconn.commit()
+    return cur.rowcount
 
 
 def clear_table(dbconn, table_name):
@@ -60,7 +252,7 @@ def clear_table(dbconn, table_name):
     :return:
     """
     cur = dbconn.cursor()
-    cur.execute("DELETE FROM '{name}'".format(name=table_name))
+    cur.execute("DELETE FROM {name}".format(name=quote_identifier(table_name)))
     dbconn.commit()
 
 
@@ -78,20 +270,22 @@ def get_table_list(dbconn):
         return get_table_list(dbconn)
 
 
-def get_uuid_list(dbconn):
+def get_uuid_list(dbconn, tables=None):
     """
-    Get a list of tables that exist in dbconn
+    Get the UUIDs that have rows in the database. The tables are read in groups with a single compound query, which
+    uses the UUID indexes of a consolidated database.
     :param dbconn: master database connection
-    :return: List of uuids in the database
+    :param tables: optional list of the tables to read, all tables with a UUID column by default
+    :return: set of uuids in the database
     """
-    cur = dbconn.cursor()
-    tables = get_table_list(dbconn)
+    if tables is None:
+        tables = [t for t in get_table_list(dbconn) if 'UUID' in (c[0] for c in get_table_columns(dbconn, t))]
+    tables = list(tables)
     uuids = set()
-    for table in tables:
-        cur.execute("SELECT (UUID) FROM '{table}'".format(table=table))
-        uuid = set([i[0] for i in cur.fetchall()])
-        if uuid:
-            uuids.update(uuid)
+    # SQLite limits a compound SELECT to 500 terms by default
+    for ii in xrange(0, len(tables), 100):
+        query = " UNION ".join("SELECT UUID FROM {}".format(quote_identifier(t)) for t in tables[ii:ii + 100])
+        uuids.update(row[0] for row in dbconn.execute(query))
     return uuids
 
 
@@ -100,7 +294,7 @@ def get_table_columns(dbconn, tablename):
     Return a list of tuples specifying the column name and type
     """
     cur = dbconn.cursor()
-    cur.execute("PRAGMA table_info('%s');" % tablename)
+    cur.execute("PRAGMA table_info(%s);" % quote_identifier(tablename))
     info = cur.fetchall()
     cols = [(i[1], i[2]) for i in info]
     return cols
@@ -115,10 +309,11 @@ def get_number_of_rows(dbcon, tablename, uuid=None):
     """
     dbcur = dbcon.cursor()
     if check_table_exists(dbcon, tablename):
+        name = quote_identifier(tablename)
         if uuid:
-            dbcur.execute("SELECT COUNT(*) FROM '{name}' WHERE UUID='{uuid}'".format(name=tablename, uuid=uuid))
+            dbcur.execute("SELECT COUNT(*) FROM {name} WHERE UUID=?".format(name=name), (uuid,))
         else:
-            dbcur.execute("SELECT COUNT(*) FROM '{name}'".format(name=tablename))
+            dbcur.execute("SELECT COUNT(*) FROM {name}".format(name=name))
         try:
             result = dbcur.fetchone()[0]
         except (TypeError, IndexError) as e:
@@ -138,7 +333,7 @@ def check_table_exists(dbcon, tablename):
     :return: Boolean
     """
     dbcur = dbcon.cursor()
-    dbcur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='%s';" % tablename)
+    dbcur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (tablename,))
     result = dbcur.fetchone()
     dbcur.close()
     if result is None:
@@ -158,10 +353,11 @@ def get_rows(dbconn, tablename, uuid=None):
     :return: List of sqlite3.Row objects
     """
     cursor = dbconn.cursor()
+    name = quote_identifier(tablename)
     if uuid:
-        cursor.execute("SELECT * FROM  {tablename} WHERE UUID='{uuid}'".format(tablename=tablename, uuid=uuid))
+        cursor.execute("SELECT * FROM {name} WHERE UUID=?".format(name=name), (uuid,))
     else:
-        cursor.execute("SELECT * FROM %s" % tablename)
+        cursor.execute("SELECT * FROM {name}".format(name=name))
     rows = cursor.fetchall()
     return rows
 
@@ -178,9 +374,10 @@ def fetch(dbconn, tablename, n=1, uuid=None, end=True):
     order = 'DESC' if end else 'ASC'
     try:
         if uuid:
-            cur.execute("SELECT * FROM '{}' WHERE UUID='{}' ORDER BY ROWID {} LIMIT {};".format(tablename, uuid, order, n))
+            cur.execute("SELECT * FROM {} WHERE UUID=? ORDER BY ROWID {} LIMIT ?;".format(quote_identifier(tablename),
+                                                                                        order), (uuid, n))
         else:
-            cur.execute("SELECT * FROM '{}' ORDER BY ROWID {} LIMIT {};".format(tablename, order, n))
+            cur.execute("SELECT * FROM {} ORDER BY ROWID {} LIMIT ?;".format(quote_identifier(tablename), order), (n,))
     except sqlite3.OperationalError as e:
         if 'no such table' not in getattr(e, 'message', ''):
             # Suppress logging of errors generated when no table exists
@@ -190,6 +387,47 @@ def fetch(dbconn, tablename, n=1, uuid=None, end=True):
     return rows
 
 
+def get_max_rowids(dbconn, tablenames):
+    """
+    Return the highest ROWID of each table. Tables are queried in groups with a single compound statement.
+    :param dbconn: database connection
+    :param tablenames: list of table names
+    :return: dictionary of table names to their highest ROWID (None for empty tables)
+    """
+    tablenames = list(tablenames)
+    max_rowids = {}
+    for ii in xrange(0, len(tablenames), 100):
+        group = tablenames[ii:ii + 100]
+        query = " UNION ALL ".join("SELECT ?, MAX(ROWID) FROM {}".format(quote_identifier(t)) for t in group)
+        for table, max_rowid in dbconn.execute(query, group):
+            max_rowids[table] = max_rowid
+    return max_rowids
+
+
+def iter_rows_since(dbconn, tablename, rowid, until=None, with_rowid=False):
+    """
+    Iterate over the rows of a table with a ROWID greater than `rowid`, in ROWID order, without loading them all into
+    memory.
+    :param dbconn: database connection
+    :param tablename: name of the table
+    :param rowid: ROWID after which to start
+    :param until: optional highest ROWID to return
+    :param with_rowid: prepend the ROWID to each row
+    :return: generator of rows
+    """
+    name = quote_identifier(tablename)
+    select = "SELECT ROWID, * FROM" if with_rowid else "SELECT * FROM"
+    if until is None:
+        cur = dbconn.execute("{select} {name} WHERE ROWID > ? ORDER BY ROWID".format(select=select, name=name),
+                             (rowid,))
+    else:
+        cur = dbconn.execute("{select} {name} WHERE ROWID > ? AND ROWID <= ? ORDER BY ROWID".format(select=select,
+                                                                                                     name=name),
+                             (rowid, until))
+    for row in cur:
+        yield row
+
+
 def get_last_row(dbconn, tablename, n=1, uuid=None):
     """
     Returns the last `n` rows in the table
@@ -204,35 +442,97 @@ def get_first_row(dbconn, tablename, n=1, uuid=None):
     return fetch(dbconn, tablename, n, uuid, end=False)
 
 
-def merge_databases(master, part):
+def get_database_path(dbconn):
+    """
+    Returns the path of the file of a connection's main database
+    """
+    for row in dbconn.execute("PRAGMA database_list"):
+        if row[1] == 'main':
+            return row[2]
+
+
+@contextmanager
+def attach_database(dbconn, path, name):
+    """
+    Attach another database file to a connection for the duration of a with block. A database can not be attached or
+    detached within a transaction, so the block must commit or roll back its changes.
+    :param dbconn: database connection
+    :param path: path to the database file
+    :param name: schema name to attach the database as
+    """
+    dbconn.execute("ATTACH DATABASE ? AS {name}".format(name=quote_identifier(name)), (path,))
+    try:
+        yield dbconn
+    finally:
+        dbconn.execute("DETACH DATABASE {name}".format(name=quote_identifier(name)))
+
+
+def merge_attached_tables(dbconn, source, rowids, delete=False):
     """
-    Merge the partial database into the master database.
+    Copy rows from the tables of an attached database into the tables of the same name in the main database. The rows
+    are copied by SQLite without passing through Python. Nothing is committed, so the copy can share a transaction with
+    other changes. The tables must already exist in the main database.
+
+    Rows that are already in the main database (equal in every column) are skipped. In WAL mode SQLite commits each
+    attached database file on its own, so a crash can leave the copy committed in the main database while the rows are
+    still in the attached database. Merging again then does not duplicate them.
+    :param dbconn: database connection
+    :param source: schema name of the attached database
+    :param rowids: dictionary of table names to the highest ROWID to copy (None to copy all of the table's rows)
+    :param delete: delete the copied rows from the attached database
+    :return: number of rows copied
+    """
+    source = quote_identifier(source)
+    # Read the columns before copying, the sqlite3 module commits the open transaction before a PRAGMA
+    columns = {table: [quote_identifier(c) for c, _ in get_table_columns(dbconn, table)] for table in rowids}
+    total = 0
+    for table, max_rowid in rowids.iteritems():
+        name = quote_identifier(table)
+        if max_rowid is None:
+            where, args = "", ()
+        else:
+            where, args = "WHERE ROWID <= ?", (max_rowid,)
+        # The Time index of the main table finds the copies of a row
+        match = ' AND '.join('m.{c} IS s.{c}'.format(c=c) for c in columns[table])
+        cur = dbconn.execute("INSERT INTO main.{name} SELECT * FROM {source}.{name} AS s {where} {cond} NOT EXISTS "
+                             "(SELECT 1 FROM main.{name} AS m WHERE {match})".format(
+                                 name=name, source=source, where=where.replace('ROWID', 's.ROWID'),
+                                 cond='AND' if where else 'WHERE', match=match), args)
+        if cur.rowcount:
+            logger.debug("Merging {m} rows of table '{name}' into master".format(name=table, m=cur.rowcount))
+        total += cur.rowcount
+        if delete:
+            dbconn.execute("DELETE FROM {source}.{name} {where}".format(name=name, source=source, where=where), args)
+    return total
+
+
+def merge_databases(master, part, rowids=None, delete=False):
+    """
+    Merge the partial database into the master database in a single transaction. The partial database is attached to
+    the master connection and its rows are copied with INSERT INTO ... SELECT. Rows already in the master database are
+    skipped, so a merge interrupted between the commits of the two files (in WAL mode) can safely be repeated.
     :param master: database connection to the master database
     :param part: database connection to the partial database
+    :param rowids: optional dictionary of table names to the highest ROWID to merge (None to merge all of the table's
+                   rows). If given, only these tables are merged.
+    :param delete: delete the merged rows from the partial database in the same transaction
+    :return: number of rows merged
     """
-    mcur = master.cursor()
-    pcur = part.cursor()
-
     logger.debug("Merging databases...")
-    tables = get_table_list(part)
-    for table in tables:
-        cols = get_table_columns(part, table)
-        pcur.execute("SELECT * FROM '%s'" % table)
-        rows = pcur.fetchall()
-        if rows:
-            try:
-                logger.debug("Found   {n} rows of table '{name}' in master".format(name=table, n=rows[0][1]-1))
-            except Exception as e:
-                logging.error(e)
-            if not check_table_exists(master, table):
-                create_table(master, table, cols)
+    if rowids is None:
+        rowids = dict.fromkeys(get_table_list(part))
+    for table in rowids:
+        if not check_table_exists(master, table):
+            create_table(master, table, get_table_columns(part, table))
 
-            args = ("?," * len(cols))[:-1]
-            query = "INSERT INTO '{name}' VALUES ({args})".format(name=table, args=args)
-            mcur.executemany(query, tuple(tuple(r) for r in rows))
-            logger.debug("Merging {m} rows of table '{name}' into master".format(name=table, m=len(rows)))
-
-    master.commit()
+    with attach_database(master, get_database_path(part), 'part'):
+        try:
+            n = merge_attached_tables(master, 'part', rowids, delete=delete)
+            master.commit()
+        except sqlite3.Error:
+            master.rollback()
+            raise
+    return n
 
 
 def get_datetime_sorted_rows(dbconn, table_name, uuid=None, column=None):
@@ -244,16 +544,19 @@ def get_datetime_sorted_rows(dbconn, table_name, uuid=None, column=None):
     :param column: optional column/field in the table to pull instead of rows
     :returns: a list of tuples containing (datetime, row) pairs or (datetime, column) pairs if columns is specified.
     """
-    rows = get_rows(dbconn, table_name, uuid=uuid)
+    cursor = dbconn.cursor()
+    name = quote_identifier(table_name)
+    if uuid:
+        cursor.execute("SELECT * FROM {name} WHERE UUID=? ORDER BY \"Time\"".format(name=name), (uuid,))
+    else:
+        cursor.execute("SELECT * FROM {name} ORDER BY \"Time\"".format(name=name))
     data = []
-    for r in rows:
-        dt = datetime.datetime.strptime(r['Time'], "%d/%m/%Y %H:%M:%S")
+    for r in cursor:
+        dt = datetime.datetime.fromtimestamp(r['Time'])
         if column is None:
             data.append((dt, r))
         else:
             data.append((dt, r[column]))
-    data.sort()
-
     return data
 
 
@@ -265,7 +568,8 @@ def rename_table(dbconn, original, new):
     :param new: new table name
     """
     cur = dbconn.cursor()
-    cur.execute("ALTER TABLE '{original}' RENAME TO '{new}'".format(original=original, new=new))
+    cur.execute("ALTER TABLE {original} RENAME TO {new}".format(original=quote_identifier(original),
+                                                                new=quote_identifier(new)))
 
 
 def login_hq(host, user, passwd, path='', acct='', port=21, timeout=5):
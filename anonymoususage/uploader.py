@@ -0,0 +1,109 @@
+__author__ = 'calvin'
+
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('AnonymousUsage')
+
+
+class Uploader(object):
+    """
+    Sends uploads to the HQ over a persistent HTTP session, so the TCP/TLS connection is reused between uploads.
+
+    Failed requests are retried with exponential backoff and full jitter. After `failure_threshold` consecutive failed
+    uploads the circuit opens and uploads are refused for `cooldown_s` seconds, after which a single upload is let
+    through to probe the HQ.
+    """
+
+    def __init__(self, host, timeout=10, retries=2, backoff_s=1., max_backoff_s=30., failure_threshold=3,
+                 cooldown_s=600.):
+        """
+        :param host: address of the HQ
+        :param timeout: timeout of each request in seconds
+        :param retries: number of times a failed request is retried
+        :param backoff_s: delay limit before the first retry, doubled on every following retry
+        :param max_backoff_s: highest delay limit between retries
+        :param failure_threshold: number of consecutive failed uploads that open the circuit
+        :param cooldown_s: number of seconds the circuit stays open
+        """
+        self.host = host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.failure_threshold = failure_threshold
+        self.cooldown_s = cooldown_s
+        self.failures = 0
+        self._open_until = 0
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @property
+    def is_open(self):
+        """
+        True while uploads are refused because the HQ has failed too many times in a row.
+        """
+        return time.time() < self._open_until
+
+    def backoff(self, attempt):
+        """
+        Number of seconds to wait before retry number `attempt` (starting at 1).
+        """
+        limit = min(self.max_backoff_s, self.backoff_s * 2 ** (attempt - 1))
+        return random.uniform(0, limit)
+
+    def post(self, path, data, headers=None):
+        """
+        Post data to the HQ, retrying on connection errors, timeouts and server errors.
+        :param path: path on the HQ
+        :param data: request body
+        :param headers: optional dictionary of request headers
+        :return: True if the HQ responded with 200 OK
+        """
+        if self.is_open:
+            logger.debug('HQ upload skipped, {n} consecutive uploads failed.'.format(n=self.failures))
+            return False
+
+        url = self.host + path
+        for attempt in xrange(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff(attempt))
+            try:
+                response = self.session.post(url, data=data, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                logger.error(e)
+                continue
+            if response.status_code == 200:
+                self._record(True)
+                return True
+            logger.error('HQ responded to upload with status {code}'.format(code=response.status_code))
+            if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                # The request itself was rejected, sending it again will not help
+                break
+
+        self._record(False)
+        return False
+
+    def _record(self, success):
+        with self._lock:
+            if success:
+                self.failures = 0
+                self._open_until = 0
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    logger.warning('Pausing HQ uploads for {t} seconds after {n} failed uploads.'.format(
+                        t=self.cooldown_s, n=self.failures))
+                    self._open_until = time.time() + self.cooldown_s
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,197 @@
+__author__ = 'calvin'
+
+import logging
+import select
+import socket
+import sys
+import threading
+import Queue
+
+from .exceptions import FutureTimeoutError
+
+logger = logging.getLogger('AnonymousUsage')
+
+
+class Future(object):
+    """
+    The result of a call that runs on a Worker. Mirrors the parts of concurrent.futures.Future that the tracker uses.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._running = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        """
+        True once the call has finished.
+        """
+        return self._done
+
+    def running(self):
+        """
+        True while the call is executing.
+        """
+        return self._running
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to finish and return its result. Exceptions raised by the call are raised again here.
+        :param timeout: maximum number of seconds to wait, None to wait forever
+        """
+        self._wait(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the call to finish and return the exception it raised, or None.
+        :param timeout: maximum number of seconds to wait, None to wait forever
+        """
+        self._wait(timeout)
+        return self._exc_info[1] if self._exc_info else None
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(future) once the call has finished, right away if it already has.
+        """
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise FutureTimeoutError(timeout)
+
+    def _run(self, func, args, kwargs):
+        self._running = True
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self._finish(None, sys.exc_info())
+        else:
+            self._finish(result, None)
+
+    def _finish(self, result, exc_info):
+        with self._condition:
+            self._result = result
+            self._exc_info = exc_info
+            self._running = False
+            self._done = True
+            self._condition.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logger.error(e)
+
+
+class Worker(object):
+    """
+    Runs calls one at a time on a daemon thread, which is started with the first call.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) to run on the worker thread.
+        :return: Future of the call's result
+        """
+        future = Future()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._queue.put((future, func, args, kwargs))
+        return future
+
+    def stop(self, timeout=None):
+        """
+        Stop the worker thread once the queued calls have run.
+        :param timeout: maximum number of seconds to wait for the thread to stop, None to wait forever
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._queue.put(None)
+        thread.join(timeout)
+
+    def _run(self):
+        while 1:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, func, args, kwargs = item
+            future._run(func, args, kwargs)
+
+
+def socketpair():
+    """
+    Return a pair of connected sockets. socket.socketpair is not available on Windows in Python 2, so a loopback
+    connection is used there instead.
+    """
+    try:
+        return socket.socketpair()
+    except AttributeError:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            client = socket.create_connection(listener.getsockname())
+            server, _ = listener.accept()
+        finally:
+            listener.close()
+        return server, client
+
+
+class Waiter(object):
+    """
+    Lets a thread sleep until another thread calls notify() or a timeout passes. In Python 2,
+    threading.Condition.wait(timeout) polls every few milliseconds, whereas the Waiter blocks in select() and does not
+    wake until it has to. A notify() that arrives while no thread is waiting makes the next wait() return right away.
+    """
+
+    def __init__(self):
+        self._recv, self._send = socketpair()
+        self._recv.setblocking(False)
+
+    def wait(self, timeout=None):
+        """
+        Block until notified or until `timeout` seconds have passed.
+        :return: True if notified
+        """
+        readable = select.select([self._recv], [], [], timeout)[0]
+        if readable:
+            try:
+                self._recv.recv(4096)
+            except socket.error:
+                pass
+        return bool(readable)
+
+    def notify(self):
+        try:
+            self._send.send('\0')
+        except socket.error:
+            # The socket buffer is full of notifications the waiting thread has not read yet
+            pass
+
+    def close(self):
+        self._recv.close()
+        self._send.close()
@@ -0,0 +1,97 @@
+"""
+Measure how often threads can read a tracker while other threads write to it.
+
+Writer threads each increment their own Statistic. Every increment inserts a row into the partial database, which is
+committed with synchronous=FULL. Reader threads at the same time ask a Timer for the percentiles of its durations, as
+the REST API does, which only needs the lock of the Timer. The same workload is run twice:
+
+    global          every table and connection share one lock, as with the former class-level Table.lock
+    fine-grained    the tracker's per-table and per-database locks
+
+SQLite allows one writer per database, so the rows/s of the writers are about the same either way: every write to a
+database still holds that database's lock. What the per-table locks change is that readers of other tables no longer
+wait for those writes.
+
+    python benchmarks/lock_contention.py [seconds]
+"""
+__author__ = 'calvin'
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from anonymoususage import AnonymousUsageTracker
+
+N_READERS = 2
+PRAGMAS = {'synchronous': 'FULL'}
+
+
+def create_tracker(path, n_writers):
+    tracker = AnonymousUsageTracker('benchmark', path, submit_interval_s=3600, sqlite_pragmas=PRAGMAS)
+    tracker.track_time('timer')
+    for i in xrange(10):
+        tracker['timer'].start_timer()
+        tracker['timer'].stop_timer()
+    for i in xrange(n_writers):
+        tracker.track_statistic('stat%d' % i)
+    return tracker
+
+
+def run(n_writers, duration, global_lock):
+    """
+    :return: rows written per second, percentile reads per second
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tracker = create_tracker(os.path.join(tmpdir, 'benchmark.db'), n_writers)
+        if global_lock:
+            lock = threading.RLock()
+            tracker.db_lock = lambda dbconn: lock
+            for table in tracker._tables.itervalues():
+                table.lock = lock
+
+        stop = threading.Event()
+        counts = {}
+
+        def write(name):
+            n = 0
+            while not stop.is_set():
+                tracker[name] += 1
+                n += 1
+            counts[name] = n
+
+        def read(i):
+            n = 0
+            while not stop.is_set():
+                tracker['timer'].percentile(50)
+                tracker['timer'].percentile(99)
+                n += 1
+            counts[i] = n
+
+        writers = [threading.Thread(target=write, args=('stat%d' % i,)) for i in xrange(n_writers)]
+        readers = [threading.Thread(target=read, args=(i,)) for i in xrange(N_READERS)]
+        for t in writers + readers:
+            t.start()
+        time.sleep(duration)
+        stop.set()
+        for t in writers + readers:
+            t.join()
+        tracker.close()
+        rows = sum(counts['stat%d' % i] for i in xrange(n_writers))
+        reads = sum(counts[i] for i in xrange(N_READERS))
+        return rows / duration, reads / duration
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    print '{:>8} {:>14} {:>15} {:>14} {:>15}'.format('writers', 'global rows/s', 'global reads/s',
+                                                     'fine rows/s', 'fine reads/s')
+    for n_writers in (1, 2, 4, 8):
+        results = run(n_writers, duration, True) + run(n_writers, duration, False)
+        print '{:>8} {:>14.0f} {:>15.0f} {:>14.0f} {:>15.0f}'.format(n_writers, *results)
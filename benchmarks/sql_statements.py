@@ -0,0 +1,56 @@
+"""
+Compare the cost of SQL statements built from Python literals, which sqlite3 has to parse and prepare on every call,
+against the parameterized statements used by anonymoususage.tools, which are prepared once per table and then reused
+from the connection's statement cache. Every literal INSERT carries different values, so its SQL text never matches a
+cached statement.
+
+The database is held in memory so the numbers reflect statement preparation rather than disk I/O.
+
+    python benchmarks/sql_statements.py [number_of_rows]
+"""
+__author__ = 'calvin'
+
+import datetime
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from anonymoususage.tools import create_table, insert_row
+
+TIME_FMT = "%d/%m/%Y %H:%M:%S"
+COLUMNS = ("UUID", "INTEGER"), ("Count", "REAL"), ("Time", "TEXT")
+
+
+def literal_insert(dbconn, n):
+    dt = datetime.datetime.now().strftime(TIME_FMT)
+    for i in xrange(n):
+        args = ('benchmark', float(i), dt)
+        dbconn.execute("INSERT INTO 'stat' VALUES{args}".format(args=args))
+        dbconn.commit()
+
+
+def parameterized_insert(dbconn, n):
+    dt = datetime.datetime.now().strftime(TIME_FMT)
+    for i in xrange(n):
+        insert_row(dbconn, 'stat', 'benchmark', float(i), dt)
+
+
+def run(func, n):
+    dbconn = sqlite3.connect(':memory:')
+    create_table(dbconn, 'stat', COLUMNS)
+    t0 = time.time()
+    func(dbconn, n)
+    elapsed = time.time() - t0
+    dbconn.close()
+    return elapsed
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print 'Inserting {n} rows'.format(n=n)
+    t_literal = run(literal_insert, n)
+    t_param = run(parameterized_insert, n)
+    print '{:<22} {:8.1f} us/row'.format('literal SQL', 1e6 * t_literal / n)
+    print '{:<22} {:8.1f} us/row ({:.2f}x faster)'.format('parameterized SQL', 1e6 * t_param / n, t_literal / t_param)
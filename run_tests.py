@@ -7,8 +7,21 @@ from pprint import pprint
 from unit_tests.statistic import StatisticTests
 from unit_tests.state import StateTests
 from unit_tests.sequence import SequenceTests
+from unit_tests.buffer import BufferTests
+from unit_tests.table import TableTests
+from unit_tests.tracker import TrackerTests
+from unit_tests.submission import SubmissionTests
+from unit_tests.uploader import UploaderTests
+from unit_tests.worker import WorkerTests
+from unit_tests.storage import StorageTests, LogStorageTests
+from unit_tests.rollup import RollupTests
+from unit_tests.sketch import SketchTests
+from unit_tests.analysis import AnalysisTests
+from unit_tests.server import ServerTests
 
-RUN_TESTS = [StatisticTests, StateTests, SequenceTests]
+RUN_TESTS = [StatisticTests, StateTests, SequenceTests, BufferTests, TableTests, TrackerTests, SubmissionTests, UploaderTests, WorkerTests,
+             StorageTests, LogStorageTests, RollupTests, SketchTests, AnalysisTests,
+             ServerTests]
 
 total_errors = 0
 total_failures = 0
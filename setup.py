@@ -7,7 +7,7 @@ from anonymoususage import __version__
 
 setup(
     name='anonymoususage',
-    packages=['anonymoususage', 'anonymoususage.tables'],  # this must be the same as the name above
+    packages=['anonymoususage', 'anonymoususage.tables', 'anonymoususage.analysis'],  # this must be the same as the name above
     version=__version__,
     description='Anonymously track user usage patterns and statistics.',
     author='Calvin Lobo',
@@ -16,5 +16,6 @@ setup(
     download_url='https://github.com/lobocv/anonymoususage/tarball/%s' % __version__,
     keywords=['logging', 'usage', 'tracking', 'statistics', 'anonymous'],
     classifiers=[],
-    install_requires=['requests==2.8.1', 'cherrypy==8.1.2']
+    install_requires=['requests==2.8.1', 'cherrypy==8.1.2'],
+    extras_require={'analysis': ['numpy'], 'plot': ['numpy', 'matplotlib']}
 )
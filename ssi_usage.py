@@ -1,11 +1,9 @@
 __author__ = 'calvin'
 
 from anonymoususage.analysis import plot_statistic, plot_total_statistics, plot_state, plot_timer
-from anonymoususage.analysis import DataManager, DataBase
-import sqlite3
+from anonymoususage.analysis import DataManager
 import datetime
 import logging
-import os
 from anonymoususage import tools
 
 logger = logging.basicConfig(level=logging.DEBUG)
@@ -14,11 +12,8 @@ interval = datetime.timedelta(seconds=1)
 dm = DataManager(config='anonymoususage.cfg')
 dm.consolidate_individuals(delete_parts=True)
 dm.consolidate_into_master()
-if os.path.exists('./master.db'):
-    os.remove('./master.db')
-dm.download_master('./master.db')
 
-db = sqlite3.connect('./master.db', factory=DataBase)
+db = dm.open_master()
 db.rename_table('total_line_length_m', 'line_length_m')
 db.rename_table('total_line_length_m', 'power_cycles')
 db.rename_table('total_line_collection_time', 'line_collection_time')
@@ -0,0 +1,189 @@
+import datetime
+import os
+import sqlite3
+import tempfile
+import shutil
+import unittest
+
+import numpy as np
+
+from anonymoususage.analysis import *
+from anonymoususage.tools import create_table, insert_row, to_epoch, get_uuid_list
+
+
+class AnalysisTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.tmpdir, 'user%d.db' % i) for i in xrange(2)]
+        for i, path in enumerate(self.paths):
+            dbconn = sqlite3.connect(path)
+            create_table(dbconn, 'Statistic', (('UUID', 'TEXT'), ('Count', 'INTEGER'), ('Time', 'REAL')))
+            create_table(dbconn, 'State', (('UUID', 'TEXT'), ('Count', 'INTEGER'), ('State', 'TEXT'),
+                                           ('Time', 'REAL')))
+            uuid = 'user%d' % i
+            for count, t in ((1, 100.), (3, 110.), (4, 130.)):
+                insert_row(dbconn, 'Statistic', uuid, count, t + i)
+            for count, (state, t) in enumerate((('a', 100.), ('b', 160.), ('a', 190.)), 1):
+                insert_row(dbconn, 'State', uuid, count, state, t)
+            dbconn.close()
+        self.db = DataManager.open(self.paths[0])
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_load(self):
+        data = self.db.load('Statistic')
+        self.assertEqual(len(data), 3)
+        self.assertEqual(data.uuids.tolist(), ['user0'])
+        np.testing.assert_array_equal(data.times, [100., 110., 130.])
+        self.assertEqual(len(self.db.load('Statistic', since=105, until=130)), 1)
+        self.assertIsNone(self.db.load('Statistic').states)
+
+    def test_load_text_times(self):
+        # Databases written by older versions store day-first local times as text
+        path = os.path.join(self.tmpdir, 'legacy.db')
+        dbconn = sqlite3.connect(path)
+        create_table(dbconn, 'Statistic', (('UUID', 'TEXT'), ('Count', 'INTEGER'), ('Time', 'TEXT')))
+        for count, t in enumerate(('01/03/2016 12:00:00', '15/03/2016 12:00:00', '01/04/2016 12:00:00'), 1):
+            insert_row(dbconn, 'Statistic', 'legacy', count, t)
+        dbconn.close()
+        db = DataManager.open(path)
+        try:
+            since, until = datetime.datetime(2016, 3, 10), datetime.datetime(2016, 3, 20)
+            self.assertEqual(db.load('Statistic', since=since).counts.tolist(), [2., 3.])
+            self.assertEqual(db.load('Statistic', until=until).counts.tolist(), [1., 2.])
+            self.assertEqual(db.load('Statistic').times[0], to_epoch(datetime.datetime(2016, 3, 1, 12)))
+        finally:
+            db.close()
+
+    def test_diffs_and_rates(self):
+        data = self.db.load('Statistic')
+        np.testing.assert_array_equal(diffs(data), [1., 2., 1.])
+        np.testing.assert_array_equal(rates(data)[1:], [0.2, 0.05])
+        self.assertTrue(np.isnan(rates(data)[0]))
+
+    def test_resample(self):
+        data = self.db.load('Statistic')
+        starts, values = resample(data.times, diffs(data), 20, start=100, end=140)
+        np.testing.assert_array_equal(starts, [100., 120.])
+        np.testing.assert_array_equal(values, [3., 1.])
+        self.assertEqual(resample(data.times, data.counts, 20, start=100, end=140, how='last')[1].tolist(), [3., 4.])
+        self.assertRaises(ValueError, resample, data.times, data.counts, 20, how='median')
+
+    def test_state_dwell_times(self):
+        data = self.db.load('State')
+        self.assertEqual(data.states.tolist(), ['a', 'b'])
+        self.assertEqual(state_dwell_times(data), {'a': 60., 'b': 30.})
+        self.assertEqual(state_dwell_times(data, end=200), {'a': 70., 'b': 30.})
+        self.assertRaises(ValueError, state_dwell_times, self.db.load('Statistic'))
+
+    def test_manager(self):
+        manager = DataManager(self.tmpdir)
+        self.assertEqual(manager.databases(), self.paths)
+        data = manager.load('Statistic')
+        self.assertEqual(data.uuids.tolist(), ['user0', 'user1'])
+        self.assertEqual(len(data.for_uuid('user1')), 3)
+        uuids, counts = totals(data)
+        self.assertEqual(dict(zip(uuids.tolist(), counts.tolist())), {'user0': 4., 'user1': 4.})
+        np.testing.assert_array_equal(diffs(data), [1., 2., 1.] * 2)
+        self.assertIsNone(manager.load('Missing'))
+
+    def test_uuid_list_many_tables(self):
+        for i in xrange(600):
+            create_table(self.db, 'T%d' % i, (('UUID', 'TEXT'), ('Count', 'INTEGER'), ('Time', 'REAL')))
+        insert_row(self.db, 'T599', 'user9', 1, 100.)
+        self.assertEqual(get_uuid_list(self.db), {'user0', 'user9'})
+
+    def test_database(self):
+        self.assertEqual(self.db.get_uuid_list(), {'user0'})
+        self.assertTrue(self.db.rename_table('Statistic', 'Renamed'))
+        self.assertFalse(self.db.rename_table('Statistic', 'Renamed'))
+        self.assertEqual(sorted(self.db.get_table_list()), ['Renamed', 'State'])
+
+    def _write_part(self, name, rows):
+        dbconn = sqlite3.connect(os.path.join(self.tmpdir, name))
+        create_table(dbconn, 'Statistic', (('UUID', 'TEXT'), ('Count', 'INTEGER'), ('Time', 'REAL')))
+        for row in rows:
+            insert_row(dbconn, 'Statistic', *row)
+        dbconn.close()
+
+    def test_consolidate_individuals(self):
+        self._write_part('user2_1.db', [('user2', 1, 100.), ('user2', 2, 110.)])
+        self._write_part('user2_2.db', [('user2', 2, 110.), ('user2', 3, 120.)])
+        manager = DataManager(self.tmpdir)
+        self.assertEqual(manager.consolidate_individuals(delete_parts=True, processes=1), 3)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['user0.db', 'user1.db', 'user2.db'])
+        self.assertEqual(manager.load('Statistic').for_uuid('user2').counts.tolist(), [1., 2., 3.])
+
+    def test_consolidate_into_master(self):
+        shutil.copy(self.paths[0], os.path.join(self.tmpdir, 'copy.db'))
+        manager = DataManager(self.tmpdir)
+        self.assertEqual(manager.consolidate_into_master(processes=1), 12)
+        # Rows already in the master database are skipped
+        self.assertEqual(manager.consolidate_into_master(processes=1), 0)
+        master = manager.open_master()
+        try:
+            self.assertEqual(master.get_uuid_list(), {'user0', 'user1'})
+            self.assertEqual(len(master.load('Statistic')), 6)
+            indexes = [r[1] for r in master.execute("PRAGMA index_list(Statistic)")]
+            self.assertIn('Statistic_UUID', indexes)
+        finally:
+            master.close()
+
+    def test_consolidate_does_not_modify_inputs(self):
+        path = os.path.join(self.tmpdir, 'legacy.db')
+        dbconn = sqlite3.connect(path)
+        create_table(dbconn, 'Statistic', (('UUID', 'TEXT'), ('Count', 'INTEGER'), ('Time', 'TEXT')))
+        insert_row(dbconn, 'Statistic', 'legacy', 1, '01/03/2016 12:00:00')
+        dbconn.close()
+        with open(path, 'rb') as f:
+            contents = f.read()
+        os.chmod(path, 0o444)
+
+        manager = DataManager(self.tmpdir)
+        # The master database has the table already, but no UUID index
+        master = sqlite3.connect(manager.master_path)
+        create_table(master, 'Statistic', (('UUID', 'TEXT'), ('Count', 'INTEGER'), ('Time', 'REAL')))
+        master.close()
+        self.assertEqual(manager.consolidate_into_master(processes=1), 13)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+
+        master = manager.open_master()
+        try:
+            self.assertEqual(master.load('Statistic').for_uuid('legacy').times.tolist(),
+                             [to_epoch(datetime.datetime(2016, 3, 1, 12))])
+            indexes = [r[1] for r in master.execute("PRAGMA index_list(Statistic)")]
+            self.assertIn('Statistic_UUID', indexes)
+        finally:
+            master.close()
+
+    def test_consolidate_parallel(self):
+        for i in xrange(2, 6):
+            self._write_part('user%d.db' % i, [('user%d' % i, 1, 100.), ('user%d' % i, 2, 110.)])
+        manager = DataManager(self.tmpdir)
+        self.assertEqual(manager.consolidate_into_master(delete=True, processes=3), 20)
+        self.assertEqual(os.listdir(self.tmpdir), ['master.db'])
+        master = manager.open_master()
+        self.assertEqual(len(master.get_uuid_list()), 6)
+        master.close()
+
+    def test_query(self):
+        self._write_part('user2_1.db', [('user2', 1, 100.), ('user2', 5, 110.)])
+        self._write_part('user2_2.db', [('user2', 6, 120.)])
+        with open(os.path.join(self.tmpdir, 'corrupt.db'), 'wb') as f:
+            f.write('not a database' * 100)
+        manager = DataManager(self.tmpdir)
+        result = manager.query(LastCount('Statistic'), processes=1)
+        self.assertEqual(result.values, {'user0': 4, 'user1': 4, 'user2': 6})
+        self.assertEqual(result.value, 14)
+        self.assertEqual(sorted(result.timings), manager.databases())
+        self.assertEqual(result.errors.keys(), [os.path.join(self.tmpdir, 'corrupt.db')])
+        self.assertEqual(len(result.slowest(2)), 2)
+
+        self.assertEqual(manager.query(RowCount('Statistic'), 'mean', processes=2).value, 3.)
+        counts, edges = manager.query(LastCount('Statistic'), 'histogram', processes=2, bins=2).value
+        self.assertEqual(counts.tolist(), [2, 1])
+        self.assertIsNone(manager.query(LastCount('Missing'), processes=1).value)
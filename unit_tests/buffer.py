@@ -0,0 +1,48 @@
+import os
+
+from anonymoususage import AnonymousUsageTracker
+from anonymoususage.tools import get_number_of_rows
+from . import AnonymousUsageTests
+
+
+class BufferTests(AnonymousUsageTests):
+
+    def setUp(self):
+        super(BufferTests, self).setUp()
+        trackerfile = os.path.join(self.tmpdir, 'au_buffered.db')
+        self.buffered = AnonymousUsageTracker('UnitTests', trackerfile, buffer_size=10)
+        self.buffered.track_statistic('Statistic')
+        self.buffered.track_state('State', 'A')
+
+    def test_rows_are_buffered(self):
+        s = self.buffered['Statistic']
+        for i in xrange(5):
+            s += 1
+        # The count is updated right away but nothing has been written yet
+        self.assertEquals(s.count, 5)
+        self.assertEquals(get_number_of_rows(self.buffered.dbcon, 'Statistic'), 0)
+        self.assertEquals(len(self.buffered.buffer), 5)
+
+        self.assertEquals(self.buffered.flush(), 5)
+        self.assertEquals(get_number_of_rows(self.buffered.dbcon, 'Statistic'), 5)
+
+    def test_flush_on_size(self):
+        s = self.buffered['Statistic']
+        for i in xrange(12):
+            s += 1
+        self.assertEquals(get_number_of_rows(self.buffered.dbcon, 'Statistic'), 10)
+        self.assertEquals(len(self.buffered.buffer), 2)
+
+    def test_reads_include_buffered_rows(self):
+        self.buffered['Statistic'] += 1
+        self.buffered['State'] = 'B'
+        self.assertEquals(self.buffered['Statistic'].get_number_of_rows(), 1)
+        self.assertEquals(self.buffered['State'].get_last()[0]['State'], 'B')
+        self.assertEquals(self.buffered['Statistic'].get_last()[0]['Count'], 1)
+
+    def test_close_flushes(self):
+        self.buffered['Statistic'] += 1
+        self.buffered.close()
+        tracker = AnonymousUsageTracker('UnitTests', os.path.join(self.tmpdir, 'au_buffered.db'))
+        tracker.track_statistic('Statistic')
+        self.assertEquals(tracker['Statistic'].count, 1)
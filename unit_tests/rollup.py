@@ -0,0 +1,96 @@
+import os
+import tempfile
+import time
+import shutil
+import unittest
+
+from anonymoususage import AnonymousUsageTracker
+from anonymoususage.tools import check_table_exists
+
+
+class RollupTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tracker = AnonymousUsageTracker('UnitTests', os.path.join(self.tmpdir, 'au_rollup.db'), rollups=True)
+        self.tracker.track_statistic('Statistic', max_rows=2)
+        self.tracker.track_time('Timer')
+
+    def tearDown(self):
+        self.tracker.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_aggregates(self):
+        rollups = self.tracker.rollups
+        t0 = time.time() // 3600 * 3600
+        for i, value in enumerate((1, 5, 2, -3)):
+            rollups.add('Timer', value, t=t0 + i)
+        for resolution in ('minute', 'hour', 'day'):
+            rows = rollups.query('Timer', resolution)
+            self.assertEquals(len(rows), 1)
+            start, total, count, minimum, maximum = rows[0]
+            self.assertEquals((total, count, minimum, maximum), (5, 4, -3, 5))
+            self.assertEquals(start % rollups.resolution(resolution), 0)
+
+    def test_statistic_aggregates(self):
+        s = self.tracker['Statistic']
+        for value in (1, 5, 2, -3):
+            s += value
+        # The changes are added at the current time, which may fall in two buckets of a resolution
+        for resolution in ('minute', 'hour', 'day'):
+            rows = s.get_rollups(resolution)
+            self.assertEquals((sum(r['Sum'] for r in rows), sum(r['Count'] for r in rows)), (5, 4))
+            self.assertEquals(min(r['Min'] for r in rows), -3)
+            self.assertEquals(max(r['Max'] for r in rows), 5)
+        # The aggregates outlive the rows removed by max_rows
+        self.assertEquals(s.count_rows(), 2)
+
+    def test_aggregates_are_added(self):
+        rollups = self.tracker.rollups
+        t0 = time.time() // 3600 * 3600
+        rollups.add('Statistic', 2, t=t0 + 120)
+        rollups.flush()
+        rollups.add('Statistic', 4, t=t0 + 150)
+        rollups.add('Statistic', 1, t=t0 + 200)
+        rows = rollups.query('Statistic', 'minute')
+        self.assertEquals([tuple(r) for r in rows], [(t0 + 120, 6, 2, 2, 4), (t0 + 180, 1, 1, 1, 1)])
+        rows = rollups.query('Statistic', 60, since=t0 + 150)
+        self.assertEquals([tuple(r) for r in rows], [(t0 + 180, 1, 1, 1, 1)])
+        self.assertEquals([tuple(r) for r in rollups.query('Statistic', 'hour')], [(t0, 7, 3, 1, 4)])
+
+    def test_minute_end_flushes(self):
+        rollups = self.tracker.rollups
+        rollups.add('Timer', 3, t=60)
+        self.assertFalse(check_table_exists(self.tracker.dbcon_master, '__rollups__'))
+        rollups.add('Timer', 3, t=125)
+        self.assertTrue(check_table_exists(self.tracker.dbcon_master, '__rollups__'))
+        self.assertEquals(len(rollups._pending), 3)
+
+    def test_idle_flush(self):
+        rollups = self.tracker.rollups
+        rollups.add('Timer', 3)
+        # A timer writes the aggregates after the current minute ends, without waiting for another value
+        timer = rollups._timer
+        self.assertTrue(timer.is_alive())
+        self.assertTrue(1 <= timer.interval <= 61)
+        self.assertLess((time.time() + timer.interval) % 60, 2)
+        timer.function()
+        # The flush cancelled the timer
+        self.assertTrue(timer.finished.is_set())
+        self.assertEquals(rollups._pending, {})
+        self.assertIsNone(rollups._timer)
+        self.assertEquals(len(rollups.query('Timer', 'minute')), 1)
+
+    def test_retention(self):
+        rollups = self.tracker.rollups
+        rollups.add('Statistic', 1, t=60)
+        rollups.flush()
+        self.assertEquals(rollups.query('Statistic', 'minute'), [])
+        self.assertEquals(len(rollups.query('Statistic', 'day')), 1)
+
+    def test_disabled(self):
+        tracker = AnonymousUsageTracker('UnitTests', os.path.join(self.tmpdir, 'au_norollup.db'))
+        tracker.track_statistic('Statistic')
+        tracker['Statistic'] += 1
+        self.assertRaises(ValueError, tracker['Statistic'].get_rollups)
+        tracker.close()
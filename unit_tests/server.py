@@ -0,0 +1,58 @@
+import os
+import sys
+import types
+
+try:
+    import cherrypy
+except ImportError:
+    # Only the decorators of cherrypy are used by these tests, which do not start the HTTP server
+    cherrypy = types.ModuleType('cherrypy')
+    cherrypy.expose = lambda func: func
+    cherrypy.tools = types.ModuleType('cherrypy.tools')
+    cherrypy.tools.json_out = lambda: cherrypy.expose
+    cherrypy.HTTPError = Exception
+    cherrypy.lib = types.ModuleType('cherrypy.lib')
+    cherrypy.lib.auth_digest = types.ModuleType('cherrypy.lib.auth_digest')
+    sys.modules.update({'cherrypy': cherrypy, 'cherrypy.lib': cherrypy.lib,
+                        'cherrypy.lib.auth_digest': cherrypy.lib.auth_digest})
+
+from anonymoususage.api import UsageTrackerServer
+from .submission import HQTests
+
+
+class ServerTests(HQTests):
+
+    def create_server(self, **kwargs):
+        server = UsageTrackerServer('UnitTests', os.path.join(self.tmpdir, 'au_server.db'),
+                                    application_name='UnitTests', application_version='1.0', **kwargs)
+        server.setup_hq(self.host, 'api_key')
+        server._uploader.backoff_s = 0
+        server.track_statistic('Statistic')
+        return server
+
+    def test_queued_submission_uploads(self):
+        server = self.create_server()
+        server['Statistic'] += 1
+        self.assertEquals(server.submit_statistics(), 'Submitting usage statistics: Queued')
+        # The queued submission uploads rather than calling the endpoint again
+        self.assertIs(server._pending_submission.result(timeout=10), True)
+        self.assertEquals(len(self.server.payloads), 1)
+        server.close()
+
+    def test_wait(self):
+        server = self.create_server()
+        server['Statistic'] += 1
+        self.assertEquals(server.submit_statistics(wait='false'), 'Submitting usage statistics: Queued')
+        server._pending_submission.result(timeout=10)
+        self.assertEquals(server.submit_statistics(wait='true'), 'Submitting usage statistics: Success')
+        self.assertEquals(len(self.server.payloads), 2)
+        server.close()
+
+    def test_setup_hq_options(self):
+        server = self.create_server()
+        # The options arrive as strings from the query string of the request
+        self.assertEquals(server.setup_hq(self.host, 'api_key', content_encoding='none', batch_rows='10'),
+                          'HQ API key received.')
+        self.assertEquals(server._hq['batch_rows'], 10)
+        self.assertIsNone(server._hq['content_encoding'])
+        server.close()
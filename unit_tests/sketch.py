@@ -0,0 +1,78 @@
+import json
+import os
+import random
+import tempfile
+import shutil
+import unittest
+
+from anonymoususage import AnonymousUsageTracker
+from anonymoususage.sketch import QuantileSketch
+
+
+class SketchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'au_sketch.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_quantiles(self):
+        sketch = QuantileSketch(0.01)
+        rng = random.Random(0)
+        values = [rng.expovariate(0.1) for i in xrange(10000)]
+        for value in values:
+            sketch.add(value)
+        values.sort()
+        for q in (0.5, 0.95, 0.99):
+            exact = values[int(q * (len(values) - 1))]
+            self.assertAlmostEqual(sketch.quantile(q) / exact, 1, delta=0.011)
+        self.assertEquals(sketch.quantile(0), values[0])
+        self.assertEquals(sketch.quantile(1), values[-1])
+        self.assertIsNone(QuantileSketch().quantile(0.5))
+
+    def test_merge(self):
+        a, b, combined = QuantileSketch(), QuantileSketch(), QuantileSketch()
+        for i in xrange(1, 1001):
+            (a if i % 2 else b).add(i)
+            combined.add(i)
+        a.merge(b)
+        self.assertEquals(a.to_dict(), combined.to_dict())
+        self.assertRaises(ValueError, a.merge, QuantileSketch(0.05))
+
+    def test_fixed_memory(self):
+        sketch = QuantileSketch(0.01, max_buckets=64)
+        for i in xrange(-10, 10):
+            sketch.add(10. ** i)
+        self.assertLessEqual(len(sketch.buckets), 64)
+        self.assertEquals(sketch.count, 20)
+        self.assertAlmostEqual(sketch.quantile(1) / 1e9, 1, delta=0.01)
+
+    def test_serialization(self):
+        sketch = QuantileSketch()
+        for value in (0, 0.5, 3, 3, 120):
+            sketch.add(value)
+        state = json.loads(json.dumps(sketch.to_dict()))
+        self.assertEquals(QuantileSketch.from_dict(state).to_dict(), sketch.to_dict())
+
+    def test_timer_percentile(self):
+        tracker = AnonymousUsageTracker('UnitTests', self.path)
+        tracker.track_time('Timer')
+        timer = tracker['Timer']
+        self.assertIsNone(timer.percentile(50))
+        for seconds in (1, 2, 3, 4, 100):
+            timer.start_timer()
+            timer.paused = True
+            timer._delta_seconds = seconds
+            timer.stop_timer()
+        self.assertAlmostEqual(timer.percentile(50), 3, delta=0.03)
+        self.assertAlmostEqual(timer.percentile(100), 100, delta=1)
+        tracker.close()
+
+        # The sketch is persisted with the tracker
+        tracker = AnonymousUsageTracker('UnitTests', self.path)
+        tracker.track_time('Timer')
+        self.assertEquals(tracker['Timer'].sketch.count, 5)
+        self.assertAlmostEqual(tracker['Timer'].percentile(50), 3, delta=0.03)
+        tracker.close()
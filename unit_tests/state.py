@@ -24,3 +24,9 @@ class StateTests(AnonymousUsageTests):
         row = s.get_last()[0]
         self.assertEquals(row['State'], 'SomeOtherState')
 
+
+    def test_quoted_value(self):
+        s = self.tracker['State']
+        self.tracker['State'] = "It's a \"quoted\" state"
+        self.assertEquals(s.get_last()[0]['State'], "It's a \"quoted\" state")
+        self.assertEquals(s.get_number_of_rows(), 1)
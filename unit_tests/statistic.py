@@ -39,3 +39,14 @@ class StatisticTests(AnonymousUsageTests):
         self.assertEquals(2, nrows)
         row = s.get_last(1)[0]
         self.assertEquals(row['Count'], 50)
+
+    def test_row_count(self):
+        s = self.tracker['Statistic']
+        s.max_rows = 5
+        for i in xrange(3):
+            s += 1
+        self.assertEquals(s.get_number_of_rows(), 3)
+        self.assertEquals(s.count_rows(), 3)
+        s.delete_last()
+        self.assertEquals(s.get_number_of_rows(), s.count_rows())
+        self.assertEquals(self.tracker.get_row_count()['Statistic']['nrows'], s.get_number_of_rows())
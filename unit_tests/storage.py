@@ -0,0 +1,156 @@
+import os
+import tempfile
+import shutil
+import unittest
+
+from anonymoususage import AnonymousUsageTracker
+from anonymoususage.tables import MemoryStorage
+from anonymoususage.tools import check_table_exists, get_number_of_rows
+
+
+class StorageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tracker = AnonymousUsageTracker('UnitTests', os.path.join(self.tmpdir, 'au_storage.db'), storage='memory')
+        self.tracker.track_statistic('Statistic')
+        self.tracker.track_state('State', 'A')
+        self.tracker.track_time('Timer')
+
+    def tearDown(self):
+        self.tracker.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_rows_kept_in_memory(self):
+        s = self.tracker['Statistic']
+        for i in xrange(3):
+            s += 1
+        self.assertEquals(s.count_rows(), 3)
+        self.assertEquals([r['Count'] for r in s.get_rows()], [1, 2, 3])
+        self.assertEquals(s.get_first()[0]['Count'], 1)
+        self.assertEquals([r['Count'] for r in s.get_last(2)], [3, 2])
+        self.assertFalse(check_table_exists(self.tracker.dbcon, 'Statistic'))
+
+    def test_max_rows(self):
+        s = self.tracker['Statistic']
+        s.max_rows = 3
+        for i in xrange(8):
+            s += 1
+        self.assertEquals(s.get_number_of_rows(), 3)
+        self.assertEquals(s.count_rows(), 3)
+        self.assertEquals([r['Count'] for r in s.get_rows()], [6, 7, 8])
+
+    def test_delete_last(self):
+        s = self.tracker['Statistic']
+        for i in xrange(3):
+            s += 1
+        s.delete_last()
+        self.assertEquals(s.count_rows(), 2)
+        self.assertEquals(s.get_count(), 2)
+
+    def test_state(self):
+        self.tracker['State'] = 'B'
+        self.assertEquals(self.tracker['State'].get_last()[0]['State'], 'B')
+
+    def test_rows_between(self):
+        s = self.tracker['Statistic']
+        for i in xrange(3):
+            s += 1
+        times = [r['Time'] for r in s.get_rows()]
+        self.assertEquals([r['Count'] for r in s.get_rows_between(times[1])], [2, 3])
+        self.assertEquals([r['Count'] for r in s.get_rows_between(until=times[1])], [1])
+
+    def test_delta(self):
+        storage = self.tracker.storage
+        s = self.tracker['Statistic']
+        for i in xrange(3):
+            s += 1
+        watermarks = {}
+        delta, rowids = storage.collect_delta(watermarks)
+        self.assertEquals(delta['Statistic']['columns'], ['UUID', 'Count', 'Time'])
+        self.assertEquals([r[1] for r in delta['Statistic']['rows']], [1, 2, 3])
+        storage.merge({'Statistic': rowids['Statistic'][-1]}, watermarks)
+        s += 1
+        self.assertEquals(storage.count_since('Statistic', watermarks['Statistic']), 1)
+        delta, rowids = storage.collect_delta(watermarks)
+        self.assertEquals([r[1] for r in delta['Statistic']['rows']], [4])
+
+    def test_rowids_not_reused(self):
+        storage = MemoryStorage()
+        storage.create('Table', [('Count', 'REAL')])
+        for i in xrange(3):
+            storage.append('Table', (i,))
+        storage.delete_last('Table')
+        storage.append('Table', (3,))
+        self.assertEquals([rowid for rowid, _ in storage.iter_since('Table', 0)], [1, 2, 4])
+        self.assertEquals(storage.max_rowid('Table'), 4)
+
+
+class LogStorageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'au_log.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create_tracker(self, **kwargs):
+        tracker = AnonymousUsageTracker('UnitTests', self.path, storage='log', **kwargs)
+        tracker.track_statistic('Statistic')
+        tracker.track_time('Timer')
+        tracker.track_state('State', 'A')
+        return tracker
+
+    def test_rows_are_logged(self):
+        tracker = self.create_tracker()
+        storage = tracker.storage
+        for i in xrange(3):
+            tracker['Statistic'] += 1
+        tracker['State'] = 'B'
+        self.assertEquals(storage._n_records, 3)
+        self.assertEquals(get_number_of_rows(tracker.dbcon, 'Statistic'), 0)
+        self.assertEquals(get_number_of_rows(tracker.dbcon, 'State'), 1)
+        self.assertEquals([r['Count'] for r in tracker['Statistic'].get_rows()], [1, 2, 3])
+        self.assertEquals(storage._n_records, 0)
+        tracker.close()
+
+    def test_timer(self):
+        tracker = self.create_tracker()
+        timer = tracker['Timer']
+        timer.start_timer()
+        elapsed = timer.stop_timer()
+        self.assertEquals(tracker.storage._n_records, 1)
+        self.assertEquals(timer.get_last()[0]['Count'], elapsed)
+        tracker.close()
+
+    def test_segment_full(self):
+        tracker = self.create_tracker()
+        tracker.storage.capacity = 4
+        for i in xrange(6):
+            tracker['Statistic'] += 1
+        self.assertEquals(tracker.storage._n_records, 2)
+        self.assertEquals(get_number_of_rows(tracker.dbcon, 'Statistic'), 4)
+        tracker.close()
+
+    def test_max_rows_at_compaction(self):
+        tracker = self.create_tracker()
+        s = tracker['Statistic']
+        s.max_rows = 3
+        for i in xrange(8):
+            s += 1
+        self.assertEquals(s.get_number_of_rows(), 3)
+        self.assertEquals(tracker.storage._evictions['Statistic'], 5)
+        self.assertEquals([r['Count'] for r in s.get_rows()], [6, 7, 8])
+        tracker.close()
+
+    def test_recovered_after_crash(self):
+        tracker = self.create_tracker()
+        for i in xrange(3):
+            tracker['Statistic'] += 1
+        tracker.storage._mmap.flush()
+        # Reopen without closing, as if the process had died
+        tracker = self.create_tracker()
+        self.assertEquals(tracker['Statistic'].count, 3)
+        self.assertEquals(tracker['Statistic'].count_rows(), 3)
+        tracker.close()
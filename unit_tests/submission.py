@@ -0,0 +1,441 @@
+import os
+import sqlite3
+import json
+import threading
+import time
+import zlib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from anonymoususage import AnonymousUsageTracker
+from anonymoususage.submission import load_watermarks
+from anonymoususage.tools import create_table, insert_rows, get_number_of_rows, merge_databases
+from . import AnonymousUsageTests
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class HQHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the HQ server that records the payload of every upload.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length')))
+        self.server.connections.add(self.client_address)
+        encoding = self.headers.getheader('Content-Encoding')
+        self.server.encodings.append(encoding)
+        if encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+
+        if self.server.statuses:
+            status = self.server.statuses.pop(0)
+        elif self.server.accept == 0:
+            status = 503
+        else:
+            status = 200
+            if self.server.accept is not None:
+                self.server.accept -= 1
+        if status == 200:
+            self.server.payloads.append(json.loads(body))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class HQTests(AnonymousUsageTests):
+    """
+    Tests that run against a local HQ stand-in server.
+    """
+
+    def setUp(self):
+        super(HQTests, self).setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), HQHandler)
+        self.server.payloads = []
+        self.server.encodings = []
+        self.server.connections = set()
+        # Status codes to respond with before the default response
+        self.server.statuses = []
+        # Number of uploads to acknowledge before failing, None to acknowledge all of them
+        self.server.accept = None
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.host = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(HQTests, self).tearDown()
+
+
+class SubmissionTests(HQTests):
+
+    def create_tracker(self, hq_params=None, **kwargs):
+        tracker = AnonymousUsageTracker('UnitTests', os.path.join(self.tmpdir, 'au_submission.db'),
+                                        application_name='UnitTests', application_version='1.0', **kwargs)
+        tracker.setup_hq(self.host, 'api_key', **(hq_params or {}))
+        tracker._uploader.backoff_s = 0
+        tracker.track_statistic('Statistic')
+        return tracker
+
+    def test_only_new_rows_are_submitted(self):
+        tracker = self.create_tracker(submit_interval_s=3600)
+        for i in xrange(3):
+            tracker['Statistic'] += 1
+        self.assertTrue(tracker.submit_statistics())
+        data = self.server.payloads[-1]['Data']['Statistic']
+        self.assertEquals(len(data['rows']), 3)
+        self.assertEquals(data['data'], 3)
+
+        # Submitted rows are moved into the master database
+        self.assertEquals(get_number_of_rows(tracker.dbcon_part, 'Statistic'), 0)
+        self.assertEquals(get_number_of_rows(tracker.dbcon_master, 'Statistic'), 3)
+
+        tracker['Statistic'] += 1
+        self.assertTrue(tracker.submit_statistics())
+        data = self.server.payloads[-1]['Data']['Statistic']
+        self.assertEquals(len(data['rows']), 1)
+        self.assertEquals(data['rows'][0][data['columns'].index('Count')], 4)
+        self.assertEquals(get_number_of_rows(tracker.dbcon_master, 'Statistic'), 4)
+
+        # Nothing new to send
+        self.assertTrue(tracker.submit_statistics())
+        self.assertNotIn('rows', self.server.payloads[-1]['Data']['Statistic'])
+        tracker.close()
+
+    def test_watermarks_persist(self):
+        tracker = self.create_tracker()
+        for i in xrange(2):
+            tracker['Statistic'] += 1
+        self.assertTrue(tracker.submit_statistics())
+        self.assertEquals(load_watermarks(tracker.dbcon)['Statistic'], 2)
+        tracker.close()
+
+        tracker = self.create_tracker()
+        tracker['Statistic'] += 1
+        self.assertTrue(tracker.submit_statistics())
+        data = self.server.payloads[-1]['Data']['Statistic']
+        self.assertEquals(len(data['rows']), 1)
+        self.assertEquals(data['data'], 3)
+        tracker.close()
+
+    def test_compression(self):
+        for encoding in ('gzip', 'deflate', 'none'):
+            tracker = self.create_tracker(hq_params={'content_encoding': encoding})
+            tracker['Statistic'] += 1
+            self.assertTrue(tracker.submit_statistics())
+            self.assertEquals(self.server.encodings[-1], None if encoding == 'none' else encoding)
+            self.assertEquals(len(self.server.payloads[-1]['Data']['Statistic']['rows']), 1)
+            tracker.close()
+
+    def test_batches(self):
+        tracker = self.create_tracker(hq_params={'batch_rows': 4}, submit_interval_s=3600)
+        for i in xrange(10):
+            tracker['Statistic'] += 1
+        self.assertTrue(tracker.submit_statistics())
+        # 10 Statistic rows and 1 __submissions__ row
+        self.assertEquals(len(self.server.payloads), 3)
+        self.assertEquals([p['Batch'] for p in self.server.payloads], [1, 2, 3])
+        self.assertEquals(sum(len(p['Data'].get('Statistic', {}).get('rows', [])) for p in self.server.payloads), 10)
+        for payload in self.server.payloads:
+            self.assertTrue(sum(len(d.get('rows', [])) for d in payload['Data'].itervalues()) <= 4)
+        self.assertEquals(get_number_of_rows(tracker.dbcon_part, 'Statistic'), 0)
+        self.assertEquals(get_number_of_rows(tracker.dbcon_master, 'Statistic'), 10)
+        tracker.close()
+
+    def test_acknowledged_batches_are_not_resent(self):
+        tracker = self.create_tracker(hq_params={'batch_rows': 4}, submit_interval_s=3600)
+        for i in xrange(10):
+            tracker['Statistic'] += 1
+        self.server.accept = 1
+        self.assertFalse(tracker.submit_statistics())
+        # The first batch was merged, the rest stay in the partial database
+        self.assertEquals(get_number_of_rows(tracker.dbcon_master, 'Statistic'), 4)
+        self.assertEquals(get_number_of_rows(tracker.dbcon_part, 'Statistic'), 6)
+
+        self.server.accept = None
+        del self.server.payloads[:]
+        self.assertTrue(tracker.submit_statistics())
+        counts = []
+        for payload in self.server.payloads:
+            data = payload['Data'].get('Statistic', {})
+            counts.extend(row[data['columns'].index('Count')] for row in data.get('rows', []))
+        self.assertEquals(counts, range(5, 11))
+        self.assertEquals(get_number_of_rows(tracker.dbcon_master, 'Statistic'), 10)
+        tracker.close()
+
+    def test_async_submission(self):
+        tracker = self.create_tracker(submit_interval_s=3600)
+        tracker['Statistic'] += 1
+        future = tracker.submit_statistics_async()
+        self.assertTrue(future.result(10))
+        self.assertEquals(len(self.server.payloads[-1]['Data']['Statistic']['rows']), 1)
+        self.assertEquals(get_number_of_rows(tracker.dbcon_master, 'Statistic'), 1)
+        tracker.close()
+
+    def test_async_submissions_are_coalesced(self):
+        tracker = self.create_tracker()
+        # Occupy the worker so that the following submissions wait in the queue
+        event = threading.Event()
+        tracker._submit_worker.submit(event.wait)
+        first = tracker.submit_statistics_async()
+        second = tracker.submit_statistics_async()
+        self.assertIs(first, second)
+        event.set()
+        self.assertTrue(first.result(10))
+        self.assertEquals(len(self.server.payloads), 1)
+        tracker.close()
+
+    def test_deferred_submission(self):
+        tracker = AnonymousUsageTracker('UnitTests', os.path.join(self.tmpdir, 'au_submission.db'),
+                                        application_name='UnitTests', application_version='1.0',
+                                        submit_interval_s=60, defer_submission=True)
+        tracker.track_statistic('Statistic')
+        tracker['Statistic'] += 1
+        # The tracker has never submitted and its database is older than the submit interval
+        os.utime(tracker.filepath, (0, 0))
+        tracker.setup_hq(self.host, 'api_key')
+        self.assertTrue(tracker._pending_submission.result(10))
+        self.assertEquals(len(self.server.payloads), 1)
+        tracker.close()
+
+    def wait_for_payloads(self, n, timeout=5):
+        t0 = time.time()
+        while len(self.server.payloads) < n and time.time() - t0 < timeout:
+            time.sleep(0.01)
+        return len(self.server.payloads) >= n
+
+    def test_watcher_stops_promptly(self):
+        tracker = self.create_tracker(submit_interval_s=3600, check_interval_s=3600)
+        watcher = tracker._watcher
+        self.assertTrue(watcher.is_alive())
+        t0 = time.time()
+        tracker.stop_watcher()
+        watcher.join(5)
+        self.assertFalse(watcher.is_alive())
+        self.assertLess(time.time() - t0, 1)
+        tracker.close()
+
+    def test_watcher_submit_threshold(self):
+        tracker = self.create_tracker(submit_interval_s=3600, check_interval_s=3600, submit_threshold=5)
+        # The registrations of the two new tables count as new rows
+        self.assertEquals(tracker._rows_since_submission, 2)
+        for i in xrange(2):
+            tracker['Statistic'] += 1
+        self.assertFalse(self.wait_for_payloads(1, timeout=0.2))
+        # The fifth row wakes the watcher long before the submit interval has passed
+        tracker['Statistic'] += 1
+        self.assertTrue(self.wait_for_payloads(1))
+        self.assertEquals(len(self.server.payloads[0]['Data']['Statistic']['rows']), 3)
+        tracker.close()
+
+    def test_watcher_waits_for_rows(self):
+        tracker = self.create_tracker(submit_interval_s=0.5, check_interval_s=3600)
+        # The registration of the tables is submitted first
+        self.assertTrue(self.wait_for_payloads(1))
+        # The next submission is due but there is nothing to submit
+        self.assertFalse(self.wait_for_payloads(2, timeout=1))
+        self.assertTrue(tracker._watcher_idle)
+        tracker['Statistic'] += 1
+        self.assertTrue(self.wait_for_payloads(2))
+        self.assertEquals(len(self.server.payloads[1]['Data']['Statistic']['rows']), 1)
+        tracker.close()
+
+    def test_failed_submission_is_not_recorded(self):
+        tracker = self.create_tracker(submit_interval_s=3600)
+        self.assertTrue(tracker.submit_statistics())
+        last_submission = tracker._last_submission_time()
+        tracker['Statistic'] += 1
+        self.server.statuses = [400]
+        self.assertFalse(tracker.submit_statistics())
+        self.assertEquals(tracker['__submissions__'].count, 1)
+        self.assertAlmostEqual(tracker._last_submission_time(), last_submission, places=2)
+        tracker.close()
+
+    def test_watcher_retries_after_check_interval(self):
+        tracker = self.create_tracker(submit_interval_s=1, check_interval_s=0.2)
+        self.assertTrue(self.wait_for_payloads(1))
+        self.server.statuses = [400]
+        tracker['Statistic'] += 1
+        while self.server.statuses:
+            time.sleep(0.01)
+        t0 = time.time()
+        # The failed submission is retried after check_interval_s rather than another submit_interval_s
+        self.assertTrue(self.wait_for_payloads(2))
+        self.assertLess(time.time() - t0, 0.7)
+        tracker.close()
+
+    def test_rows_since_submission(self):
+        tracker = self.create_tracker(submit_interval_s=3600)
+        self.assertTrue(tracker.submit_statistics())
+        self.assertEquals(tracker._rows_since_submission, 0)
+        self.assertFalse(tracker._requires_submission())
+        for i in xrange(3):
+            tracker['Statistic'] += 1
+        self.assertEquals(tracker._rows_since_submission, 3)
+        # Not due yet, the tracker just submitted
+        self.assertFalse(tracker._requires_submission())
+        tracker._last_submission -= 3601
+        self.assertTrue(tracker._requires_submission())
+        tracker.close()
+
+        # Rows that were not submitted are counted when the tracker is opened again
+        tracker = self.create_tracker(submit_interval_s=3600)
+        self.assertEquals(tracker._rows_since_submission, 3)
+        last_submission = tracker._last_submission_time()
+        self.assertLess(time.time() - last_submission, 60)
+        tracker.close()
+
+    def test_delete_last_submitted_row(self):
+        tracker = self.create_tracker(storage_mode='single')
+        for i in xrange(3):
+            tracker['Statistic'] += 1
+        delta, rowids = tracker._collect_delta()
+        tracker._advance_watermarks({'Statistic': max(rowids['Statistic'])})
+        # The ROWID of the deleted row is used again by the next row, which has not been submitted
+        tracker['Statistic'].delete_last()
+        tracker['Statistic'] += 1
+        delta, rowids = tracker._collect_delta()
+        self.assertEquals([row[1] for row in delta['Statistic']['rows']], [3])
+        tracker.close()
+
+        tracker = self.create_tracker(storage_mode='single')
+        self.assertEquals(len(tracker._collect_delta()[0]['Statistic']['rows']), 1)
+        tracker.close()
+
+    def test_delete_last_during_submission(self):
+        tracker = self.create_tracker(storage_mode='single')
+        tracker.track_time('Timer')
+        timer = tracker['Timer']
+        timer.start_timer()
+        timer.stop_timer()
+
+        def submit():
+            # A submission takes the submit lock and then the lock of the timer to read its sketch
+            with tracker._submit_lock:
+                deleting.wait(5)
+                time.sleep(0.1)
+                timer.get_sketch_state()
+
+        deleting = threading.Event()
+        submission = threading.Thread(target=submit)
+        deletion = threading.Thread(target=lambda: (deleting.set(), timer.delete_last()))
+        for thread in (submission, deletion):
+            thread.daemon = True
+            thread.start()
+        for thread in (submission, deletion):
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEquals(timer.number_of_rows, 0)
+        tracker.close()
+
+    def test_merge_is_atomic(self):
+        master = sqlite3.connect(os.path.join(self.tmpdir, 'master.db'))
+        part = sqlite3.connect(os.path.join(self.tmpdir, 'part.db'))
+        for dbconn in (master, part):
+            create_table(dbconn, 'A', [('Count', 'INTEGER')])
+        create_table(master, 'B', [('Count', 'INTEGER')])
+        # The columns of B do not match in master, so copying it fails
+        create_table(part, 'B', [('Count', 'INTEGER'), ('Time', 'TEXT')])
+        insert_rows(part, 'A', [(i,) for i in xrange(5)])
+        insert_rows(part, 'B', [(1, 'now')])
+
+        self.assertRaises(sqlite3.Error, merge_databases, master, part, {'A': None, 'B': None}, True)
+        self.assertEquals(get_number_of_rows(master, 'A'), 0)
+        self.assertEquals(get_number_of_rows(part, 'A'), 5)
+
+        self.assertEquals(merge_databases(master, part, {'A': 3}, delete=True), 3)
+        self.assertEquals(get_number_of_rows(master, 'A'), 3)
+        self.assertEquals([r[0] for r in part.execute('SELECT Count FROM A')], [3, 4])
+
+        # Repeating a merge whose rows were committed to master but not deleted from part copies nothing
+        self.assertEquals(merge_databases(master, part, {'A': None}), 2)
+        self.assertEquals(merge_databases(master, part, {'A': None}, delete=True), 0)
+        self.assertEquals(get_number_of_rows(master, 'A'), 5)
+        self.assertEquals(get_number_of_rows(part, 'A'), 0)
+        master.close()
+        part.close()
+
+    def test_single_storage_mode(self):
+        tracker = self.create_tracker(submit_interval_s=3600, storage_mode='single')
+        self.assertIsNone(tracker.dbcon_part)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'au_submission.part.db')))
+        for i in xrange(3):
+            tracker['Statistic'] += 1
+        self.assertEquals(tracker._rows_since_submission, 3)
+        self.assertTrue(tracker.submit_statistics())
+        tracker['Statistic'] += 1
+        self.assertTrue(tracker.submit_statistics())
+        self.assertEquals(len(self.server.payloads[-1]['Data']['Statistic']['rows']), 1)
+        self.assertEquals(get_number_of_rows(tracker.dbcon_master, 'Statistic'), 4)
+        self.assertEquals(tracker._rows_since_submission, 0)
+        tracker.close()
+
+    def test_timer_sketch_submitted(self):
+        tracker = self.create_tracker(submit_interval_s=3600)
+        tracker.track_time('Timer')
+        tracker['Timer'].start_timer()
+        tracker['Timer'].stop_timer()
+        self.assertTrue(tracker.submit_statistics())
+        sketch = self.server.payloads[-1]['Data']['Timer']['sketch']
+        self.assertEquals(sketch['count'], 1)
+        self.assertNotIn('sketch', self.server.payloads[-1]['Data']['Statistic'])
+        tracker.close()
+
+    def test_memory_storage(self):
+        tracker = self.create_tracker(submit_interval_s=3600, storage='memory')
+        self.assertIsNone(tracker.dbcon_part)
+        for i in xrange(3):
+            tracker['Statistic'] += 1
+        self.assertTrue(tracker.submit_statistics())
+        tracker['Statistic'] += 1
+        self.assertTrue(tracker.submit_statistics())
+        self.assertEquals(len(self.server.payloads[-1]['Data']['Statistic']['rows']), 1)
+        self.assertEquals(tracker._rows_since_submission, 0)
+        tracker.close()
+
+    def test_migrate_to_single_storage_mode(self):
+        tracker = self.create_tracker(submit_interval_s=3600)
+        for i in xrange(3):
+            tracker['Statistic'] += 1
+        self.assertTrue(tracker.submit_statistics())
+        for i in xrange(2):
+            tracker['Statistic'] += 1
+        tracker.close()
+
+        tracker = self.create_tracker(submit_interval_s=3600, storage_mode='single')
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'au_submission.part.db')))
+        self.assertEquals(get_number_of_rows(tracker.dbcon_master, 'Statistic'), 5)
+        self.assertEquals(tracker['Statistic'].count, 5)
+        self.assertEquals(tracker._rows_since_submission, 2)
+        # Only the rows that were in the partial database are submitted
+        self.assertTrue(tracker.submit_statistics())
+        data = self.server.payloads[-1]['Data']['Statistic']
+        self.assertEquals([row[data['columns'].index('Count')] for row in data['rows']], [4, 5])
+        tracker.close()
+
+    def test_split_mode_keeps_partial_database(self):
+        tracker = self.create_tracker(submit_interval_s=3600)
+        for i in xrange(2):
+            tracker['Statistic'] += 1
+        nrows = tracker._rows_since_submission
+        tracker.close()
+
+        # Without a submit interval the partial database is not used, but it is not merged either
+        tracker = self.create_tracker(submit_interval_s=0)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'au_submission.part.db')))
+        tracker.close()
+
+        tracker = self.create_tracker(submit_interval_s=3600)
+        self.assertEquals(tracker['Statistic'].count, 2)
+        self.assertEquals(tracker._rows_since_submission, nrows)
+        tracker.close()
@@ -0,0 +1,140 @@
+import datetime
+import os
+import sqlite3
+import time
+
+from anonymoususage import AnonymousUsageTracker
+from anonymoususage.tools import SCHEMA_VERSION, get_schema_version
+from . import AnonymousUsageTests
+
+
+class TableTests(AnonymousUsageTests):
+
+    def test_max_rows(self):
+        # Rows inserted within the same second must be evicted one by one
+        s = self.tracker['Statistic']
+        s.max_rows = 3
+        for i in xrange(8):
+            s += 1
+        self.assertEquals(s.get_number_of_rows(), 3)
+        self.assertEquals(s.count_rows(), 3)
+        self.assertEquals([r['Count'] for r in s.get_rows()], [6, 7, 8])
+
+    def test_eviction_slack(self):
+        self.tracker.eviction_slack = 5
+        s = self.tracker['Statistic']
+        s.max_rows = 3
+        for i in xrange(8):
+            s += 1
+        self.assertEquals(s.count_rows(), 8)
+        s += 1
+        # The table went more than eviction_slack rows over max_rows
+        self.assertEquals(s.count_rows(), 3)
+        for i in xrange(2):
+            s += 1
+        self.assertEquals(self.tracker.evict(), 2)
+        self.assertEquals(s.get_number_of_rows(), 3)
+        self.assertEquals([r['Count'] for r in s.get_rows()], [9, 10, 11])
+
+    def test_default_eviction_slack(self):
+        s = self.tracker['Statistic']
+        s.max_rows = 50
+        self.assertEquals(s.eviction_slack(), 5)
+        for i in xrange(55):
+            s += 1
+        self.assertEquals(s.count_rows(), 55)
+        s += 1
+        self.assertEquals(s.count_rows(), 50)
+        self.assertEquals(s.get_first()[0]['Count'], 7)
+
+    def test_buffered_max_rows(self):
+        tracker = AnonymousUsageTracker('UnitTests', os.path.join(self.tmpdir, 'au_buffered.db'), buffer_size=10)
+        tracker.track_statistic('Statistic', max_rows=3)
+        s = tracker['Statistic']
+        for i in xrange(8):
+            s += 1
+        self.assertEquals(s.get_number_of_rows(), 3)
+        self.assertEquals([r['Count'] for r in s.get_rows()], [6, 7, 8])
+
+    def test_delete_last(self):
+        s = self.tracker['Statistic']
+        for i in xrange(3):
+            s += 1
+        s.delete_last()
+        self.assertEquals(s.count_rows(), 2)
+        self.assertEquals(s.get_last()[0]['Count'], 2)
+
+    def test_schema_cache(self):
+        dbcon = self.tracker.dbcon
+        self.assertTrue(self.tracker.table_exists(dbcon, 'Statistic'))
+        self.assertFalse(self.tracker.table_exists(dbcon, 'NewStatistic'))
+        self.assertEquals([c[0] for c in self.tracker.table_columns(dbcon, 'Statistic')], ['UUID', 'Count', 'Time'])
+        self.tracker.track_statistic('NewStatistic')
+        self.assertTrue(self.tracker.table_exists(dbcon, 'NewStatistic'))
+
+    def test_time_is_epoch(self):
+        before = time.time()
+        self.tracker['Statistic'] += 1
+        t = self.tracker['Statistic'].get_last()[0]['Time']
+        self.assertTrue(before <= t <= time.time())
+        indexes = self.tracker.dbcon.execute("PRAGMA index_list(Statistic)").fetchall()
+        self.assertEquals([i[1] for i in indexes], ['Statistic_Time'])
+        self.assertEquals(get_schema_version(self.tracker.dbcon), SCHEMA_VERSION)
+
+    def test_rows_between(self):
+        s = self.tracker['Statistic']
+        for i in xrange(5):
+            s += 1
+        times = [r['Time'] for r in s.get_rows()]
+        rows = s.get_rows_between(times[1], times[3])
+        self.assertEquals([r['Time'] for r in rows], times[1:3])
+        self.assertEquals(len(s.get_rows_between(since=times[2])), 3)
+        self.assertEquals(len(s.get_rows_between(until=datetime.datetime.now() + datetime.timedelta(days=1))), 5)
+
+    def test_schema_migration(self):
+        path = os.path.join(self.tmpdir, 'au_version0.db')
+        dbconn = sqlite3.connect(path)
+        dbconn.execute('CREATE TABLE "Statistic"("UUID" INTEGER, "Count" REAL, "Time" TEXT)')
+        dbconn.executemany('INSERT INTO Statistic VALUES (?, ?, ?)',
+                           [('UnitTests', 1, '05/02/2016 13:30:00'), ('UnitTests', 2, '06/02/2016 09:00:05')])
+        dbconn.execute('DELETE FROM Statistic WHERE Count = 1')
+        dbconn.commit()
+        dbconn.close()
+
+        tracker = AnonymousUsageTracker('UnitTests', path)
+        tracker.track_statistic('Statistic')
+        self.assertEquals(get_schema_version(tracker.dbcon), SCHEMA_VERSION)
+        self.assertEquals(tracker.table_columns(tracker.dbcon, 'Statistic')[2], ('Time', 'REAL'))
+        row = tracker.dbcon.execute('SELECT ROWID, * FROM Statistic').fetchone()
+        self.assertEquals(row[0], 2)
+        self.assertEquals(row['Time'], time.mktime(datetime.datetime(2016, 2, 6, 9, 0, 5).timetuple()))
+        tracker['Statistic'] += 1
+        self.assertEquals([r['Count'] for r in tracker['Statistic'].get_rows()], [2, 3])
+        tracker.close()
+
+    def test_query(self):
+        s = self.tracker['Statistic']
+        for i in xrange(5):
+            s += 1
+        times = [r['Time'] for r in s.get_rows()]
+        self.assertEquals([r['Count'] for r in s.query(since=times[1], limit=2)], [2, 3])
+        self.assertEquals([r['Count'] for r in s.query(order='desc', limit=2)], [5, 4])
+        rows = s.iter_rows(until=times[2])
+        self.assertEquals(next(rows)['Count'], 1)
+        self.assertEquals([r['Count'] for r in rows], [2])
+        self.assertRaises(ValueError, s.query, order='newest')
+
+    def test_query_partial_database(self):
+        tracker = AnonymousUsageTracker('UnitTests', os.path.join(self.tmpdir, 'au_query.db'), submit_interval_s=3600)
+        tracker.track_statistic('Statistic')
+        s = tracker['Statistic']
+        for i in xrange(3):
+            s += 1
+        # Move the rows into the master database as a submission would
+        tracker.storage.merge({'Statistic': 3}, {})
+        for i in xrange(3):
+            s += 1
+        self.assertTrue(tracker.table_exists(tracker.dbcon_master, 'Statistic'))
+        self.assertEquals([r['Count'] for r in s.query()], [1, 2, 3, 4, 5, 6])
+        self.assertEquals([r['Count'] for r in s.query(order='desc', limit=4)], [6, 5, 4, 3])
+        tracker.close()
@@ -0,0 +1,63 @@
+import os
+import threading
+
+from anonymoususage import AnonymousUsageTracker
+from . import AnonymousUsageTests
+
+
+class TrackerTests(AnonymousUsageTests):
+
+    def test_default_pragmas(self):
+        dbcon = self.tracker.dbcon_master
+        self.assertEquals(dbcon.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        # NORMAL
+        self.assertEquals(dbcon.execute('PRAGMA synchronous').fetchone()[0], 1)
+
+    def test_custom_pragmas(self):
+        tracker = AnonymousUsageTracker('UnitTests', os.path.join(self.tmpdir, 'au_pragmas.db'), submit_interval_s=60,
+                                        sqlite_pragmas={'journal_mode': None, 'cache_size': -4000})
+        for dbcon in (tracker.dbcon_master, tracker.dbcon_part):
+            self.assertEquals(dbcon.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+            self.assertEquals(dbcon.execute('PRAGMA cache_size').fetchone()[0], -4000)
+        tracker.close()
+
+    def test_concurrent_inserts(self):
+        # Evict on every insert past max_rows
+        self.tracker.eviction_slack = 0
+        names = ['Statistic%d' % i for i in xrange(4)]
+        for name in names:
+            self.tracker.track_statistic(name, max_rows=50)
+
+        def increment(name):
+            for i in xrange(100):
+                self.tracker[name] += 1
+
+        threads = [threading.Thread(target=increment, args=(name,)) for name in names]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for name in names:
+            s = self.tracker[name]
+            self.assertEquals(s.count, 100)
+            self.assertEquals(s.get_number_of_rows(), 50)
+            self.assertEquals(s.count_rows(), 50)
+
+    def test_connection_per_thread(self):
+        connections = {}
+        self.tracker['Statistic'] += 1
+
+        def read(name):
+            connections[name] = self.tracker.dbcon
+            connections[name + '_count'] = self.tracker['Statistic'].get_last()[0]['Count']
+
+        for name in ('a', 'b'):
+            t = threading.Thread(target=read, args=(name,))
+            t.start()
+            t.join()
+        self.assertIsNot(connections['a'], self.tracker.dbcon)
+        # The second thread is handed the connection of the first thread, which has exited
+        self.assertIs(connections['a'], connections['b'])
+        self.assertEquals(connections['a_count'], 1)
+        self.assertEquals(connections['b_count'], 1)
@@ -0,0 +1,74 @@
+import time
+
+from anonymoususage.uploader import Uploader
+from .submission import HQTests
+
+
+class UploaderTests(HQTests):
+
+    def setUp(self):
+        super(UploaderTests, self).setUp()
+        self.uploader = Uploader(self.host, timeout=5, retries=2, backoff_s=0, failure_threshold=2, cooldown_s=60)
+
+    def tearDown(self):
+        self.uploader.close()
+        super(UploaderTests, self).tearDown()
+
+    def test_connection_is_reused(self):
+        for i in xrange(3):
+            self.assertTrue(self.uploader.post('/usagestats/upload', '{}'))
+        self.assertEquals(len(self.server.payloads), 3)
+        self.assertEquals(len(self.server.connections), 1)
+
+    def test_retry(self):
+        self.server.statuses = [503, 500]
+        self.assertTrue(self.uploader.post('/usagestats/upload', '{}'))
+        self.assertEquals(len(self.server.encodings), 3)
+        self.assertEquals(self.uploader.failures, 0)
+
+    def test_client_errors_are_not_retried(self):
+        self.server.statuses = [400]
+        self.assertFalse(self.uploader.post('/usagestats/upload', '{}'))
+        self.assertEquals(len(self.server.encodings), 1)
+
+    def test_backoff(self):
+        uploader = Uploader(self.host, backoff_s=1, max_backoff_s=4)
+        for attempt, limit in ((1, 1), (2, 2), (3, 4), (10, 4)):
+            for i in xrange(20):
+                self.assertTrue(0 <= uploader.backoff(attempt) <= limit)
+        uploader.close()
+
+    def test_circuit_breaker(self):
+        self.server.accept = 0
+        self.assertFalse(self.uploader.post('/usagestats/upload', '{}'))
+        self.assertFalse(self.uploader.is_open)
+        self.assertFalse(self.uploader.post('/usagestats/upload', '{}'))
+        self.assertTrue(self.uploader.is_open)
+
+        # Uploads are refused without contacting the HQ while the circuit is open
+        n_requests = len(self.server.encodings)
+        self.server.accept = None
+        self.assertFalse(self.uploader.post('/usagestats/upload', '{}'))
+        self.assertEquals(len(self.server.encodings), n_requests)
+
+        # After the cooldown an upload is let through and closes the circuit when it succeeds
+        self.uploader._open_until = time.time()
+        self.assertTrue(self.uploader.post('/usagestats/upload', '{}'))
+        self.assertFalse(self.uploader.is_open)
+        self.assertEquals(self.uploader.failures, 0)
+
+    def test_tracker_pauses_submissions(self):
+        self.tracker.application_name, self.tracker.application_version = 'UnitTests', '1.0'
+        self.tracker.setup_hq(self.host, 'api_key')
+        self.tracker._uploader.backoff_s = 0
+        self.tracker.start_watcher()
+        self.server.accept = 0
+        for i in xrange(self.tracker.HQ_FAILURE_THRESHOLD):
+            self.assertFalse(self.tracker.submit_statistics())
+        self.assertTrue(self.tracker._uploader.is_open)
+        n_requests = len(self.server.encodings)
+        self.assertFalse(self.tracker.submit_statistics())
+        self.assertEquals(len(self.server.encodings), n_requests)
+        # The watcher keeps running and resumes uploading once the circuit closes
+        self.assertTrue(self.tracker._watcher_enabled)
+        self.tracker.stop_watcher()
@@ -0,0 +1,53 @@
+import threading
+import unittest
+
+from anonymoususage.exceptions import FutureTimeoutError
+from anonymoususage.worker import Worker
+
+
+class WorkerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = Worker('unit_tests')
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def test_result(self):
+        future = self.worker.submit(lambda a, b=0: a + b, 1, b=2)
+        self.assertEquals(future.result(5), 3)
+        self.assertTrue(future.done())
+        self.assertIsNone(future.exception())
+
+    def test_exception(self):
+        future = self.worker.submit(lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, future.result, 5)
+        self.assertIsInstance(future.exception(), ZeroDivisionError)
+
+    def test_timeout(self):
+        event = threading.Event()
+        future = self.worker.submit(event.wait)
+        self.assertRaises(FutureTimeoutError, future.result, 0.05)
+        self.assertFalse(future.done())
+        event.set()
+        future.result(5)
+
+    def test_calls_run_in_order(self):
+        calls = []
+        futures = [self.worker.submit(calls.append, i) for i in xrange(10)]
+        futures[-1].result(5)
+        self.assertEquals(calls, range(10))
+
+    def test_done_callback(self):
+        results = []
+        future = self.worker.submit(lambda: 'done')
+        future.add_done_callback(lambda f: results.append(f.result()))
+        future.result(5)
+        # Callbacks added after the call finished run right away
+        future.add_done_callback(lambda f: results.append(f.result()))
+        self.assertEquals(results, ['done', 'done'])
+
+    def test_restart_after_stop(self):
+        self.worker.submit(lambda: None).result(5)
+        self.worker.stop()
+        self.assertEquals(self.worker.submit(lambda: 1).result(5), 1)